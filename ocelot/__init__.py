@@ -5,12 +5,13 @@ general ocelot description
 __version__ = '19.06.0'
 
 
-__all__ = ['Twiss', 'twiss', "Beam", "Particle", "get_current", "get_envelope",  # beam
-            "ellipse_from_twiss", "ParticleArray",    # beam
+__all__ = ['Twiss', 'twiss', 'TwissTable', 'twiss_table', 'twiss_chromatic', "Beam", "Particle", "get_current", "get_envelope",  # beam
+            "ellipse_from_twiss", "ParticleArray", "ensemble_array", "get_envelopes",    # beam
            "global_slice_analysis",  # beam
            "save_particle_array", "load_particle_array",            # io
            'fodo_parameters', 'lattice_transfer_map', 'TransferMap', 'gauss_from_twiss',  # optics
            "get_map", "MethodTM", "SecondTM", "KickTM", "CavityTM", "UndulatorTestTM",  # optics
+           "tm_cache",  # optics
            'Element', 'Multipole', 'Quadrupole', 'RBend', "Matrix", "UnknownElement",  # elements
            'SBend', 'Bend', 'Drift', 'Undulator', 'Hcor',  # elements
            'Vcor', "Sextupole", "Monitor", "Marker", "Octupole", "Cavity", "Edge",  # elements
@@ -18,7 +19,9 @@ __all__ = ['Twiss', 'twiss', "Beam", "Particle", "get_current", "get_envelope",
            "match", "match_tunes",  # match
            "Navigator", "tracking_step", "create_track_list", "track_nturns", "freq_analysis",  # track
             "contour_da", "track_nturns_mpi", "nearest_particle", "stable_particles",  # track
-            "spectrum", "track",  # track
+            "spectrum", "track", "TurnRecorder", "track_nturns_pool", "da_pool", "fma_pool", "naff", "naff_fma",  # track
+           "LongitudinalLattice",  # longitudinal
+           "BeamMoments", "get_moments", "moments_from_twiss", "track_moments",  # moments
            "pi", "m_e_eV", "m_e_MeV", "m_e_GeV",  # globals
            "compensate_chromaticity",  # chromaticity
            "EbeamParams",  # beam_params
@@ -39,6 +42,8 @@ from ocelot.cpbd.optics import *
 from ocelot.cpbd.elements import *
 from ocelot.cpbd.match import *
 from ocelot.cpbd.track import *
+from ocelot.cpbd.longitudinal import *
+from ocelot.cpbd.moments import *
 from ocelot.common.globals import *
 from ocelot.common.logging import *
 from ocelot.cpbd.chromaticity import *
@@ -120,7 +120,64 @@ class Twiss:
         val += "s        = " + str(self.s) + "\n"
         return val
 
-            
+
+
+class TwissTable:
+    """
+    Columnar container of twiss parameters along a lattice.
+    Every parameter of Twiss is stored as a numpy array (e.g. tws.beta_x, tws.s), ids are stored in a list.
+    The table can be used as a list of Twiss objects: tws[-1], tws[2:5], len(tws), [tw.beta_x for tw in tws].
+    Note: Twiss objects returned by indexing are copies, changing them does not change the table.
+    """
+    keys = [key for key in Twiss().__dict__ if key != "id"]
+
+    def __init__(self, n=0):
+        """
+        :param n: number of points
+        """
+        for key in self.keys:
+            setattr(self, key, np.zeros(n))
+        self.id = [""] * n
+
+    @classmethod
+    def from_list(cls, twiss_list):
+        """
+        :param twiss_list: list of Twiss objects
+        :return: TwissTable
+        """
+        table = cls(0)
+        for key in cls.keys:
+            setattr(table, key, np.array([getattr(tw, key) for tw in twiss_list], dtype=float))
+        table.id = [tw.id for tw in twiss_list]
+        return table
+
+    def to_list(self):
+        """
+        :return: list of Twiss objects
+        """
+        return [self[i] for i in range(len(self))]
+
+    def __len__(self):
+        return len(self.id)
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            table = TwissTable(0)
+            for key in self.keys:
+                setattr(table, key, getattr(self, key)[item])
+            table.id = self.id[item]
+            return table
+        tws = Twiss()
+        for key in self.keys:
+            setattr(tws, key, float(getattr(self, key)[item]))
+        tws.id = self.id[item]
+        return tws
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+
 class Particle:
     """
     particle
@@ -581,19 +638,241 @@ class ParticleArray:
         self.q_array = np.zeros(n)    # charge
         self.s = 0.0
         self.E = 0.0
+        # optional reference energies of the particles, None - all particles have the reference energy self.E.
+        # The transfer maps are applied to the groups of particles with the same energy (see energy_buckets())
+        self.E_array = None
+        # width of the energy bucket [GeV], 0 - only the particles with exactly the same energy are grouped
+        self.dE_bucket = 0.
+        self._buckets = None
+        # optional index of the bunch of every particle, the ensemble of bunches is tracked in one sweep
+        # (see ensemble_array()), physics processes are applied to every bunch separately
+        self.bunch_ids = None
+        self._bunch_inds = None
+        self._nbunches = 0
+        # lost particles are marked in the alive mask and removed from the arrays only when
+        # the fraction of the lost particles exceeds compact_threshold (see mark_lost() and compact())
+        self.compact_threshold = 0.
+        self.losses = []
+        self._alive = None
+        self._ids = None
+
+    def _check_mask(self):
+        n = self.size()
+        if self._alive is None or len(self._alive) != n:
+            self._alive = np.ones(n, dtype=bool)
+            self._ids = np.arange(n)
+
+    def alive_mask(self):
+        """
+        :return: bool array, False for the lost particles which are not removed from the array yet
+        """
+        self._check_mask()
+        return self._alive
+
+    def particle_ids(self):
+        """
+        :return: indices of the particles in the array before the lost particles were removed
+        """
+        self._check_mask()
+        return self._ids
+
+    def n_alive(self):
+        return int(np.count_nonzero(self.alive_mask()))
+
+    def mark_lost(self, inds, turn=-1, eid=None, cause=""):
+        """
+        Marks the particles as lost and adds them to the loss record. The coordinates of the lost particles are set
+        to zero, the particles are removed from the arrays by compact().
+
+        :param inds: indices (or bool mask) of the particles in the current array
+        :param turn: turn number
+        :param eid: id of the element where the particles are lost
+        :param cause: reason of the loss, string or array of strings for every index
+        :return: indices of the particles which were alive before the call
+        """
+        alive = self.alive_mask()
+        inds = np.arange(self.size())[inds]
+        new = alive[inds]
+        inds = inds[new]
+        if len(inds) == 0:
+            return inds
+        cause = np.broadcast_to(np.asarray(cause), new.shape)[new]
+        self.losses.append((self._ids[inds], turn, self.s, eid, cause, self.rparticles[:, inds]))
+        alive[inds] = False
+        self.rparticles[:, inds] = 0.
+        return inds
+
+    def compact(self, threshold=None):
+        """
+        Removes the lost particles from the arrays if the fraction of the lost particles exceeds the threshold
+
+        :param threshold: None - self.compact_threshold
+        :return: True if the arrays were compacted
+        """
+        threshold = self.compact_threshold if threshold is None else threshold
+        alive = self.alive_mask()
+        n_lost = len(alive) - np.count_nonzero(alive)
+        if n_lost == 0 or n_lost <= threshold * len(alive):
+            return False
+        self.rparticles = self.rparticles[:, alive]
+        if len(self.q_array) == len(alive):
+            self.q_array = self.q_array[alive]
+        if self.E_array is not None:
+            self.E_array = self.E_array[alive]
+        if self.bunch_ids is not None:
+            self.bunch_ids = self.bunch_ids[alive]
+        self._ids = self._ids[alive]
+        self._alive = np.ones(len(self._ids), dtype=bool)
+        return True
+
+    def loss_record(self):
+        """
+        :return: dictionary with the arrays "id" - index of the particle in the initial array, "turn", "s",
+                "eid" - element id, "cause" and "rparticles" - coordinates of the particles before the loss
+        """
+        record = {"id": np.zeros(0, dtype=int), "turn": np.zeros(0, dtype=int), "s": np.zeros(0),
+                  "eid": np.zeros(0, dtype=object), "cause": np.zeros(0, dtype=str), "rparticles": np.zeros((6, 0))}
+        if len(self.losses) == 0:
+            return record
+        ids, turn, s, eid, cause, X = zip(*self.losses)
+        n = [len(i) for i in ids]
+        record["id"] = np.concatenate(ids)
+        record["turn"] = np.repeat(turn, n)
+        record["s"] = np.repeat(s, n)
+        record["eid"] = np.repeat(np.array(eid, dtype=object), n)
+        record["cause"] = np.concatenate(cause)
+        record["rparticles"] = np.concatenate(X, axis=1)
+        return record
+
+    def energies(self):
+        """
+        :return: array of the reference energies of the particles
+        """
+        if self.E_array is None:
+            return np.full(self.size(), float(self.E))
+        return self.E_array
+
+    def energy_buckets(self, dE=None):
+        """
+        Groups the particles by the reference energy. The particles in one bucket are tracked
+        with the transfer map calculated for the energy of the bucket.
+
+        :param dE: width of the energy bucket [GeV], None - self.dE_bucket. If dE > 0 the energies are rounded
+                    to the multiple of dE, otherwise only the particles with exactly the same energy are grouped
+        :return: list of (energy, indices), indices is slice(None) if there is only one bucket
+        """
+        if self.E_array is None:
+            return [(self.E, slice(None))]
+        dE = self.dE_bucket if dE is None else dE
+        # the buckets are reused until E_array is replaced or changed in place (e.g. by a cavity map)
+        cache = self._buckets
+        if cache is not None and cache[0] is self.E_array and cache[1] == dE and np.array_equal(cache[2], self.E_array):
+            return cache[3]
+        energies = self.E_array
+        if dE > 0:
+            energies = np.round(energies / dE) * dE
+        levels, inverse = np.unique(energies, return_inverse=True)
+        if len(levels) == 1:
+            buckets = [(float(levels[0]), slice(None))]
+        else:
+            order = np.argsort(inverse, kind="stable")
+            bounds = np.cumsum(np.bincount(inverse))[:-1]
+            buckets = [(float(energy), inds) for energy, inds in zip(levels, np.split(order, bounds))]
+        self._buckets = (self.E_array, dE, np.copy(self.E_array), buckets)
+        return buckets
+
+    def n_bunches(self):
+        """
+        :return: number of the bunches in the ensemble, 1 if bunch_ids is None
+        """
+        if self.bunch_ids is None:
+            return 1
+        # the bunches lost completely are counted as well
+        n = int(np.max(self.bunch_ids)) + 1 if len(self.bunch_ids) > 0 else 0
+        return max(n, self._nbunches)
 
-    def rm_tails(self, xlim, ylim, px_lim, py_lim):
+    def bunch_indices(self):
         """
-        comment behaviour and possibly move out of class
+        :return: list of the arrays of the particle indices of every bunch
+        """
+        if self.bunch_ids is None:
+            return [np.arange(self.size())]
+        if self._bunch_inds is None or self._bunch_inds[0] is not self.bunch_ids:
+            order = np.argsort(self.bunch_ids, kind="stable")
+            bounds = np.cumsum(np.bincount(self.bunch_ids, minlength=self.n_bunches()))[:-1]
+            self._bunch_inds = (self.bunch_ids, np.split(order, bounds))
+        return self._bunch_inds[1]
+
+    def sub_array(self, inds):
+        """
+        Copy of the part of the array, e.g. one bunch of the ensemble. The lost particles are not removed
+        from the sub array (see set_sub_array()).
+
+        :param inds: indices of the particles
+        :return: ParticleArray
+        """
+        self._check_mask()
+        sub = ParticleArray()
+        sub.rparticles = self.rparticles[:, inds]
+        sub.q_array = self.q_array[inds]
+        sub.s = self.s
+        energies = self.energies()[inds]
+        sub.E = float(energies[0]) if len(energies) > 0 else self.E
+        sub.E_array = np.copy(energies) if np.any(energies != sub.E) else None
+        sub.compact_threshold = 1.
+        sub._alive = self._alive[inds]
+        sub._ids = self._ids[inds]
+        return sub
+
+    def set_sub_array(self, inds, sub):
+        """
+        Writes the sub array (see sub_array()) back, the particles lost in the sub array are marked as lost.
+
+        :param inds: indices of the particles
+        :param sub: ParticleArray
+        :return: None
+        """
+        self._check_mask()
+        self.rparticles[:, inds] = sub.rparticles
+        self.q_array[inds] = sub.q_array
+        energies = sub.energies()
+        if self.E_array is not None or np.any(energies != self.E):
+            self.E_array = np.array(self.energies())
+            self.E_array[inds] = energies
+        self._alive[inds] = sub.alive_mask()
+        self.losses.extend(sub.losses)
+
+    def bunch(self, i):
+        """
+        :param i: index of the bunch in the ensemble
+        :return: ParticleArray, copy of the bunch
+        """
+        return self.sub_array(self.bunch_indices()[i])
+
+    def rm_tails(self, xlim, ylim, px_lim, py_lim, turn=-1, eid=None):
+        """
+        Marks the particles outside the limits or with NaN coordinates as lost (see mark_lost())
+        and compacts the arrays if the fraction of the lost particles exceeds self.compact_threshold.
+
+        :param xlim: limit of |x|
+        :param ylim: limit of |y|
+        :param px_lim: limit of |px|
+        :param py_lim: limit of |py|
+        :param turn: turn number for the loss record
+        :param eid: element id for the loss record
+        :return: indices of the lost particles in the array before the compaction
         """
         x = abs(self.x())
         px = abs(self.px())
         y = abs(self.y())
         py = abs(self.py())
-        ind_angles = np.append(np.argwhere(px > px_lim), np.argwhere(py > py_lim))
-        p_idxs = np.unique(np.append(np.argwhere(x > xlim), np.append(np.argwhere(y > ylim), np.append(np.argwhere(x != x), np.append(np.argwhere(y!= y), ind_angles)) )))
-        #e_idxs = [append([], x) for x in array([6*p_idxs, 6*p_idxs+1, 6*p_idxs+2, 6*p_idxs+3, 6*p_idxs+4, 6*p_idxs+5])]
-        self.rparticles = np.delete(self.rparticles, p_idxs, axis=1)
+        conditions = [np.logical_or(x != x, y != y), x > xlim, y > ylim, px > px_lim, py > py_lim]
+        lost = np.logical_or.reduce(conditions) & self.alive_mask()
+        p_idxs = np.flatnonzero(lost)
+        if len(p_idxs) > 0:
+            cause = np.select([c[p_idxs] for c in conditions], ["nan", "x", "y", "px", "py"])
+            self.mark_lost(p_idxs, turn=turn, eid=eid, cause=cause)
+            self.compact()
         return p_idxs
 
     def __getitem__(self, idx):
@@ -618,6 +897,8 @@ class ParticleArray:
             self[i] = p
         self.s = p_list[0].s
         self.E = p_list[0].E
+        energies = np.array([p.E for p in p_list], dtype=float)
+        self.E_array = energies if np.any(energies != self.E) else None
 
     def array2list(self):
         p_list = []
@@ -634,7 +915,7 @@ class ParticleArray:
             p.py = self.rparticles[3, i]
             p.tau =self.rparticles[4, i]
             p.p =  self.rparticles[5, i]
-            p.E = self.E
+            p.E = self.E if self.E_array is None else float(self.E_array[i])
             p.s = self.s
         return p_list
 
@@ -686,6 +967,11 @@ class ParticleArray:
         p.q_array[:] = self.q_array[n0:n_end:nth]*nth
         p.s = self.s
         p.E = self.E
+        if self.E_array is not None:
+            p.E_array = self.E_array[n0:n_end:nth].copy()
+        if self.bunch_ids is not None:
+            p.bunch_ids = self.bunch_ids[n0:n_end:nth].copy()
+            p._nbunches = self._nbunches
         return p
 
     def rescale2energy(self, energy):
@@ -726,6 +1012,26 @@ class ParticleArray:
         return val
 
 
+def ensemble_array(p_arrays):
+    """
+    Merges the bunches into one ParticleArray to track them in one sweep. The bunches can have different
+    reference energies (see ParticleArray.E_array), ParticleArray.bunch_ids is the index of the bunch in p_arrays.
+
+    :param p_arrays: list of ParticleArray
+    :return: ParticleArray
+    """
+    p_array = ParticleArray()
+    p_array.rparticles = np.concatenate([p.rparticles for p in p_arrays], axis=1)
+    p_array.q_array = np.concatenate([p.q_array for p in p_arrays])
+    p_array.s = p_arrays[0].s
+    p_array.E = p_arrays[0].E
+    energies = np.concatenate([p.energies() for p in p_arrays])
+    p_array.E_array = energies if np.any(energies != p_array.E) else None
+    p_array.bunch_ids = np.repeat(np.arange(len(p_arrays)), [p.size() for p in p_arrays])
+    p_array._nbunches = len(p_arrays)
+    return p_array
+
+
 def recalculate_ref_particle(p_array):
     pref = np.sqrt(p_array.E ** 2 / m_e_GeV ** 2 - 1) * m_e_GeV
     Enew = p_array.p()[0]*pref + p_array.E
@@ -746,6 +1052,9 @@ def get_envelope(p_array, tws_i=Twiss(), bounds=None):
     :param bounds: optional, [left_bound, right_bound] - bounds in units of std(p_array.tau())
     :return: Twiss()
     """
+    if p_array.n_alive() < p_array.size():
+        # the lost particles which are not removed from the array yet (see ParticleArray.mark_lost())
+        p_array = p_array.sub_array(np.flatnonzero(p_array.alive_mask()))
 
     if bounds is not None:
         tau = p_array.tau()
@@ -824,6 +1133,23 @@ def get_envelope(p_array, tws_i=Twiss(), bounds=None):
     tws.alpha_y = -tws.ypy/tws.emit_y
     return tws
 
+def get_envelopes(p_array, tws_i=Twiss(), bounds=None):
+    """
+    Function to calculate twiss parameters of every bunch of the ensemble (see ensemble_array())
+
+    :param p_array: ParticleArray
+    :param tws_i: optional, design Twiss,
+    :param bounds: optional, [left_bound, right_bound] - bounds in units of std(p_array.tau())
+    :return: list of Twiss()
+    """
+    alive = p_array.alive_mask()
+    tws_list = []
+    for inds in p_array.bunch_indices():
+        inds = inds[alive[inds]]
+        tws_list.append(get_envelope(p_array.sub_array(inds), tws_i=tws_i, bounds=bounds) if len(inds) > 0 else Twiss())
+    return tws_list
+
+
 def get_current(p_array, charge=None, num_bins=200):
     """
     Function calculates beam current from particleArray
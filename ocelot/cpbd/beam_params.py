@@ -3,7 +3,7 @@ __author__ = 'Sergey'
 from scipy.integrate import simps
 
 from ocelot.common.globals import *
-from ocelot.cpbd.optics import trace_z, twiss
+from ocelot.cpbd.optics import trace_z, twiss, twiss_z
 from ocelot.cpbd.beam import *
 from ocelot.cpbd.elements import *
 from ocelot.rad.undulator_params import *
@@ -44,26 +44,21 @@ def radiation_integrals(lattice, twiss_0, nsuperperiod = 1):
     h = 0.
     for elem in lattice.sequence:
         if elem.__class__ in (SBend, RBend, Bend) and elem.l != 0:
-            Dx = []
-            Hinvariant = []
-            Z = []
             h = elem.angle/elem.l
 
-            for z in np.linspace(0, elem.l, num=n_points_element, endpoint=True):
-                tws_z = elem.transfer_map(z)*tws_elem
-                Dx.append(tws_z.Dx)
-                Z.append(z)
-                Hx = (tws_z.gamma_x*tws_z.Dx*tws_z.Dx + 2.*tws_z.alpha_x*tws_z.Dxp*tws_z.Dx
-                                        + tws_z.beta_x*tws_z.Dxp*tws_z.Dxp)
-                Hinvariant.append(Hx)
+            Z = np.linspace(0, elem.l, num=n_points_element, endpoint=True)
+            tws_z = twiss_z(elem.transfer_map, tws_elem, Z)
+            Dx = tws_z.Dx
+            Hinvariant = (tws_z.gamma_x*tws_z.Dx*tws_z.Dx + 2.*tws_z.alpha_x*tws_z.Dxp*tws_z.Dx
+                          + tws_z.beta_x*tws_z.Dxp*tws_z.Dxp)
             #H = array(h)
             H2 = h*h
             H3 = np.abs(h*h*h)
-            I1 += h*simps(np.array(Dx), Z)
+            I1 += h*simps(Dx, Z)
             I2 += H2*elem.l  #simps(H2, Z)*nsuperperiod
             I3 += H3*elem.l  #simps(H3, Z)*nsuperperiod
-            I4 += h*(2*elem.k1 + H2)*simps(np.array(Dx), Z)
-            I5 += H3*simps(np.array(Hinvariant), Z)
+            I4 += h*(2*elem.k1 + H2)*simps(Dx, Z)
+            I5 += H3*simps(Hinvariant, Z)
         tws_elem = elem.transfer_map*tws_elem
     #if abs(tws_elem.beta_x - twiss_0.beta_x)>1e-7 or abs(tws_elem.beta_y - twiss_0.beta_y)>1e-7:
     #    print( "WARNING! Results may be wrong! radiation_integral() -> beta functions are not matching. ")
@@ -1,6 +1,6 @@
 __author__ = 'Sergey Tomin'
 
-from ocelot.cpbd.optics import trace_z, twiss
+from ocelot.cpbd.optics import trace_z, twiss, periodic_twiss, twiss_z
 from scipy.integrate import simps
 from numpy.linalg import inv
 from ocelot.cpbd.beam import *
@@ -53,32 +53,21 @@ def natural_chromaticity(lattice, tws_0, nsuperperiod = 1):
     integr_y = 0.
     for elem in lattice.sequence:
         if elem.__class__ in [SBend, RBend, Bend, Quadrupole]:
-            bx = []
-            by = []
-            k = []
-            h = []
-            Z = []
-            for z in np.linspace(0, elem.l,num = 5, endpoint=True):
-                twiss_z = elem.transfer_map(z)*tws_elem
-                bx.append(twiss_z.beta_x)
-                by.append(twiss_z.beta_y)
-                k.append(elem.k1)
-                #print elem.l
-                if elem.__class__ != Quadrupole and elem.l != 0:
-                    h.append(elem.angle/elem.l)
-                else:
-                    h.append(0.)
-                Z.append(z)
-
-            H2 = np.array(h)*np.array(h)
-            X = np.array(bx)*(np.array(k)+ H2)
-            Y = -np.array(by)*np.array(k)
+            Z = np.linspace(0, elem.l, num=5, endpoint=True)
+            tws_z = twiss_z(elem.transfer_map, tws_elem, Z)
+            if elem.__class__ != Quadrupole and elem.l != 0:
+                h = elem.angle/elem.l
+            else:
+                h = 0.
+            H2 = h*h
+            X = tws_z.beta_x*(elem.k1 + H2)
+            Y = -tws_z.beta_y*elem.k1
             integr_x += simps(X, Z)
             integr_y += simps(Y, Z)
         elif elem.__class__ == Multipole:
-            twiss_z = elem.transfer_map*tws_elem
-            integr_x += twiss_z.beta_x*elem.kn[1]
-            integr_y -= twiss_z.beta_y*elem.kn[1]
+            tws_mult = elem.transfer_map*tws_elem
+            integr_x += tws_mult.beta_x*elem.kn[1]
+            integr_y -= tws_mult.beta_y*elem.kn[1]
         tws_elem = elem.transfer_map*tws_elem
     ksi_x = -(integr_x - edge_ksi_x)/(4*pi)
     ksi_y = -(integr_y - edge_ksi_y)/(4*pi)
@@ -93,21 +82,10 @@ def sextupole_chromaticity(lattice, tws0, nsuperperiod = 1):
     integr_y = 0.
     for elem in lattice.sequence:
         if elem.__class__ == Sextupole:
-            bx = []
-            by = []
-            Dx = []
-            Z = []
-
-            for z in np.linspace(0, elem.l, num = 5, endpoint=True):
-                twiss_z = elem.transfer_map(z)*tws_elem
-                bx.append(twiss_z.beta_x)
-                by.append(twiss_z.beta_y)
-                Dx.append(twiss_z.Dx)
-
-                Z.append(z)
-
-            X = np.array(bx)*np.array(Dx)
-            Y = np.array(by)*np.array(Dx)
+            Z = np.linspace(0, elem.l, num=5, endpoint=True)
+            tws_z = twiss_z(elem.transfer_map, tws_elem, Z)
+            X = tws_z.beta_x*tws_z.Dx
+            Y = tws_z.beta_y*tws_z.Dx
             integr_x += simps(X, Z)*elem.k2
             integr_y += simps(Y, Z)*elem.k2
 
@@ -177,9 +155,8 @@ def compensate_chromaticity(lattice,  ksi_x_comp=0, ksi_y_comp=0,  nsuperperiod=
     '''
     old chromaticity compensation with 2 sextupole families
     '''
-    tws0 = Twiss()
-    tws = twiss(lattice, tws0)
-    tws_0 = tws[0]
+    # periodic solution from the one-turn map, the map is updated only for modified elements
+    tws_0 = periodic_twiss(Twiss(), lattice.cached_transfer_map(energy=0.)[0])
     ksi_comp = (ksi_x_comp, ksi_y_comp)
     ksi = natural_chromaticity(lattice, tws_0, nsuperperiod)
     print("ksi_x = ", ksi[0])
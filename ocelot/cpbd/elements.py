@@ -7,6 +7,55 @@ from ocelot.cpbd.field_map import FieldMap
 import numpy as np
 
 
+class ObjectParam:
+    """
+    Object parameter of the element (field map, magnetic field function, ...) in the element fingerprint.
+    It is compared by identity and holds the reference to the object, so the id of the object can not be reused
+    by a new object while the fingerprint is a key of the cache (see tm_cache).
+    """
+    __slots__ = ("obj",)
+
+    def __init__(self, obj):
+        self.obj = obj
+
+    def __eq__(self, other):
+        return isinstance(other, ObjectParam) and self.obj is other.obj
+
+    def __hash__(self):
+        return id(self.obj)
+
+    def __repr__(self):
+        return "ObjectParam(" + self.obj.__class__.__name__ + ")"
+
+
+def _hashable_param(value):
+    if value is None or isinstance(value, (bool, int, float, complex, str)):
+        return value
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, np.ndarray):
+        return ("ndarray", value.dtype.str, value.shape, value.tobytes())
+    if isinstance(value, (list, tuple)):
+        return tuple(_hashable_param(v) for v in value)
+    if isinstance(value, dict):
+        return tuple((str(k), _hashable_param(v)) for k, v in sorted(value.items(), key=lambda kv: str(kv[0])))
+    # objects (field maps, magnetic field functions, ...) are compared by identity
+    return ObjectParam(value)
+
+
+def element_fingerprint(element):
+    """
+    Hashable representation of the element parameters. Attribute 'id', private attributes and
+    transfer map are ignored.
+
+    :param element: Element
+    :return: tuple (element class, ((name, value), ...))
+    """
+    params = tuple((key, _hashable_param(value)) for key, value in sorted(element.__dict__.items())
+                   if key[0] != "_" and key not in ("id", "transfer_map"))
+    return element.__class__, params
+
+
 class Element(object):
     """
     Element is a basic beamline building element
@@ -27,6 +76,27 @@ class Element(object):
         self.dtilt = 0.
         self.params = {}
     
+    def __setattr__(self, name, value):
+        object.__setattr__(self, name, value)
+        if name[0] != "_" and name != "transfer_map":
+            # any public attribute change invalidates the element fingerprint
+            self.__dict__["_fingerprint"] = None
+
+    def fingerprint(self, update=False):
+        """
+        Hashable snapshot of the element parameters (class, numbers, strings and arrays). It is used as a key for
+        caching of the transfer maps and to detect modified elements. The snapshot is recalculated lazily
+        after any public attribute has been changed.
+
+        :param update: if True, recalculate the fingerprint (e.g. after in-place change of an array attribute)
+        :return: tuple
+        """
+        params = self.__dict__.get("_fingerprint")
+        if params is None or update:
+            params = element_fingerprint(self)
+            self.__dict__["_fingerprint"] = params
+        return params
+
     def __hash__(self):
         return hash(id(self))
         #return hash((self.id, self.__class__))
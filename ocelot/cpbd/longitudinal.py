@@ -0,0 +1,200 @@
+"""
+Longitudinal tracking for the fast scans of the RF and bunch compressor settings.
+Only (tau, p) of the particles are tracked, the runs of the elements between the cavities are reduced to the
+longitudinal part of the composed second order maps (R55, R56, T566, ...), the cavities are tracked
+with the longitudinal part of CavityTM.map4cav(). All settings of the scan are tracked at once.
+"""
+import logging
+
+import numpy as np
+
+from ocelot.common.globals import m_e_GeV, speed_of_light
+from ocelot.cpbd.beam import ParticleArray
+from ocelot.cpbd.elements import Cavity
+from ocelot.cpbd.optics import SecondTM, ProcessTable, sym_matrix, transfer_maps_mult
+from ocelot.cpbd.r_matrix import cavity_long_coefficients
+
+_logger = logging.getLogger(__name__)
+
+
+def longitudinal_map(t_maps, energy):
+    """
+    Longitudinal part of the composed second order map. The transverse coordinates of the particles are assumed
+    to be zero, the dispersive contributions (e.g. R56 of a chicane) are included by the composition.
+
+    :param t_maps: list of the transfer maps of the elements
+    :param energy: initial energy
+    :return: R, T, energy - 2x2 and symmetric 2x2x2 matrices for (tau, p), final energy
+    """
+    R = np.eye(6)
+    T = np.zeros((6, 6, 6))
+    for tm in t_maps:
+        Rb = tm.R(energy)
+        if tm.__class__ == SecondTM:
+            Tb = sym_matrix(np.copy(tm.T_tilt(energy)))
+        else:
+            Tb = np.zeros((6, 6, 6))
+        T = transfer_maps_mult(R, T, Rb, Tb)[1]
+        R = np.dot(Rb, R)
+        energy += tm.delta_e
+    return R[4:, 4:], T[4:, 4:, 4:], energy
+
+
+def cavity_long_map(tau, p, energy, v, freq, phi, z):
+    """
+    Longitudinal map of the cavity (see CavityTM.map4cav()) vectorized over the cavity settings.
+    The coefficients are shared with cavity_R_z() and CavityTM.long_t_matrix() (see cavity_long_coefficients()),
+    the energy is changed with the exact cosine.
+
+    :param tau: array (K, n)
+    :param p: array (K, n)
+    :param energy: array (K,) of the initial energies [GeV]
+    :param v: array (K,) of the voltages [GeV]
+    :param freq: frequency [Hz]
+    :param phi: array (K,) of the phases [deg]
+    :param z: length of the cavity
+    :return: tau, p, energy - new arrays
+    """
+    E = np.asarray(energy, dtype=float)[:, np.newaxis]
+    V = np.asarray(v, dtype=float)[:, np.newaxis]
+    phi = np.asarray(phi, dtype=float)[:, np.newaxis]
+    r55_cor, r56, r65, r66, T566, T556, T555 = cavity_long_coefficients(E, V, freq, phi, z)[:7]
+    phi = phi * np.pi / 180.
+    E1 = E + V * np.cos(phi)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        g0 = E / m_e_GeV
+        g1 = E1 / m_e_GeV
+        beta0 = np.sqrt(1. - 1. / (g0 * g0))
+        beta1 = np.sqrt(1. - 1. / (g1 * g1))
+        k = 2. * np.pi * freq / speed_of_light
+        # exact cosine for the energy, see CavityTM.map4cav()
+        p1 = np.where(E1 > 0, p * E * beta0 / (E1 * beta1) + V * beta0 / (E1 * beta1) * (
+                      np.cos(-tau * beta0 * k + phi) - np.cos(phi)), r65 * tau + r66 * p)
+    tau1 = (1. + r55_cor) * tau + r56 * p + T566 * p * p + T556 * tau * p + T555 * tau * tau
+    return tau1, p1, E1[:, 0]
+
+
+class LongitudinalLattice:
+    """
+    Lattice reduced to the longitudinal maps for the fast scans of the cavity settings.
+    The maps of the runs of the elements between the cavities and physics processes are composed for every
+    energy and cached, after the change of the elements (e.g. SectionTrack.update_bunch_compressor())
+    only the maps of the modified runs are composed again.
+
+    Example
+    -------
+    long_lat = LongitudinalLattice(lat)
+    long_lat.add_physics_proc(lsc, lat.sequence[0], lat.sequence[-1])
+    tau, p, E = long_lat.track(p_array, v=0.02, phi=np.linspace(-30, 30, 101), cavities=cavities)
+    """
+    def __init__(self, lattice, dE_bucket=0.):
+        """
+        :param lattice: MagneticLattice
+        :param dE_bucket: width of the energy bucket [GeV], the settings with close energies share the maps
+                        of the runs (see ParticleArray.energy_buckets()), 0 - exact energies
+        """
+        self.lattice = lattice
+        self.dE_bucket = dE_bucket
+        self.process_table = ProcessTable(lattice)
+        self.maxsize = 10000
+        self._maps = {}
+
+    def add_physics_proc(self, physics_proc, elem1, elem2):
+        """
+        Adds the collective process (e.g. LSC or Wake). The process is applied as one kick at the beginning of elem2
+        with the step equal to the distance between elem1 and elem2, the transverse coordinates of the particles
+        are frozen at the initial values.
+
+        :param physics_proc: PhysProc
+        :param elem1: start element
+        :param elem2: stop element
+        :return: None
+        """
+        self.process_table.add_physics_proc(physics_proc, elem1, elem2)
+
+    def run_map(self, start, stop, energy):
+        """
+        Longitudinal map of lattice.sequence[start:stop] (see longitudinal_map()), the maps are cached.
+
+        :return: R, T, energy
+        """
+        t_maps = [elem.transfer_map for elem in self.lattice.sequence[start:stop]]
+        key = (start, stop, energy)
+        cached = self._maps.get(key)
+        if cached is None or len(cached[0]) != len(t_maps) or any(a is not b for a, b in zip(cached[0], t_maps)):
+            if len(self._maps) > self.maxsize:
+                self._maps.clear()
+            cached = (t_maps, longitudinal_map(t_maps, energy))
+            self._maps[key] = cached
+        return cached[1]
+
+    def _track_run(self, start, stop, tau, p, E):
+        if start == stop:
+            return tau, p, E
+        energies = E if self.dE_bucket <= 0 else np.round(E / self.dE_bucket) * self.dE_bucket
+        levels, inverse = np.unique(energies, return_inverse=True)
+        maps = [self.run_map(start, stop, float(energy)) for energy in levels]
+        R = np.array([m[0] for m in maps])[inverse]
+        T = np.array([m[1] for m in maps])[inverse]
+        dE = np.array([m[2] - energy for m, energy in zip(maps, levels)])[inverse]
+        R = R[:, :, :, np.newaxis]
+        T = T[:, :, :, :, np.newaxis]
+        tau1 = R[:, 0, 0] * tau + R[:, 0, 1] * p + T[:, 0, 0, 0] * tau * tau + 2 * T[:, 0, 0, 1] * tau * p + \
+               T[:, 0, 1, 1] * p * p
+        p1 = R[:, 1, 0] * tau + R[:, 1, 1] * p + T[:, 1, 0, 0] * tau * tau + 2 * T[:, 1, 0, 1] * tau * p + \
+             T[:, 1, 1, 1] * p * p
+        return tau1, p1, E + dE
+
+    def _apply_proc(self, proc, p_array, tau, p, E):
+        beam = ParticleArray()
+        beam.q_array = p_array.q_array
+        for k in range(len(E)):
+            beam.rparticles = np.copy(p_array.rparticles)
+            beam.rparticles[4] = tau[k]
+            beam.rparticles[5] = p[k]
+            beam.E = E[k]
+            proc.apply(beam, proc.s_stop - proc.s_start)
+            tau[k] = beam.rparticles[4]
+            p[k] = beam.rparticles[5]
+            E[k] = beam.E
+
+    def track(self, p_array, v=None, phi=None, cavities=None):
+        """
+        Longitudinal tracking of the beam for all cavity settings at once.
+
+        :param p_array: ParticleArray, initial beam
+        :param v: None - voltages of the elements, otherwise array (or number) of the voltages [GeV]
+                    of the scanned cavities
+        :param phi: None - phases of the elements, otherwise array (or number) of the phases [deg]
+        :param cavities: list of the scanned cavities, None - all cavities of the lattice
+        :return: tau, p, E - arrays (K, n), (K, n) and (K,) for K cavity settings
+        """
+        self.lattice.update_modified_maps()
+        sequence = self.lattice.sequence
+        nsettings = np.broadcast(np.zeros(1) if v is None else v, np.zeros(1) if phi is None else phi).size
+        tau = np.tile(p_array.tau(), (nsettings, 1))
+        p = np.tile(p_array.p(), (nsettings, 1))
+        E = np.full(nsettings, float(p_array.E))
+
+        kicks = {}
+        for proc in self.process_table.proc_list:
+            kicks.setdefault(proc.indx1, []).append(proc)
+
+        start = 0
+        for i, elem in enumerate(sequence):
+            if i not in kicks and elem.__class__ != Cavity:
+                continue
+            tau, p, E = self._track_run(start, i, tau, p, E)
+            start = i
+            for proc in kicks.get(i, []):
+                self._apply_proc(proc, p_array, tau, p, E)
+            if elem.__class__ == Cavity:
+                scanned = cavities is None or elem in cavities
+                V = np.broadcast_to(elem.v if v is None or not scanned else v, (nsettings,))
+                phase = np.broadcast_to(elem.phi if phi is None or not scanned else phi, (nsettings,))
+                tau, p, E = cavity_long_map(tau, p, E, V, elem.freq, phase, elem.l)
+                start = i + 1
+        tau, p, E = self._track_run(start, len(sequence), tau, p, E)
+        for proc in kicks.get(len(sequence), []):
+            self._apply_proc(proc, p_array, tau, p, E)
+        return tau, p, E
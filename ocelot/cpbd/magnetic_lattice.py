@@ -1,4 +1,5 @@
-from ocelot.cpbd.optics import MethodTM
+from ocelot.cpbd.optics import MethodTM, TransferMapTree, TrackingPlan, twiss_propagate
+from ocelot.cpbd.beam import TwissTable
 from ocelot.cpbd.elements import *
 import logging
 import numpy as np
@@ -158,6 +159,9 @@ class MagneticLattice:
         if not self.check_edges():
             self.add_edges()
         self.update_transfer_maps()
+        self.plan = None  # TrackingPlan, see compile()
+        if getattr(method, "kick_kernel", False):
+            self.compile(order=1)
 
         self.__hash__ = {}
         #print 'creating hash'
@@ -251,6 +255,7 @@ class MagneticLattice:
     def update_transfer_maps(self):
         #E = self.energy
         self.totalLen = 0
+        self._positions = None
         for i, element in enumerate(self.sequence):
             if element.__class__ == Undulator:
                 if element.field_file != None:
@@ -259,27 +264,219 @@ class MagneticLattice:
                         element.l = element.l*0.001
             self.totalLen += element.l
             #print(element.k1)
-            if element.__class__ == Edge:
-
-                if "_e1" in element.id:
-                    bend = self.sequence[i+1]
-                    if bend.__class__ not in (SBend, RBend, Bend):
-                        bend = self.sequence[i - 1]
-                        print("Backtracking?")
-                    self.update_edge_e1(element, bend)
-                elif "_e2" in element.id:
-                    bend = self.sequence[i-1]
-                    if bend.__class__ not in (SBend, RBend, Bend):
-                        bend = self.sequence[i + 1]
-                        print("Backtracking?")
-                    self.update_edge_e2(element, bend)
-                else:
-                    print("EDGE is not updated. Use standard function to create and update MagneticLattice")
-            element.transfer_map = self.method.create_tm(element)
-            _logger.debug("update: " + element.transfer_map.__class__.__name__)
-            if 'pulse' in element.__dict__: element.transfer_map.pulse = element.pulse
+            self.update_element_map(i)
         return self
 
+    def update_element_map(self, i):
+        """
+        Recreate the transfer map of the i-th element of the sequence. The Edge elements are updated from
+        the neighboring dipole.
+
+        :param i: index of the element in the sequence
+        """
+        element = self.sequence[i]
+        if element.__class__ == Edge:
+
+            if "_e1" in element.id:
+                bend = self.sequence[i+1]
+                if bend.__class__ not in (SBend, RBend, Bend):
+                    bend = self.sequence[i - 1]
+                    print("Backtracking?")
+                self.update_edge_e1(element, bend)
+            elif "_e2" in element.id:
+                bend = self.sequence[i-1]
+                if bend.__class__ not in (SBend, RBend, Bend):
+                    bend = self.sequence[i + 1]
+                    print("Backtracking?")
+                self.update_edge_e2(element, bend)
+            else:
+                print("EDGE is not updated. Use standard function to create and update MagneticLattice")
+        element.transfer_map = self.method.create_tm(element)
+        _logger.debug("update: " + element.transfer_map.__class__.__name__)
+        if 'pulse' in element.__dict__: element.transfer_map.pulse = element.pulse
+
+    def update_modified_maps(self):
+        """
+        Recreate the transfer maps of the elements which parameters were changed after the map creation
+        (together with the edges of a modified dipole).
+
+        :return: list of indices of the elements with recreated transfer maps
+        """
+        modified = []
+        changed_bends = set()
+        for i, element in enumerate(self.sequence):
+            params = getattr(element.transfer_map, "element_fingerprint", None)
+            if params is None or element.__dict__.get("_fingerprint") is params:
+                continue
+            if element.fingerprint() == params:
+                element.__dict__["_fingerprint"] = params
+                continue
+            if element.__class__ in (SBend, RBend, Bend):
+                changed_bends.add(id(element))
+            self.update_element_map(i)
+            modified.append(i)
+        if changed_bends:
+            for i, element in enumerate(self.sequence):
+                if element.__class__ == Edge and any(0 <= j < len(self.sequence) and
+                                                     id(self.sequence[j]) in changed_bends for j in (i - 1, i + 1)):
+                    self.update_element_map(i)
+                    modified.append(i)
+        if modified:
+            self.totalLen = sum(element.l for element in self.sequence)
+            self._positions = None
+        return sorted(modified)
+
+    def element_position(self, i):
+        """
+        Position of the start of the i-th element (i = len(sequence) - the lattice end). The element lengths
+        are summed by np.sum and the positions are kept until the transfer maps are updated
+        (see update_transfer_maps() and update_modified_maps()).
+
+        :param i: index of the element
+        :return: Sum[sequence[k].l, {k, 0, i-1}]
+        """
+        positions = self.__dict__.get("_positions")
+        if positions is None or len(positions) != len(self.sequence) + 1:
+            self._lengths = np.array([element.l for element in self.sequence])
+            positions = self._positions = np.full(len(self.sequence) + 1, np.nan)
+        if np.isnan(positions[i]):
+            positions[i] = np.sum(self._lengths[:i])
+        return positions[i]
+
+    def changed_maps(self, maps):
+        """
+        Compare transfer maps of the elements with a snapshot.
+
+        :param maps: list of transfer maps, e.g. [elem.transfer_map for elem in lat.sequence] or None
+        :return: list of indices of the elements with a different transfer map
+        """
+        if maps is None or len(maps) != len(self.sequence):
+            return list(range(len(self.sequence)))
+        return [i for i, element in enumerate(self.sequence) if element.transfer_map is not maps[i]]
+
+    def _update_matrices(self, energy):
+        """
+        Update cached R matrices of the elements.
+
+        :param energy: initial energy
+        :return: index of the first element which matrices were recalculated
+        """
+        n = len(self.sequence)
+        self.update_modified_maps()
+        changed = self.changed_maps(self.__dict__.get("_cache_maps"))
+        first = changed[0] if changed else n
+        self._cache_maps = [element.transfer_map for element in self.sequence]
+        if self.__dict__.get("_cache_energy") != energy or len(self.__dict__.get("_cache_E", [])) != n + 1:
+            first = 0
+            self._cache_energy = energy
+            self._cache_R = np.zeros((n, 6, 6))
+            self._cache_E = np.zeros(n + 1)
+            self._cache_E[0] = energy
+            self._cache_tws = None
+        R = self._cache_R
+        E = self._cache_E
+        for i in range(first, n):
+            tm = self.sequence[i].transfer_map
+            R[i] = tm.R(E[i])
+            E[i + 1] = E[i] + tm.delta_e
+        return first
+
+    def cached_r_matrices(self, energy):
+        """
+        First order matrices of the elements (see lattice_r_matrices()). The matrices are cached, only the matrices
+        of the modified elements are recalculated.
+
+        :param energy: initial energy
+        :return: R - array (N, 6, 6), E - array (N + 1) of the energies (must not be modified)
+        """
+        if self._update_matrices(energy) < len(self.sequence):
+            self._cache_tws = None
+        return self._cache_R, self._cache_E
+
+    def map_tree(self, energy=0., order=1):
+        """
+        Segment tree of the composed transfer maps (see TransferMapTree). The tree is kept by the lattice and
+        updated on every call, only the maps of the modified elements and their parents in the tree are recalculated.
+
+        :param energy: initial energy
+        :param order: 1 - first order maps, 2 - second order maps
+        :return: TransferMapTree
+        """
+        trees = self.__dict__.setdefault("_map_trees", {})
+        key = (energy, order)
+        if key in trees:
+            trees[key].update()
+        else:
+            if len(trees) > 3:
+                trees.clear()
+            self.update_modified_maps()
+            trees[key] = TransferMapTree(self, energy=energy, order=order)
+        return trees[key]
+
+    def cached_transfer_map(self, energy):
+        """
+        First order transfer map of the lattice. The map is composed with the segment tree (see map_tree()),
+        after a change of the elements only O(log N) matrix products are recalculated.
+
+        :param energy: initial energy
+        :return: R, B - 6x6 transfer matrix and 6x1 vector of the lattice
+        """
+        R, B, T = self.map_tree(energy, order=1).transfer_map()
+        return R, B
+
+    def compile(self, energy=0., order=2):
+        """
+        Compile the lattice into a flat execution plan for tracking (see TrackingPlan). Runs of the linear maps
+        are fused into one matrix and, for order=2, runs of the second order maps into one composed R and T.
+        The plans are cached by the lattice, only runs with modified elements are composed again.
+        The plan is used by tracking_step() and track_nturns() until lattice.plan is set to None.
+
+        :param energy: initial energy
+        :param order: 1 - fuse only linear maps, 2 - fuse linear and second order maps
+        :return: TrackingPlan
+        """
+        plans = self.__dict__.setdefault("_plans", {})
+        key = (energy, order)
+        if key in plans:
+            plans[key].update()
+        else:
+            if len(plans) > 3:
+                plans.clear()
+            plans[key] = TrackingPlan(self, energy=energy, order=order)
+        self.plan = plans[key]
+        return self.plan
+
+    def cached_twiss(self, tws0):
+        """
+        Twiss parameters at the end of each element. The result is cached, if the initial twiss parameters
+        are the same as in the previous call, only the twiss parameters downstream of the first modified element
+        are recalculated. tws0 is used as is (gamma_x and gamma_y are not recalculated).
+
+        :param tws0: initial Twiss
+        :return: TwissTable (must not be modified)
+        """
+        first = self._update_matrices(tws0.E)
+        tws0_key = tuple(getattr(tws0, key) for key in TwissTable.keys) + (tws0.id,)
+        table = self.__dict__.get("_cache_tws")
+        if table is None or self._cache_tws0_key != tws0_key:
+            first = 0
+        elif first >= len(self.sequence):
+            return table
+
+        R = self._cache_R[first:]
+        lengths = [element.transfer_map.length for element in self.sequence[first:]]
+        ids = [element.id for element in self.sequence[first:]]
+        if first == 0:
+            table = twiss_propagate(tws0, R, self._cache_E, lengths, ids)
+        else:
+            tail = twiss_propagate(table[first], R, self._cache_E[first:], lengths, ids)
+            for key in TwissTable.keys:
+                getattr(table, key)[first + 1:] = getattr(tail, key)[1:]
+            table.id[first + 1:] = tail.id[1:]
+        self._cache_tws = table
+        self._cache_tws0_key = tws0_key
+        return table
+
     def printElements(self):
         print('\nLattice\n')
         for e in self.sequence:
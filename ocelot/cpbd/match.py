@@ -2,9 +2,16 @@ from scipy.optimize import *
 from ocelot.cpbd.beam_params import radiation_integrals
 from ocelot.cpbd.magnetic_lattice import MagneticLattice
 from ocelot.cpbd.optics import *
+from ocelot.cpbd.r_matrix import uni_matrix_derivative, edge_matrix_derivative
 from ocelot.cpbd.beam import get_envelope
 from ocelot.cpbd.track import track
 import multiprocessing
+import logging
+import copy
+from time import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+_logger = logging.getLogger(__name__)
 
 
 
@@ -34,7 +41,8 @@ def match(lat, constr, vars, tw, verbose=True, max_iter=1000, method='simplex',
     :param tw: initial Twiss
     :param verbose: allow print output of minimization procedure
     :param max_iter:
-    :param method: string, available 'simplex', 'cg', 'bfgs'
+    :param method: string, available 'simplex', 'cg', 'bfgs', 'lm' (Levenberg-Marquardt with the analytic
+                    Jacobian, see match_lm())
     :param weights: function returns weights, for example
                     def weights_default(val):
                         if val == 'periodic': return 10000001.0
@@ -48,6 +56,11 @@ def match(lat, constr, vars, tw, verbose=True, max_iter=1000, method='simplex',
     :param min_i5: minimization of the radiation integral I5. Can be useful for storage rings.
     :return: result
     """
+    if method == 'lm':
+        if min_i5:
+            raise ValueError("match: min_i5 is not supported by method 'lm'")
+        return match_lm(lat, constr, vars, tw, verbose=verbose, max_iter=max_iter, weights=weights,
+                        vary_bend_angle=vary_bend_angle)
     # tw = deepcopy(tw0)
 
     def errf(x):
@@ -91,7 +104,7 @@ def match(lat, constr, vars, tw, verbose=True, max_iter=1000, method='simplex',
         err = 0.0
         if "periodic" in constr.keys():
             if constr["periodic"] == True:
-                tw_loc = periodic_twiss(tw_loc, lattice_transfer_map(lat, tw.E))
+                tw_loc = periodic_twiss(tw_loc, lat.cached_transfer_map(tw.E)[0])
                 tw0 = deepcopy(tw_loc)
                 if tw_loc == None:
                     print("########")
@@ -117,13 +130,14 @@ def match(lat, constr, vars, tw, verbose=True, max_iter=1000, method='simplex',
         '''
                         
         tw_loc.s = 0
-                        
-        for e in lat.sequence:
-            #print e.id,  e in constr.keys()
-            # print tw_loc
-            #print '--->'
-            tw_loc = e.transfer_map * tw_loc
-            # print tw_loc
+        # only the part of the lattice downstream of the first changed element is recalculated
+        tws = lat.cached_twiss(tw_loc)
+        check_all = 'global' in constr.keys()
+
+        for i, e in enumerate(lat.sequence):
+            if not check_all and e not in constr and e not in ref_hsh:
+                continue
+            tw_loc = tws[i + 1]
 
             if 'global' in constr.keys():
                 # print 'there is a global constraint', constr['global'].keys()
@@ -189,6 +203,8 @@ def match(lat, constr, vars, tw, verbose=True, max_iter=1000, method='simplex',
                         err = err + weights(k) * (constr[e][k] - tw_loc.__dict__[k]) ** 2
                         # print err
         
+        tw_loc = tws[-1]
+
         if "total_len" in constr.keys():
             total_len = constr["periodic"]
             err = err + weights('total_len')*(tw_loc.s - total_len)**2
@@ -254,6 +270,560 @@ def match(lat, constr, vars, tw, verbose=True, max_iter=1000, method='simplex',
     return res
 
 
+def _variable_elements(lat, vars, vary_bend_angle=False):
+    """
+    Elements of the lattice sequence which first order matrices depend on the matching variables.
+
+    :return: list (for every variable) of the lists of tuples (index in the sequence, kind of the derivative, argument)
+    """
+    positions = {}
+    for i, elem in enumerate(lat.sequence):
+        positions.setdefault(id(elem), []).append(i)
+    variables = []
+    for var in vars:
+        deriv = []
+        if var.__class__ == list:
+            variables.append(deriv)
+            continue
+        for elem in (var if var.__class__ == tuple else (var,)):
+            for i in positions.get(id(elem), []):
+                if elem.__class__ == Drift:
+                    deriv.append((i, "uni", (1., 0., 0.)))
+                elif elem.__class__ == Quadrupole or (elem.__class__ in [RBend, SBend, Bend] and
+                                                      (var.__class__ == tuple or not vary_bend_angle)):
+                    deriv.append((i, "uni", (0., 1., 0.)))
+                elif elem.__class__ in [RBend, SBend, Bend]:
+                    dh = 1. / elem.l
+                    deriv.append((i, "uni", (0., 0., dh)))
+                    for j in (i - 1, i + 1):
+                        if 0 <= j < len(lat.sequence) and lat.sequence[j].__class__ == Edge:
+                            deriv.append((j, "edge", dh))
+                elif elem.__class__ == Solenoid:
+                    deriv.append((i, "num", "k"))
+                else:
+                    raise ValueError("match_lm: variable of type " + elem.__class__.__name__ + " is not supported")
+        variables.append(deriv)
+    return variables
+
+
+def _element_r_derivative(lat, elem, kind, arg, energy):
+    """
+    Derivative of the first order matrix of the element, analytic for the drifts, quadrupoles, dipoles and edges.
+    For the other elements only the matrix of the element is recalculated with the varied parameter.
+    """
+    tilt = elem.dtilt + elem.tilt
+    if kind == "uni":
+        hx = elem.angle / elem.l if elem.l != 0 else 0.
+        return uni_matrix_derivative(elem.l, elem.k1, hx, *arg, sum_tilts=tilt, energy=energy)
+    if kind == "edge":
+        return edge_matrix_derivative(elem, dh=arg, sum_tilts=tilt)
+    value = getattr(elem, arg)
+    step = 1.e-7 * (1. + abs(value))
+    setattr(elem, arg, value + step)
+    r_plus = lat.method.create_tm(elem).R(energy)
+    setattr(elem, arg, value - step)
+    r_minus = lat.method.create_tm(elem).R(energy)
+    setattr(elem, arg, value)
+    return (r_plus - r_minus) / (2. * step)
+
+
+def twiss_sensitivities(lat, tw, vars, vary_bend_angle=False, periodic=False):
+    """
+    Twiss parameters at the element ends and their derivatives with respect to the matching variables
+    (see match() for the format of vars). The derivatives are calculated in one pass over the lattice from
+    the analytic derivatives of the element matrices and the cumulative transfer matrices, the lattice is not
+    retraced for every variable.
+
+    :param lat: MagneticLattice
+    :param tw: initial Twiss
+    :param vars: list of the variables, e.g. [QF, QD, (Q1, Q2), [tw, "beta_x"]]
+    :param vary_bend_angle: if True the "angle" of the dipoles is varied instead of "k1"
+    :param periodic: if True the periodic solution is used as the initial Twiss
+    :return: tws, derivs - TwissTable and dict {key: array (N + 1, len(vars))} of the derivatives of
+             beta, alpha, gamma, D, D', mu (keys as in Twiss). None, None if the periodic solution does not exist.
+    """
+    tw0 = Twiss(tw)
+    nvars = len(vars)
+    if periodic:
+        tw0 = periodic_twiss(tw0, lat.cached_transfer_map(tw.E)[0])
+        if tw0 is None:
+            return None, None
+    tws = lat.cached_twiss(tw0)
+    R, E = lat.cached_r_matrices(tw.E)
+    n = len(R)
+
+    # augmented matrices of the planes as in twiss_propagate()
+    scale = np.ones(n)
+    acc = np.abs(E[1:] - E[:-1]) > 1.e-10
+    scale[acc] = np.sqrt(E[1:][acc] / E[:-1][acc])
+
+    def plane_matrices(r, k):
+        m = np.zeros((2,) + r.shape[:-2] + (3, 3))
+        for p, i in enumerate((0, 2)):
+            m[p, ..., 0:2, 0:2] = r[..., i:i + 2, i:i + 2] * np.reshape(k, np.shape(k) + (1, 1))
+            m[p, ..., 0:2, 2] = r[..., i:i + 2, 5]
+        return m
+
+    M = plane_matrices(R, scale)
+    M[..., 2, 2] = 1.
+    dR = {}
+    for j, deriv in enumerate(_variable_elements(lat, vars, vary_bend_angle)):
+        for i, kind, arg in deriv:
+            dR.setdefault(i, []).append((j, _element_r_derivative(lat, lat.sequence[i], kind, arg, E[i])))
+
+    if periodic:
+        # derivative of the one-turn matrix, the periodic solution is found from the coupled matrix
+        C6 = cumulative_products(R)
+        C6_prev = np.concatenate((np.eye(6)[np.newaxis], C6[:-1]))
+        C6_inv = np.linalg.inv(C6)
+        dR_lat = np.zeros((nvars, 6, 6))
+        for i, items in dR.items():
+            for j, dr in items:
+                dR_lat[j] += np.dot(C6[-1], np.dot(C6_inv[i], np.dot(dr, C6_prev[i])))
+        m_lat, dm_lat = plane_matrices(C6[-1], 1.), plane_matrices(dR_lat, np.ones(nvars))
+
+    derivs = {}
+    for p, plane in enumerate(("x", "y")):
+        b0, a0, g0 = getattr(tw0, "beta_" + plane), getattr(tw0, "alpha_" + plane), getattr(tw0, "gamma_" + plane)
+        d0, dp0 = getattr(tw0, "D" + plane), getattr(tw0, "D" + plane + "p")
+        db0, da0, dg0, dd0, ddp0, dmu0 = np.zeros((6, nvars))
+        if periodic:
+            m, dm = m_lat[p], dm_lat[p]
+            cos_mu = (m[0, 0] + m[1, 1]) / 2.
+            sin_mu = np.sign(m[0, 1]) * np.sqrt(1. - cos_mu * cos_mu)
+            dsin_mu = -cos_mu * (dm[:, 0, 0] + dm[:, 1, 1]) / 2. / sin_mu
+            db0 = dm[:, 0, 1] / sin_mu - m[0, 1] * dsin_mu / sin_mu ** 2
+            da0 = (dm[:, 0, 0] - dm[:, 1, 1]) / (2. * sin_mu) - (m[0, 0] - m[1, 1]) * dsin_mu / (2. * sin_mu ** 2)
+            dg0 = (2. * a0 * b0 * da0 - (1. + a0 * a0) * db0) / b0 ** 2
+            dX = np.linalg.solve(np.eye(2) - m[:2, :2], (dm[:, :2, 2] + np.matmul(dm[:, :2, :2], [d0, dp0])).T)
+            dd0, ddp0 = dX
+        for j, var in enumerate(vars):
+            if var.__class__ == list:
+                key = var[1]
+                if key == "beta_" + plane:
+                    db0[j], dg0[j] = 1., -(1. + a0 * a0) / b0 ** 2
+                elif key == "alpha_" + plane:
+                    da0[j], dg0[j] = 1., 2. * a0 / b0
+                elif key == "D" + plane:
+                    dd0[j] = 1.
+                elif key == "D" + plane + "p":
+                    ddp0[j] = 1.
+        values = {"beta_": [db0], "alpha_": [da0], "gamma_": [dg0], "D": [dd0], "Dp": [ddp0], "mu": [dmu0]}
+
+        # the product of the matrices is split in segments as in twiss_propagate()
+        det = M[p, :, 0, 0] * M[p, :, 1, 1] - M[p, :, 0, 1] * M[p, :, 1, 0]
+        bounds = {0, n}
+        for k in np.where(np.abs(det - 1.) > 1.e-10)[0]:
+            bounds.update((k, k + 1))
+        if abs(b0 * g0 - a0 * a0 - 1.) > 1.e-10:
+            bounds.add(1)
+        bounds = sorted(b for b in bounds if b <= n)
+        for k1, k2 in zip(bounds[:-1], bounds[1:]):
+            if k1 > 0:
+                b0, a0 = getattr(tws, "beta_" + plane)[k1], getattr(tws, "alpha_" + plane)[k1]
+                g0 = (1. + a0 * a0) / b0
+                d0, dp0 = getattr(tws, "D" + plane)[k1], getattr(tws, "D" + plane + "p")[k1]
+                db0, da0 = values["beta_"][-1][-1], values["alpha_"][-1][-1]
+                dg0 = (2. * a0 * b0 * da0 - (1. + a0 * a0) * db0) / b0 ** 2
+                dd0, ddp0, dmu0 = values["D"][-1][-1], values["Dp"][-1][-1], values["mu"][-1][-1]
+            C = cumulative_products(M[p, k1:k2])
+            C_prev = np.concatenate((np.eye(3)[np.newaxis], C[:-1]))
+            C_inv = np.linalg.inv(C)
+            S = np.zeros((k2 - k1, nvars, 3, 3))
+            for i in range(k1, k2):
+                for j, dr in dR.get(i, []):
+                    dM = plane_matrices(dr, scale[i])[p]
+                    S[i - k1, j] += np.dot(C_inv[i - k1], np.dot(dM, C_prev[i - k1]))
+            G = np.matmul(C[:, np.newaxis], np.cumsum(S, axis=0))
+
+            c = C[:, np.newaxis]
+            c00, c01, c02, c10, c11, c12 = [c[..., i, k] for i, k in ((0, 0), (0, 1), (0, 2), (1, 0), (1, 1), (1, 2))]
+            d00, d01, d02, d10, d11, d12 = [G[..., i, k] for i, k in ((0, 0), (0, 1), (0, 2), (1, 0), (1, 1), (1, 2))]
+            beta = c00 * c00 * b0 - 2 * c00 * c01 * a0 + c01 * c01 * g0
+            alpha = -c00 * c10 * b0 + (c01 * c10 + c11 * c00) * a0 - c01 * c11 * g0
+            dbeta = (2 * c00 * d00 * b0 - 2 * (d00 * c01 + c00 * d01) * a0 + 2 * c01 * d01 * g0 +
+                     c00 * c00 * db0 - 2 * c00 * c01 * da0 + c01 * c01 * dg0)
+            dalpha = (-(d00 * c10 + c00 * d10) * b0 + (d01 * c10 + c01 * d10 + d11 * c00 + c11 * d00) * a0 -
+                      (d01 * c11 + c01 * d11) * g0 - c00 * c10 * db0 + (c01 * c10 + c11 * c00) * da0 -
+                      c01 * c11 * dg0)
+            x, y = c00 * b0 - c01 * a0, c01
+            dx = d00 * b0 + c00 * db0 - d01 * a0 - c01 * da0
+            values["beta_"].append(dbeta)
+            values["alpha_"].append(dalpha)
+            values["gamma_"].append((2 * alpha * dalpha * beta - (1 + alpha * alpha) * dbeta) / beta ** 2)
+            values["D"].append(d00 * d0 + d01 * dp0 + d02 + c00 * dd0 + c01 * ddp0)
+            values["Dp"].append(d10 * d0 + d11 * dp0 + d12 + c10 * dd0 + c11 * ddp0)
+            values["mu"].append(dmu0 + (x * d01 - y * dx) / (x * x + y * y))
+        for key, d in values.items():
+            derivs["D" + plane + "p" if key == "Dp" else key + plane] = np.vstack(d)
+    return tws, derivs
+
+
+def _constraint_rows(lat, constr, weights=weights_default):
+    """
+    Constraints of match() as the list of the residual rows
+    (index in TwissTable, key, target, operation, weight, index of the reference point)
+    """
+    positions = {}
+    for i, elem in enumerate(lat.sequence):
+        positions.setdefault(elem, []).append(i + 1)
+
+    rows = []
+    for e, c in constr.items():
+        if e in ("periodic", "global"):
+            continue
+        for k, v in c.items():
+            for i in positions.get(e, []):
+                if v.__class__ == list:
+                    if v[0] == "->":
+                        ref = [j for j in positions.get(v[1], []) if j <= i]
+                        if not ref:
+                            raise ValueError("match: constraint error: rval should precede lval in lattice")
+                        dv = float(v[2]) if len(v) > 2 else 0.
+                        rows.append((i, k, dv, "->", 1., ref[-1]))
+                    else:
+                        rows.append((i, k, v[1], v[0], weights(k), None))
+                else:
+                    rows.append((i, k, v, "=", weights(k), None))
+    for k, v in constr.get("global", {}).items():
+        if v.__class__ == list:
+            rows.extend((i, k, v[1], v[0], weights(k), None) for i in range(1, len(lat.sequence) + 1))
+    return rows
+
+
+def _constraint_residuals(rows, tws, derivs=None, nvars=0):
+    """
+    Weighted residuals of the constraint rows (see _constraint_rows()) and their Jacobian if derivs is given
+
+    :param rows: list of the constraint rows
+    :param tws: TwissTable
+    :param derivs: None or dict of the derivatives, see twiss_sensitivities()
+    :param nvars: number of the variables
+    :return: r, J
+    """
+    jacobian = derivs is not None
+    r = np.zeros(len(rows))
+    J = np.zeros((len(rows), nvars)) if jacobian else None
+    for n, (i, k, v, op, w, ref) in enumerate(rows):
+        val = getattr(tws, k)[i]
+        dval = derivs[k][i] if jacobian and k in derivs else 0.
+        if op == "->":
+            val = val - getattr(tws, k)[ref]
+            dval = dval - derivs[k][ref] if jacobian and k in derivs else 0.
+        elif op in ("a<", "a>"):
+            dval = np.sign(val) * dval
+            val = abs(val)
+        if op in ("<", "a<") and val <= v or op in (">", "a>") and val >= v:
+            continue
+        r[n] = np.sqrt(w) * (val - v)
+        if jacobian:
+            J[n] = np.sqrt(w) * dval
+    return r, J
+
+
+def _get_vars(vars, tw, vary_bend_angle=False):
+    """
+    Current values of the variables of match()
+    """
+    x = np.zeros(len(vars))
+    for i, var in enumerate(vars):
+        if var.__class__ == list:
+            x[i] = tw.__dict__[var[1]]
+            continue
+        elem = var[0] if var.__class__ == tuple else var
+        if elem.__class__ == Drift:
+            x[i] = elem.l
+        elif elem.__class__ == Solenoid:
+            x[i] = elem.k
+        elif elem.__class__ in [RBend, SBend, Bend] and vary_bend_angle and var.__class__ != tuple:
+            x[i] = elem.angle
+        else:
+            x[i] = elem.k1
+    return x
+
+
+def _set_vars(vars, x, tw, vary_bend_angle=False):
+    """
+    Sets the values of the variables of match() to the elements
+
+    :return: copy of tw with the varied initial twiss parameters or None if a drift gets negative length
+    """
+    tw_loc = Twiss(tw)
+    for i, var in enumerate(vars):
+        if var.__class__ == list:
+            tw_loc.__dict__[var[1]] = x[i]
+            continue
+        for elem in (var if var.__class__ == tuple else (var,)):
+            if elem.__class__ == Drift:
+                if x[i] < 0:
+                    return None
+                elem.l = x[i]
+            elif elem.__class__ == Solenoid:
+                elem.k = x[i]
+            elif elem.__class__ in [RBend, SBend, Bend] and vary_bend_angle and var.__class__ != tuple:
+                elem.angle = x[i]
+            else:
+                elem.k1 = x[i]
+    tw_loc.gamma_x = (1. + tw_loc.alpha_x ** 2) / tw_loc.beta_x
+    tw_loc.gamma_y = (1. + tw_loc.alpha_y ** 2) / tw_loc.beta_y
+    return tw_loc
+
+
+def match_lm(lat, constr, vars, tw, verbose=True, max_iter=100, weights=weights_default, vary_bend_angle=False,
+             tol=1.e-14):
+    """
+    Matching of the twiss parameters with the Levenberg-Marquardt method. The Jacobian of the constrained
+    quantities is calculated analytically (see twiss_sensitivities()), the matching usually converges in tens
+    of twiss calculations. The constraints and variables have the same format as in match(), the weights are
+    applied to the squared residuals, the initial twiss parameters which are varied start from the values in tw.
+    The constraints "total_len" and the minimization of I5 are not supported.
+
+    :param lat: MagneticLattice
+    :param constr: dict of the constraints, see match()
+    :param vars: list of the variables, see match()
+    :param tw: initial Twiss
+    :param verbose: allow print output of minimization procedure
+    :param max_iter: maximum number of the iterations
+    :param weights: function returns weights, see match()
+    :param vary_bend_angle: False, allow to vary "angle" of the dipoles instead of the focusing strength "k1"
+    :param tol: relative tolerance of the sum of the squared residuals
+    :return: result
+    """
+    if "total_len" in constr:
+        raise ValueError("match_lm: constraint 'total_len' is not supported, use method='simplex'")
+    periodic = constr.get("periodic", False) == True
+    rows = _constraint_rows(lat, constr, weights)
+
+    def residuals(x, jacobian):
+        tw_loc = _set_vars(vars, x, tw, vary_bend_angle)
+        if tw_loc is None:
+            return None, None
+        if jacobian:
+            tws, derivs = twiss_sensitivities(lat, tw_loc, vars, vary_bend_angle=vary_bend_angle, periodic=periodic)
+        else:
+            derivs = None
+            if periodic:
+                tw_loc = periodic_twiss(tw_loc, lat.cached_transfer_map(tw.E)[0])
+            tws = None if tw_loc is None else lat.cached_twiss(tw_loc)
+        if tws is None:
+            return None, None
+        return _constraint_residuals(rows, tws, derivs, len(vars))
+
+    x = _get_vars(vars, tw, vary_bend_angle)
+    if verbose:
+        print("initial value: x = ", x)
+
+    r, J = residuals(x, True)
+    if r is None:
+        raise ValueError("match_lm: twiss parameters can not be calculated for the initial values of the variables")
+    cost = np.dot(r, r)
+    lam = 1.e-3
+    nfev = 1
+    for it in range(max_iter):
+        if cost == 0:
+            break
+        A = np.dot(J.T, J)
+        g = np.dot(J.T, r)
+        scale = np.diag(A).copy()
+        scale[scale == 0] = 1.
+        while lam < 1.e16:
+            step = -np.linalg.lstsq(A + lam * np.diag(scale), g, rcond=None)[0]
+            r_new, _ = residuals(x + step, False)
+            nfev += 1
+            if r_new is not None and np.dot(r_new, r_new) < cost:
+                break
+            lam *= 10.
+        else:
+            break
+        x = x + step
+        cost_new = np.dot(r_new, r_new)
+        lam = max(lam / 10., 1.e-12)
+        if verbose:
+            print("iteration error:", cost_new)
+        converged = cost - cost_new <= tol * cost
+        cost = cost_new
+        r, J = residuals(x, True)
+        if converged:
+            break
+    residuals(x, False)
+    _logger.debug(" match_lm: " + str(nfev) + " twiss calculations, error = " + str(cost))
+
+    for i, var in enumerate(vars):
+        if var.__class__ == list:
+            tw.__dict__[var[1]] = x[i]
+    return x
+
+
+def _match_cost(lat, constr, vars, tw, x, weights=weights_default, vary_bend_angle=False, min_i5=False):
+    """
+    Common measure of the matching result to compare the solutions of the different starts of match_multistart():
+    the weighted sum of the squared residuals of the constraints (see _constraint_rows()) for the variables x.
+    The variables are set to the elements.
+
+    :return: cost, np.inf if the twiss parameters can not be calculated
+    """
+    tw_loc = _set_vars(vars, x, tw, vary_bend_angle)
+    if tw_loc is None:
+        return np.inf
+    if constr.get("periodic", False) == True:
+        tw_loc = periodic_twiss(tw_loc, lat.cached_transfer_map(tw.E)[0])
+    tws = None if tw_loc is None else lat.cached_twiss(tw_loc)
+    if tws is None:
+        return np.inf
+    r, _ = _constraint_residuals(_constraint_rows(lat, constr, weights), tws)
+    cost = np.dot(r, r)
+    if "total_len" in constr:
+        cost += weights('total_len') * (tws.s[-1] - constr["total_len"]) ** 2
+    if min_i5:
+        I1, I2, I3, I4, I5 = radiation_integrals(lat, tw_loc, nsuperperiod=1)
+        cost += I5 * weights('i5')
+    return cost if np.isfinite(cost) else np.inf
+
+
+def _match_start(lat, constr, vars, tw, x0, method='simplex', max_iter=1000, weights=weights_default,
+                 vary_bend_angle=False, min_i5=False):
+    """
+    One start of match_multistart(): match() from the initial values x0 of the variables
+
+    :return: cost, res
+    """
+    tw_loc = _set_vars(vars, x0, tw, vary_bend_angle)
+    if tw_loc is None:
+        return np.inf, x0
+    for i, var in enumerate(vars):
+        if var.__class__ == list:
+            tw.__dict__[var[1]] = x0[i]
+    try:
+        res = np.array(match(lat, constr, vars, tw, verbose=False, max_iter=max_iter, method=method,
+                             weights=weights, vary_bend_angle=vary_bend_angle, min_i5=min_i5), dtype=float)
+    except ValueError as e:
+        _logger.debug(" match_multistart: start " + str(x0) + " failed: " + str(e))
+        return np.inf, x0
+    return _match_cost(lat, constr, vars, tw, res, weights, vary_bend_angle, min_i5), res
+
+
+_multistart_worker = {}
+
+
+def _multistart_init(sequence, method, constr, vars, tw, kwargs):
+    """
+    initializer of the worker process of match_multistart(). The lattice is built once per worker.
+    """
+    _multistart_worker.update(lat=MagneticLattice(sequence, method=method), constr=constr, vars=vars, tw=tw,
+                              kwargs=kwargs)
+
+
+def _multistart_run(n, x0):
+    w = _multistart_worker
+    return (n,) + _match_start(w["lat"], w["constr"], w["vars"], w["tw"], x0, **w["kwargs"])
+
+
+def _replace_elements(obj, copies):
+    """
+    copy of the constraints or variables of match() with the elements replaced by their copies
+    """
+    if isinstance(obj, dict):
+        return {_replace_elements(k, copies): _replace_elements(v, copies) for k, v in obj.items()}
+    if obj.__class__ in (list, tuple):
+        return obj.__class__(_replace_elements(v, copies) for v in obj)
+    return copies.get(id(obj), obj)
+
+
+def latin_hypercube(n, bounds, seed=None):
+    """
+    Latin hypercube sampling: every variable is split in n intervals of equal width, every interval is sampled once.
+
+    :param n: number of the samples
+    :param bounds: array (nvars, 2) of the lower and upper bounds
+    :param seed: seed of the random generator
+    :return: array (n, nvars)
+    """
+    rng = np.random.RandomState(seed)
+    bounds = np.asarray(bounds, dtype=float).reshape(-1, 2)
+    u = (np.argsort(rng.rand(n, len(bounds)), axis=0) + rng.rand(n, len(bounds))) / n
+    return bounds[:, 0] + u * (bounds[:, 1] - bounds[:, 0])
+
+
+def match_multistart(lat, constr, vars, tw, n_starts=8, workers=None, bounds=None, spread=0.5, seed=None,
+                     method='lm', max_iter=100, weights=weights_default, vary_bend_angle=False, min_i5=False):
+    """
+    Global matching: match() is started from n_starts initial points in the local process pool and the best
+    solution is taken. The first start is the current values of the variables, the others are sampled by
+    the Latin hypercube (see latin_hypercube()) within the bounds. The lattice is shipped once per worker,
+    the results are collected as they complete, the starts are compared by the weighted sum of the squared
+    residuals of the constraints. The best solution is set to the elements of the lattice (and to tw if
+    the initial twiss parameters are varied).
+    On the platforms where the processes are spawned the call must be protected by if __name__ == "__main__".
+
+    :param lat: MagneticLattice
+    :param constr: dict of the constraints, see match()
+    :param vars: list of the variables, see match()
+    :param tw: initial Twiss
+    :param n_starts: number of the starts
+    :param workers: number of the worker processes, None - number of CPUs
+    :param bounds: None or array (nvars, 2) of the lower and upper bounds of the sampled initial values.
+                If None the bounds are x0 -/+ spread * max(|x0|, 1), the lengths of the drifts and
+                the beta functions stay positive.
+    :param spread: relative width of the default bounds
+    :param seed: seed of the random generator
+    :param method: method of match(), 'lm' by default
+    :param max_iter: maximum number of the iterations of every start
+    :param weights: function returns weights, see match()
+    :param vary_bend_angle: False, allow to vary "angle" of the dipoles instead of the focusing strength "k1"
+    :param min_i5: minimization of the radiation integral I5, see match()
+    :return: result of the best start
+    """
+    workers = multiprocessing.cpu_count() if workers is None else workers
+    x0 = _get_vars(vars, tw, vary_bend_angle)
+    if bounds is None:
+        width = spread * np.maximum(np.abs(x0), 1.)
+        bounds = np.column_stack((x0 - width, x0 + width))
+        for i, var in enumerate(vars):
+            if var.__class__ == list and var[1] in ("beta_x", "beta_y"):
+                bounds[i, 0] = max(bounds[i, 0], x0[i] / (1. + spread))
+            elif var.__class__ != list and all(elem.__class__ == Drift
+                                               for elem in (var if var.__class__ == tuple else (var,))):
+                bounds[i, 0] = max(bounds[i, 0], 0.)
+    starts = [x0] + list(latin_hypercube(n_starts - 1, bounds, seed=seed)) if n_starts > 1 else [x0]
+
+    # transfer maps are not picklable, they are created again in the workers
+    copies = {}
+    for elem in lat.sequence:
+        if id(elem) not in copies:
+            copies[id(elem)] = copy.copy(elem)
+            copies[id(elem)].__dict__.pop("transfer_map", None)
+    sequence = [copies[id(elem)] for elem in lat.sequence]
+    kwargs = {"method": method, "max_iter": max_iter, "vary_bend_angle": vary_bend_angle, "min_i5": min_i5}
+    if weights is not weights_default:
+        kwargs["weights"] = weights
+    initargs = (sequence, lat.method, _replace_elements(constr, copies), _replace_elements(vars, copies),
+                Twiss(tw), kwargs)
+
+    start = time()
+    results = []
+    with ProcessPoolExecutor(max_workers=workers, initializer=_multistart_init, initargs=initargs) as executor:
+        futures = [executor.submit(_multistart_run, n, x) for n, x in enumerate(starts)]
+        for future in as_completed(futures):
+            n, cost, res = future.result()
+            _logger.debug(" match_multistart: start " + str(n) + ", error = " + str(cost))
+            results.append((cost, n, res))
+    cost, n, res = min(results, key=lambda r: (r[0], r[1]))
+    _logger.debug(" match_multistart: time = " + str(time() - start) + " sec, best start = " + str(n))
+    n_invalid = sum(1 for r in results if not np.isfinite(r[0]))
+    if n_invalid:
+        _logger.info(" match_multistart: " + str(n_invalid) + " of " + str(len(results)) +
+                     " starts are discarded (invalid initial values or failed matching)")
+    if not np.isfinite(cost):
+        raise ValueError("match_multistart: no start converged to a valid solution")
+
+    _set_vars(vars, res, tw, vary_bend_angle)
+    for i, var in enumerate(vars):
+        if var.__class__ == list:
+            tw.__dict__[var[1]] = res[i]
+    lat.update_modified_maps()
+    return res
+
+
 def weights_default(val):
     if val == 'periodic': return 1
     if val == 'total_len': return 1
@@ -561,30 +1131,75 @@ def match_tunes(lat, tw0, quads, nu_x, nu_y, ncells=1, print_proc=0):
     return lat
 
 
-def closed_orbit(lattice, eps_xy=1.e-7, eps_angle=1.e-7, energy=0):
+def closed_orbit(lattice, eps_xy=1.e-7, eps_angle=1.e-7, energy=0, p=0., jacobian="linear", max_iter=20):
     __author__ = 'Sergey Tomin'
 
     """
-    Searching of initial coordinates (p0) by iteration method.
+    Searching of initial coordinates (p0) by Newton iterations on the one-turn map (see closed_orbits()).
     For initial conditions p uses exact solution of equation p = M*p + B
     :param lattice: class MagneticLattice
     :param eps_xy: tolerance on coordinates of beam in the start and end of lattice
     :param eps_angle: tolerance on the angles of beam in the start and end of lattice
+    :param energy: initial energy
+    :param p: momentum deviation of the closed orbit
+    :param jacobian: "linear" - Jacobian from the linear map, "tracking" - from the tracking of 4 shifted particles
+    :param max_iter: maximal number of the iterations
     :return: class Particle
     """
-    R = lattice_transfer_map(lattice, energy)
-    smult = SecondOrderMult()
+    X = closed_orbits(lattice, [p], energy=energy, eps_xy=eps_xy, eps_angle=eps_angle, jacobian=jacobian,
+                      max_iter=max_iter)[0]
+    return Particle(x=X[0], px=X[1], y=X[2], py=X[3], p=p, E=energy)
 
-    ME = np.eye(4) - R[:4, :4]
-    P = np.dot(inv(ME), lattice.B[:4])
-
-    def errf(x):
-        X = np.array([[x[0]], [x[1]], [x[2]], [x[3]], [0], [0]] )
-        smult.numpy_apply(X, R, lattice.T)
-        X += lattice.B
-        err = np.sum([1000*(X[i, 0] - x[i])**2 for i in range(4)])
-        return err
 
-    res = fmin(errf, P, xtol=1e-8, maxiter=2e3, maxfun=2.e3)
+def closed_orbits(lattice, deltas, energy=0., eps_xy=1.e-7, eps_angle=1.e-7, jacobian="linear", max_iter=20,
+                  h=1.e-8):
+    """
+    Closed orbits for many momentum deviations at once. All orbits are tracked together in one ParticleArray
+    through the one-turn map and corrected by the Newton iterations X -= (J - I)^-1 (M(X) - X).
+    The initial guess is the solution of the linear problem X = R*X + B + R[:, 5]*delta.
 
-    return Particle(x=res[0], px=res[1], y=res[2], py=res[3])
\ No newline at end of file
+    :param lattice: class MagneticLattice
+    :param deltas: momentum deviations of the closed orbits
+    :param energy: initial energy
+    :param eps_xy: tolerance on coordinates of beam in the start and end of lattice
+    :param eps_angle: tolerance on the angles of beam in the start and end of lattice
+    :param jacobian: "linear" - Jacobian is R of the linear map, "tracking" - Jacobian of every orbit from
+                    the tracking of 4 particles shifted by h in x, px, y and py (quadratic convergence)
+    :param max_iter: maximal number of the iterations
+    :param h: step of the finite differences for jacobian="tracking"
+    :return: array (len(deltas), 6) of the coordinates of the closed orbits at the start of the lattice
+    """
+    deltas = np.atleast_1d(np.asarray(deltas, dtype=float))
+    n = len(deltas)
+    t_maps = get_map(lattice, lattice.totalLen, Navigator(lattice))
+    R, B, _ = lattice.map_tree(energy, order=1).transfer_map()
+    M = np.eye(4) - R[:4, :4]
+    X = np.zeros((6, n))
+    X[5] = deltas
+    X[:4] = np.linalg.solve(M, B[:4] + R[:4, 5:6]*deltas)
+
+    eps = np.array([[eps_xy], [eps_angle], [eps_xy], [eps_angle]])
+    npart = 5 if jacobian == "tracking" else 1
+    for i in range(max_iter):
+        # reference orbits, then the orbits shifted in x, px, y and py
+        p_array = ParticleArray(n*npart)
+        p_array.E = energy
+        p_array.rparticles[:] = np.tile(X, npart)
+        for j in range(1, npart):
+            p_array.rparticles[j - 1, j*n:(j + 1)*n] += h
+        for tm in t_maps:
+            tm.apply(p_array)
+        Y = p_array.rparticles
+        F = Y[:4, :n] - X[:4]
+        if np.all(np.abs(F) < eps):
+            break
+        if npart == 1:
+            X[:4] += np.linalg.solve(M, F)
+        else:
+            J = (Y[:4, n:].reshape(4, 4, n) - Y[:4, np.newaxis, :n])/h
+            A = (np.eye(4)[:, :, np.newaxis] - J).transpose(2, 0, 1)
+            X[:4] += np.linalg.solve(A, F.T[:, :, np.newaxis])[:, :, 0].T
+    else:
+        _logger.warning(" closed_orbits: Newton iterations did not converge, max residual = "
+                        + str(np.max(np.abs(F))))
+    return X.T
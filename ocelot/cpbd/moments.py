@@ -0,0 +1,268 @@
+"""
+Propagation of the first and second moments of the beam (the 6x6 sigma matrix) through the lattice,
+the fast alternative to the particle tracking for the envelope estimates in matching and scans.
+The moments are propagated with the R matrices of the elements and, for order=2, with the T matrices,
+the third and fourth moments are taken as for the Gaussian distribution. The collective effects (LSC, Wake)
+are linearized for the Gaussian bunch: the mean energy loss, the energy chirp and the uncorrelated rest.
+"""
+import logging
+
+import numpy as np
+
+from ocelot.common.globals import m_e_GeV, speed_of_light
+from ocelot.cpbd.beam import Twiss
+from ocelot.cpbd.optics import SecondTM, CavityTM, get_map, sym_matrix, transfer_map_rotation
+from ocelot.cpbd.sc import LSC
+from ocelot.cpbd.wake3D import Wake
+
+_logger = logging.getLogger(__name__)
+
+
+class BeamMoments:
+    """
+    First and second moments of the beam
+
+    mean - array (6,) of the mean coordinates (x, px, y, py, tau, p)
+    sigma - array (6, 6), sigma matrix (covariance of the coordinates)
+    E - reference energy [GeV]
+    q - charge of the bunch [C]
+    s - position [m]
+    """
+    def __init__(self, mean=None, sigma=None, E=0., q=0., s=0.):
+        self.mean = np.zeros(6) if mean is None else np.array(mean, dtype=float)
+        self.sigma = np.zeros((6, 6)) if sigma is None else np.array(sigma, dtype=float)
+        self.E = E
+        self.q = q
+        self.s = s
+
+    def twiss(self):
+        """
+        Twiss parameters of the moments in the same format as get_envelope()
+
+        :return: Twiss
+        """
+        m = self.mean
+        S = self.sigma
+        tws = Twiss()
+        tws.x, tws.px, tws.y, tws.py, tws.tau, tws.p = m
+        tws.xx = S[0, 0]
+        tws.xpx = S[0, 1]
+        tws.pxpx = S[1, 1]
+        tws.yy = S[2, 2]
+        tws.ypy = S[2, 3]
+        tws.pypy = S[3, 3]
+        tws.tautau = S[4, 4]
+        tws.xy = S[0, 2]
+        tws.E = self.E
+        tws.s = self.s
+        tws.emit_x = np.sqrt(tws.xx * tws.pxpx - tws.xpx ** 2)
+        tws.emit_y = np.sqrt(tws.yy * tws.pypy - tws.ypy ** 2)
+        tws.beta_x = tws.xx / tws.emit_x
+        tws.beta_y = tws.yy / tws.emit_y
+        tws.alpha_x = -tws.xpx / tws.emit_x
+        tws.alpha_y = -tws.ypy / tws.emit_y
+        return tws
+
+    def propagate(self, R, B=None, S=None):
+        """
+        Applies the map X -> R X + B + sum_jk S[:, j, k] X_j X_k to the moments.
+
+        :param R: array (6, 6)
+        :param B: None or array (6,) or (6, 1)
+        :param S: None or array (6, 6, 6), second order matrix in the symmetric form (see sym_matrix())
+        :return: self
+        """
+        mean = np.dot(R, self.mean)
+        if B is not None:
+            mean += np.ravel(B)
+        J = R
+        extra = 0.
+        if S is not None:
+            mean += np.einsum("ijk,jk->i", S, self.sigma + np.outer(self.mean, self.mean))
+            J = R + 2. * np.einsum("ijk,k->ij", S, self.mean)
+            # Gaussian closure: cov(X S_i X, X S_l X) = 2 tr(S_i sigma S_l sigma)
+            SS = np.einsum("ijk,kl->ijl", S, self.sigma)
+            extra = 2. * np.einsum("ijk,lkj->il", SS, SS)
+        self.sigma = np.dot(np.dot(J, self.sigma), J.T) + extra
+        self.mean = mean
+        return self
+
+    def energy_kick(self, tau, dp):
+        """
+        Linearized longitudinal kick dp(tau) of the collective process for the Gaussian bunch: the mean,
+        the slope (energy chirp) and the rest which increases the uncorrelated energy spread.
+
+        :param tau: array of the equally spaced tau
+        :param dp: array of the kicks of p at tau
+        :return: loss, chirp - the mean kick and the slope dp/dtau
+        """
+        mu = self.mean[4]
+        sig2 = self.sigma[4, 4]
+        rho = np.exp(-(tau - mu) ** 2 / (2. * sig2))
+        rho /= np.sum(rho)
+        loss = np.sum(rho * dp)
+        chirp = np.sum(rho * dp * (tau - mu)) / sig2
+        spread = max(np.sum(rho * (dp - loss) ** 2) - chirp ** 2 * sig2, 0.)
+        M = np.eye(6)
+        M[5, 4] = chirp
+        self.propagate(M, [0., 0., 0., 0., 0., loss - chirp * mu])
+        self.sigma[5, 5] += spread
+        return loss, chirp
+
+
+def get_moments(p_array):
+    """
+    Moments of the ParticleArray
+
+    :param p_array: ParticleArray
+    :return: BeamMoments
+    """
+    X = p_array.rparticles
+    mean = np.mean(X, axis=1)
+    dX = X - mean[:, np.newaxis]
+    sigma = np.dot(dX, dX.T) / X.shape[1]
+    return BeamMoments(mean, sigma, E=p_array.E, q=np.sum(p_array.q_array), s=p_array.s)
+
+
+def moments_from_twiss(tws, sigma_tau=0., sigma_p=0., q=0.):
+    """
+    Moments of the beam with the Twiss parameters, the dispersion is included
+
+    :param tws: Twiss
+    :param sigma_tau: rms bunch length [m]
+    :param sigma_p: rms energy spread
+    :param q: charge of the bunch [C]
+    :return: BeamMoments
+    """
+    sigma = np.zeros((6, 6))
+    for i, (emit, beta, alpha) in enumerate([(tws.emit_x, tws.beta_x, tws.alpha_x),
+                                             (tws.emit_y, tws.beta_y, tws.alpha_y)]):
+        sigma[2*i:2*i + 2, 2*i:2*i + 2] = emit * np.array([[beta, -alpha], [-alpha, (1. + alpha ** 2) / beta]])
+    sigma[4, 4] = sigma_tau ** 2
+    D = np.array([tws.Dx, tws.Dxp, tws.Dy, tws.Dyp, 0., 1.])
+    sigma += sigma_p ** 2 * np.outer(D, D)
+    mean = [tws.x, tws.xp, tws.y, tws.yp, tws.tau, tws.p]
+    return BeamMoments(mean, sigma, E=tws.E, q=q, s=tws.s)
+
+
+def map_moments(tm, moments, order=1):
+    """
+    Applies the transfer map to the moments. For order=2 the second order matrices of SecondTM and
+    the longitudinal second order terms of CavityTM are taken into account.
+
+    :param tm: TransferMap
+    :param moments: BeamMoments
+    :param order: 1 or 2
+    :return: moments
+    """
+    E = moments.E
+    S = None
+    if order > 1:
+        if tm.__class__ == SecondTM:
+            T = transfer_map_rotation(tm.r_z_no_tilt(tm.length, E), tm.t_mat_z_e(tm.length, E), tm.tilt)[1]
+            S = sym_matrix(np.copy(T))
+        elif tm.__class__ == CavityTM:
+            # the sliced cavity maps keep the voltage of the whole cavity (see CavityTM.__call__()),
+            # the voltage of the slice is taken from its energy gain
+            cos_phi = np.cos(tm.phi * np.pi / 180.)
+            V = tm.delta_e / cos_phi if cos_phi != 0 else tm.v
+            S = tm.long_t_matrix(E, V, tm.freq, tm.phi, tm.length)
+    moments.propagate(tm.R(E), tm.B(E), S)
+    moments.E = E + tm.delta_e
+    return moments
+
+
+def lsc_kick(proc, moments, dz, npoints=512):
+    """
+    Longitudinal kick of LSC for the Gaussian bunch with the moments, see LSC.apply()
+
+    :param proc: LSC
+    :param moments: BeamMoments
+    :param dz: step
+    :param npoints: number of the points of the grid
+    :return: tau, dp
+    """
+    S = moments.sigma
+    sig_tau = np.sqrt(S[4, 4])
+    tau = moments.mean[4] + np.linspace(-5. * sig_tau, 5. * sig_tau, npoints)
+    # transverse rms size of the slice
+    sigma = (np.sqrt(S[0, 0] - S[0, 4] ** 2 / S[4, 4]) + np.sqrt(S[2, 2] - S[2, 4] ** 2 / S[4, 4])) / 2.
+    gamma = moments.E / m_e_GeV
+    beta = np.sqrt(1. - 1. / gamma ** 2)
+    bunch = beta * np.exp(-(tau - moments.mean[4]) ** 2 / (2. * S[4, 4])) / (np.sqrt(2. * np.pi) * sig_tau)
+    W = - proc.wake_lsc(tau, bunch, gamma, sigma, dz) * moments.q
+    pc_ref = np.sqrt(moments.E ** 2 / m_e_GeV ** 2 - 1) * m_e_GeV
+    return tau, W * 1e-9 / pc_ref
+
+
+def wake_kick(proc, moments, dz, npoints=512):
+    """
+    Longitudinal kick of the monopole wake for the Gaussian bunch with the moments, see Wake.apply()
+
+    :param proc: Wake
+    :param moments: BeamMoments
+    :param dz: step
+    :param npoints: number of the points of the grid
+    :return: tau, dp
+    """
+    T, H = proc.TH
+    sig_tau = np.sqrt(moments.sigma[4, 4])
+    tau = moments.mean[4] + np.linspace(-5. * sig_tau, 5. * sig_tau, npoints)
+    I = np.zeros((npoints, 2))
+    I[:, 0] = tau
+    I[:, 1] = moments.q * speed_of_light * np.exp(-(tau - moments.mean[4]) ** 2 / (2. * sig_tau ** 2)) / (
+              np.sqrt(2. * np.pi) * sig_tau)
+    x, Wz = proc.add_wake(I, T[int(H[0, 0])])
+    L = proc.s_stop - proc.s_start
+    dz = 1. if L == 0 else dz / L
+    return tau, np.interp(tau, x, Wz, 0, 0) * dz * proc.factor / (moments.E * 1e9)
+
+
+def apply_moments_proc(proc, moments, dz):
+    """
+    Applies the linearized physics process to the moments. LSC and Wake are supported, other processes
+    are skipped.
+
+    :param proc: PhysProc
+    :param moments: BeamMoments
+    :param dz: step
+    :return: None or (loss, chirp), see BeamMoments.energy_kick()
+    """
+    if moments.q == 0 or moments.sigma[4, 4] <= 0:
+        return None
+    if isinstance(proc, LSC):
+        if dz < 1e-10:
+            return None
+        tau, dp = lsc_kick(proc, moments, dz)
+    elif isinstance(proc, Wake):
+        tau, dp = wake_kick(proc, moments, dz)
+    else:
+        _logger.debug(" apply_moments_proc: " + proc.__class__.__name__ + " is skipped")
+        return None
+    return moments.energy_kick(tau, dp)
+
+
+def track_moments(lattice, moments, navi, order=1):
+    """
+    Propagation of the beam moments through the lattice, the counterpart of track().
+    The physics processes of the navigator are applied with the steps of track(), LSC and Wake are linearized
+    for the Gaussian bunch, the other processes are skipped.
+
+    :param lattice: MagneticLattice
+    :param moments: BeamMoments, changed in place
+    :param navi: Navigator
+    :param order: 1 - linear maps, 2 - the second order maps are included
+    :return: twiss_list, moments
+    """
+    tws_track = [moments.twiss()]
+    while np.abs(navi.z0 - lattice.totalLen) > 1e-10:
+        dz, proc_list, phys_steps = navi.get_next()
+        if navi.z0 + dz > lattice.totalLen:
+            dz = lattice.totalLen - navi.z0
+        for tm in get_map(lattice, dz, navi):
+            map_moments(tm, moments, order)
+        for p, z_step in zip(proc_list, phys_steps):
+            apply_moments_proc(p, moments, z_step)
+        moments.s += dz
+        tws_track.append(moments.twiss())
+    return tws_track, moments
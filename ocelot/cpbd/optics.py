@@ -2,10 +2,11 @@ __author__ = 'Sergey'
 
 from numpy.linalg import inv
 from math import factorial
-from ocelot.cpbd.beam import Particle, Twiss, ParticleArray
+from ocelot.cpbd.beam import Particle, Twiss, ParticleArray, TwissTable
 from ocelot.cpbd.high_order import *
 from ocelot.cpbd.r_matrix import *
 from copy import deepcopy
+from collections import OrderedDict
 import logging
 import numpy as np
 
@@ -21,9 +22,11 @@ except:
 try:
     import numba as nb
     nb_flag = True
+    prange = nb.prange
 except:
     _logger.debug(" optics.py: module NUMBA is not installed. Install it to speed up calculation")
     nb_flag = False
+    prange = range
 
 
 
@@ -158,7 +161,25 @@ def transfer_maps_mult_py(Ra, Ta, Rb, Tb):
     return Rc, Tc
 
 
-transfer_maps_mult = transfer_maps_mult_py if nb_flag is not True else nb.jit(transfer_maps_mult_py)
+def transfer_maps_mult_np(Ra, Ta, Rb, Tb=None):
+    """
+    The same composition as transfer_maps_mult_py() with batched numpy operations:
+    Tc[i] = sum_l Rb[i, l] * Ta[l] + Ra^T * Tb[i] * Ra
+
+    :param Ra: 6x6 matrix of the first map
+    :param Ta: 6x6x6 matrix of the first map
+    :param Rb: 6x6 matrix of the second map
+    :param Tb: 6x6x6 matrix of the second map, None for the linear map (the second term is skipped)
+    :return: Rc, Tc
+    """
+    Rc = np.dot(Rb, Ra)
+    Tc = np.tensordot(Rb, Ta, axes=1)
+    if Tb is not None:
+        Tc += np.matmul(np.matmul(Ra.T, Tb), Ra)
+    return Rc, Tc
+
+
+transfer_maps_mult = transfer_maps_mult_np if nb_flag is not True else nb.jit(transfer_maps_mult_py)
 
 
 def transfer_map_rotation(R, T, tilt):
@@ -168,6 +189,91 @@ def transfer_map_rotation(R, T, tilt):
     return R, T
 
 
+class TransferMapCache:
+    """
+    Bounded LRU cache of the transfer matrices (R, T) of the elements.
+    The key is (element fingerprint, kind of matrix, z, energy), the element fingerprint includes all element
+    parameters at the moment of the transfer map creation. As soon as an element attribute is changed
+    the transfer map of the element bypasses the cache until the map is recreated
+    (e.g. by MagneticLattice.update_transfer_maps()), thus outdated matrices are never used.
+
+    Cached matrices are read-only, make a copy if modification is needed.
+    """
+    def __init__(self, maxsize=20000):
+        """
+        :param maxsize: maximum number of the stored matrices
+        """
+        self.maxsize = maxsize
+        self.enabled = True
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+
+    def __len__(self):
+        return len(self._data)
+
+    def clear(self):
+        self._data.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, func, z, energy):
+        """
+        :param key: hashable key of the element and kind of the matrix
+        :param func: function(z, energy) which calculates the matrix
+        :param z: position within element
+        :param energy: beam energy
+        :return: matrix
+        """
+        try:
+            full_key = (key, z, energy)
+            mat = self._data.pop(full_key)
+        except KeyError:
+            self.misses += 1
+            mat = func(z, energy)
+            if isinstance(mat, np.ndarray):
+                mat.flags.writeable = False
+            self._data[full_key] = mat
+            if len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+            return mat
+        except TypeError:
+            # unhashable z or energy (e.g. arrays)
+            return func(z, energy)
+        self.hits += 1
+        self._data[full_key] = mat
+        return mat
+
+    def wrap(self, element, kind, func):
+        """
+        Wrap function(z, energy) of the element transfer map with the cache.
+
+        :param element: Element
+        :param kind: name of the matrix, e.g. "R_z"
+        :param func: function(z, energy)
+        :return: function(z, energy)
+        """
+        if not hasattr(element, "fingerprint"):
+            return func
+        params = element.fingerprint()
+        key = (params, kind)
+
+        def cached_func(z, energy):
+            current = element.__dict__.get("_fingerprint")
+            if current is not params:
+                if current is None and element.fingerprint() == params:
+                    element.__dict__["_fingerprint"] = params
+                else:
+                    return func(z, energy)
+            if not self.enabled:
+                return func(z, energy)
+            return self.get(key, func, z, energy)
+        return cached_func
+
+
+tm_cache = TransferMapCache()
+
+
 class TransferMap:
     def __init__(self):
         self.dx = 0.
@@ -189,6 +295,7 @@ class TransferMap:
         M = self.R(E)
         zero_tol = 1.e-10
         if abs(self.delta_e) > zero_tol:
+            M = np.copy(M)
             Ei = tws0.E
             Ef = tws0.E + self.delta_e
             k = np.sqrt(Ef / Ei)
@@ -289,7 +396,11 @@ class TransferMap:
         :return: None
         """
         if prcl_series.__class__ == ParticleArray:
-            self.map(prcl_series.rparticles, energy=prcl_series.E)
+            if prcl_series.E_array is None:
+                self.map(prcl_series.rparticles, energy=prcl_series.E)
+            else:
+                self.apply_energy_buckets(prcl_series)
+                prcl_series.E_array += self.delta_e
             prcl_series.E += self.delta_e
             prcl_series.s += self.length
 
@@ -301,26 +412,33 @@ class TransferMap:
 
         elif prcl_series.__class__ == list and prcl_series[0].__class__ == Particle:
             # If the energy is not the same (p.E) for all Particles in the list of Particles
-            # in that case cycle is applied. For particles with the same energy p.E
-            list_e = np.array([p.E for p in prcl_series])
-            if False in (list_e[:] == list_e[0]):
-                for p in prcl_series:
-                    self.map(np.array([[p.x], [p.px], [p.y], [p.py], [p.tau], [p.p]]), energy=p.E)
-                    p.E += self.delta_e
-                    p.s += self.length
-            else:
-                pa = ParticleArray()
-                pa.list2array(prcl_series)
-                pa.E = prcl_series[0].E
-                self.map(pa.rparticles, energy=pa.E)
-                pa.E += self.delta_e
-                pa.s += self.length
-                pa.array2ex_list(prcl_series)
+            # the particles are grouped by the energy (see ParticleArray.energy_buckets())
+            pa = ParticleArray()
+            pa.list2array(prcl_series)
+            self.apply(pa)
+            pa.array2ex_list(prcl_series)
 
         else:
             _logger.error(" TransferMap.apply(): Unknown type of Particle_series: " + str(prcl_series.__class__.__name))
             raise Exception(" TransferMap.apply(): Unknown type of Particle_series: " + str(prcl_series.__class__.__name))
 
+    def apply_energy_buckets(self, p_array):
+        """
+        Applies the map to the particles with the different reference energies (ParticleArray.E_array).
+        The map is evaluated once for every energy bucket, the matrices of the bucket are reused
+        from tm_cache, the particles of the bucket are tracked together.
+
+        :param p_array: ParticleArray
+        :return: None
+        """
+        for energy, inds in p_array.energy_buckets():
+            if isinstance(inds, slice):
+                self.map(p_array.rparticles, energy=energy)
+            else:
+                X = p_array.rparticles[:, inds]
+                self.map(X, energy=energy)
+                p_array.rparticles[:, inds] = X
+
     def __call__(self, s):
         m = copy(self)
         m.length = s
@@ -458,6 +576,7 @@ class CavityTM(TransferMap):
             igamma2 = 1. / (g0 * g0)
             beta0 = np.sqrt(1. - igamma2)
 
+        T = self.long_t_matrix(E, V, freq, phi, z)
         phi = phi * np.pi / 180.
         if self.coupler_kick:
             X[1] += (self.vx_up * V * np.exp(1j * phi)).real * 1e-6 / E
@@ -469,9 +588,6 @@ class CavityTM(TransferMap):
         if self.coupler_kick:
             X[1] += (self.vx_down * V * np.exp(1j * phi)).real * 1e-6 / (E + delta_e)
             X[3] += (self.vy_down * V * np.exp(1j * phi)).real * 1e-6 / (E + delta_e)
-        T566 = 1.5 * z*igamma2/(beta0**3)
-        T556 = 0.
-        T555 = 0.
         if E + delta_e > 0:
             k = 2. * np.pi * freq / speed_of_light
             E1 = E + delta_e
@@ -480,15 +596,30 @@ class CavityTM(TransferMap):
 
             X[5] = X5 * E*beta0/(E1*beta1) + V*beta0 / (E1*beta1) * (np.cos(-X4*beta0 * k + phi) - np.cos(phi))
 
-            dgamma = V / m_e_GeV
-            if delta_e > 0:
-                T566 = z * (beta0**3*g0**3 - beta1**3*g1**3)/(2*beta0*beta1**3*g0*(g0 - g1)*g1**3)
-                T556 = beta0 * k * z * dgamma *g0 * (beta1**3*g1**3 + beta0 * (g0 - g1**3)) * np.sin(phi)/ (beta1**3 * g1**3 * (g0 - g1)**2)
-                T555 = beta0**2 * k**2 * z * dgamma/2.*(dgamma*(2*g0*g1**3*(beta0*beta1**3 - 1) + g0**2 + 3*g1**2 - 2)/(beta1**3*g1**3*(g0 - g1)**3)*np.sin(phi)**2 -
-                                                    (g1*g0*(beta1*beta0 - 1) + 1)/(beta1*g1*(g0 - g1)**2)*np.cos(phi))
-        X[4] += T566 * X5*X5 + T556*X4*X5 + T555 * X4*X4
+        X[4] += T[4, 5, 5] * X5*X5 + 2 * T[4, 4, 5]*X4*X5 + T[4, 4, 4] * X4*X4
         return X
 
+    def long_t_matrix(self, E, V, freq, phi, z=0):
+        """
+        Second order longitudinal terms of the cavity map in the symmetric form, T[4, 5, 5] = T566,
+        T[4, 4, 5] = T[4, 5, 4] = T556/2, T[4, 4, 4] = T555 and T[5, 4, 4] - curvature of the RF
+        (map4cav() uses the exact cosine for the energy).
+
+        :param E: initial energy [GeV]
+        :param V: voltage [GeV]
+        :param freq: frequency [Hz]
+        :param phi: phase [deg]
+        :param z: length
+        :return: array (6, 6, 6)
+        """
+        T566, T556, T555, T655 = cavity_long_coefficients(E, V, freq, phi, z)[4:]
+        T = np.zeros((6, 6, 6))
+        T[4, 5, 5] = T566
+        T[4, 4, 5] = T[4, 5, 4] = T556 / 2.
+        T[4, 4, 4] = T555
+        T[5, 4, 4] = T655
+        return T
+
     def __call__(self, s):
         m = copy(self)
         m.length = s
@@ -760,6 +891,8 @@ class MethodTM:
             self.global_method = TransferMap
         self.sec_order_mult = SecondOrderMult()
         self.nkick = self.params['nkick'] if 'nkick' in self.params else 1
+        # runs of linear maps, kicks and multipoles are tracked with one kernel (see KickKernelTM)
+        self.kick_kernel = self.params['kick_kernel'] if 'kick_kernel' in self.params else False
 
     def create_tm(self, element):
 
@@ -767,9 +900,14 @@ class MethodTM:
             transfer_map = self.set_tm(element, self.params[element.__class__])
         else:
             transfer_map = self.set_tm(element, self.global_method)
+        # element parameters at the moment of the map creation, see MagneticLattice.update_modified_maps()
+        transfer_map.element_fingerprint = element.__dict__.get("_fingerprint")
         return transfer_map
 
     def set_tm(self, element, method):
+        if hasattr(element, "fingerprint"):
+            # array attributes can be changed in place, so the fingerprint is always recalculated here
+            element.fingerprint(update=True)
         dx = element.dx
         dy = element.dy
         tilt = element.dtilt + element.tilt
@@ -801,7 +939,8 @@ class MethodTM:
                 T_z_e = lambda z, energy: T
             if element.__class__ == XYQuadrupole:
                 T = np.zeros((6, 6, 6))
-            tm = SecondTM(r_z_no_tilt=r_z_e, t_mat_z_e=T_z_e)
+            tm = SecondTM(r_z_no_tilt=tm_cache.wrap(element, "r_z_no_tilt", r_z_e),
+                          t_mat_z_e=tm_cache.wrap(element, "t_mat_z_e", T_z_e))
             tm.multiplication = self.sec_order_mult.tmat_multip
 
         elif method == TWCavityTM:
@@ -857,19 +996,24 @@ class MethodTM:
         if element.__class__ == Hcor:
             tm = CorrectorTM(angle_x=element.angle, angle_y=0.)
             tm.multiplication = self.sec_order_mult.tmat_multip
-            tm.t_mat_z_e = lambda z, energy: t_nnn(z, 0, 0, 0, energy)
+            tm.t_mat_z_e = tm_cache.wrap(element, "t_mat_z_e", lambda z, energy: t_nnn(z, 0, 0, 0, energy))
 
         if element.__class__ == Vcor:
             tm = CorrectorTM(angle_x=0, angle_y=element.angle)
             tm.multiplication = self.sec_order_mult.tmat_multip
-            tm.t_mat_z_e = lambda z, energy: t_nnn(z, 0, 0, 0, energy)
+            tm.t_mat_z_e = tm_cache.wrap(element, "t_mat_z_e", lambda z, energy: t_nnn(z, 0, 0, 0, energy))
 
         tm.length = element.l
         tm.dx = dx
         tm.dy = dy
         tm.tilt = tilt
-        tm.R_z = lambda z, energy: np.dot(np.dot(rot_mtx(-tilt), r_z_e(z, energy)), rot_mtx(tilt))
+        tm.R_z = tm_cache.wrap(element, "R_z",
+                               lambda z, energy: np.matmul(np.matmul(rot_mtx(-tilt), r_z_e(z, energy)), rot_mtx(tilt)))
         tm.R = lambda energy: tm.R_z(element.l, energy)
+        if tm.__class__ == SecondTM:
+            t_tilt = tm_cache.wrap(element, "T_tilt", lambda z, energy: transfer_map_rotation(
+                tm.r_z_no_tilt(z, energy), tm.t_mat_z_e(z, energy), tilt)[1])
+            tm.T_tilt = lambda energy: t_tilt(tm.length, energy)
         # tm.B_z = lambda z, energy: dot((eye(6) - tm.R_z(z, energy)), array([dx, 0., dy, 0., 0., 0.]))
         # tm.B = lambda energy: tm.B_z(element.l, energy)
 
@@ -877,47 +1021,49 @@ class MethodTM:
 
 
 def sym_matrix(T):
-    for i in range(6):
-        for j in range(6):
-            for k in range(j, 6):
-                if j != k:
-                    a = T[i, j, k] / 2.
-                    T[i, k, j] = a
-                    T[i, j, k] = a
+    """
+    Symmetric form of the 6x6x6 matrix in the upper triangular form: T[i, j, k] = T[i, k, j] = T[i, j, k]/2, j < k.
+    The lower triangular part of T is ignored. T is changed in place.
+    """
+    U = np.triu(T)
+    T[:] = 0.5 * (U + np.transpose(U, (0, 2, 1)))
     return T
 
 
 def unsym_matrix(T):
-    for i in range(6):
-        for j in range(6):
-            for k in range(j, 6):
-                if j != k:
-                    a = T[i, j, k] * 2.
-                    T[i, k, j] = 0
-                    T[i, j, k] = a
+    """
+    Inverse of sym_matrix(): upper triangular form of the symmetric 6x6x6 matrix. T is changed in place.
+    """
+    T[:] = np.triu(T) + np.triu(T, 1)
     return T
 
 
 def lattice_transfer_map(lattice, energy):
     """
     transfer map for the whole lattice
+
+    The second order matrices are composed only at SecondTM elements, runs of the linear elements between them
+    are composed into one matrix first (zero second order matrices are skipped).
     """
     Ra = np.eye(6)
     Ta = np.zeros((6, 6, 6))
     Ba = np.zeros((6, 1))
+    R_run = np.eye(6)
     E = energy
     for i, elem in enumerate(lattice.sequence):
         Rb = elem.transfer_map.R(E)
         Bb = elem.transfer_map.B(E)
         if elem.transfer_map.__class__ == SecondTM:
-            Tb = np.copy(elem.transfer_map.T_tilt(E))
-            Tb = sym_matrix(Tb)
-            Ra, Ta = transfer_maps_mult(Ra, Ta, Rb, Tb)
+            Tb = sym_matrix(np.copy(elem.transfer_map.T_tilt(E)))
+            Ta = transfer_maps_mult_np(Ra, Ta, np.dot(Rb, R_run), Tb)[1]
+            Ra = np.dot(Rb, Ra)
+            R_run = np.eye(6)
         else:
-
-            Ra, Ta = transfer_maps_mult(Ra, Ta, Rb, Tb=np.zeros((6,6,6)))
+            Ra = np.dot(Rb, Ra)
+            R_run = np.dot(Rb, R_run)
         Ba = np.dot(Rb, Ba) + Bb
         E += elem.transfer_map.delta_e
+    Ta = np.tensordot(R_run, Ta, axes=1)
 
     lattice.T_sym = Ta
     lattice.T = unsym_matrix(deepcopy(Ta))
@@ -926,12 +1072,578 @@ def lattice_transfer_map(lattice, energy):
     return Ra
 
 
+class TransferMapTree:
+    """
+    Segment tree of the composed transfer maps over lattice.sequence.
+    Every node of the tree keeps the composed map (R, B and T for order=2) of a continuous part of the lattice.
+    After a change of one element the lattice map is updated with O(log N) compositions and
+    the map between any two elements is composed from O(log N) nodes.
+
+    usage:
+        tree = TransferMapTree(lat, energy=0., order=2)
+        R, B, T = tree.transfer_map()  # map of the whole lattice
+        quad.k1 = 1.1
+        tree.update()
+        R, B, T = tree.transfer_map(start=10, stop=20)  # map of lat.sequence[10:20]
+    """
+    def __init__(self, lattice, energy=0., order=1):
+        """
+        :param lattice: MagneticLattice
+        :param energy: initial energy
+        :param order: 1 - R matrices and B vectors, 2 - R, B and T matrices
+        """
+        self.lattice = lattice
+        self.energy = energy
+        self.order = order
+        self.build()
+
+    def _set_leaf(self, i):
+        tm = self.lattice.sequence[i].transfer_map
+        p = i + self.size
+        E = self.E[i]
+        self.R[p] = tm.R(E)
+        self.B[p] = tm.B(E)
+        if self.order == 2:
+            if tm.__class__ == SecondTM:
+                self.T[p] = sym_matrix(np.copy(tm.T_tilt(E)))
+            else:
+                self.T[p] = 0.
+
+    def _combine(self, p):
+        left, right = 2 * p, 2 * p + 1
+        self.R[p] = np.dot(self.R[right], self.R[left])
+        self.B[p] = np.dot(self.R[right], self.B[left]) + self.B[right]
+        if self.order == 2:
+            self.T[p] = transfer_maps_mult(self.R[left], self.T[left], self.R[right], self.T[right])[1]
+
+    def _energies(self):
+        delta_e = [element.transfer_map.delta_e for element in self.lattice.sequence]
+        return self.energy + np.append(0., np.cumsum(delta_e))
+
+    def build(self):
+        """
+        Build the tree from scratch
+        """
+        n = len(self.lattice.sequence)
+        size = 1
+        while size < n:
+            size *= 2
+        self.size = size
+        self.R = np.tile(np.eye(6), (2 * size, 1, 1))
+        self.B = np.zeros((2 * size, 6, 1))
+        self.T = np.zeros((2 * size, 6, 6, 6)) if self.order == 2 else None
+        self.E = self._energies()
+        for i in range(n):
+            self._set_leaf(i)
+        for p in range(size - 1, 0, -1):
+            self._combine(p)
+        self.maps = [element.transfer_map for element in self.lattice.sequence]
+
+    def update(self):
+        """
+        Update the tree after a change of the elements. Transfer maps of the elements with changed parameters are
+        recreated (see MagneticLattice.update_modified_maps()).
+
+        :return: list of indices of the updated elements
+        """
+        lat = self.lattice
+        lat.update_modified_maps()
+        if len(self.maps) != len(lat.sequence):
+            self.build()
+            return list(range(len(lat.sequence)))
+        changed = lat.changed_maps(self.maps)
+        if not changed:
+            return changed
+        E = self._energies()
+        if np.any(E != self.E):
+            # energy gain was changed, all downstream elements are updated
+            changed = sorted(set(changed) | set(np.where(E[:-1] != self.E[:-1])[0]))
+            self.E = E
+        nodes = set()
+        for i in changed:
+            self._set_leaf(i)
+            self.maps[i] = lat.sequence[i].transfer_map
+            nodes.add((i + self.size) // 2)
+        while nodes:
+            for p in sorted(nodes):
+                self._combine(p)
+            nodes = {p // 2 for p in nodes if p > 1}
+        return changed
+
+    def transfer_map(self, start=0, stop=None):
+        """
+        Composed map of the elements lattice.sequence[start:stop]. The tree is not updated automatically,
+        call update() after changes of the lattice.
+
+        :param start: index of the first element
+        :param stop: index after the last element, if None the end of the lattice
+        :return: R, B, T - 6x6 matrix, 6x1 vector and 6x6x6 matrix (zeros if order=1) in the same
+                 format as lattice.R, lattice.B and lattice.T after lattice_transfer_map()
+        """
+        n = len(self.lattice.sequence)
+        stop = n if stop is None else stop
+        lo, hi = start + self.size, stop + self.size
+        left, right = [], []
+        while lo < hi:
+            if lo & 1:
+                left.append(lo)
+                lo += 1
+            if hi & 1:
+                hi -= 1
+                right.append(hi)
+            lo //= 2
+            hi //= 2
+        R = np.eye(6)
+        B = np.zeros((6, 1))
+        T = np.zeros((6, 6, 6))
+        for p in left + right[::-1]:
+            if self.order == 2:
+                T = transfer_maps_mult(R, T, self.R[p], self.T[p])[1]
+            B = np.dot(self.R[p], B) + self.B[p]
+            R = np.dot(self.R[p], R)
+        return R, B, unsym_matrix(T)
+
+
+class FusedTM(TransferMap):
+    """
+    Transfer map of a run of elements composed into one R, B (and T for order=2) for a fixed initial energy.
+    If the energy of the particles differs from the energy of the composition the maps of the elements
+    are applied one by one.
+    Composition of the second order maps is truncated at the second order, the difference with
+    element by element tracking is of the third order in the particle amplitudes.
+    """
+    def __init__(self, t_maps, energy, order=1):
+        """
+        :param t_maps: list of transfer maps, TransferMap or, for order=2, SecondTM without offsets
+        :param energy: initial energy
+        :param order: 1 - linear maps, 2 - second order maps
+        """
+        TransferMap.__init__(self)
+        self.t_maps = t_maps
+        self.energy = energy
+        self.order = order
+        self.length = sum([tm.length for tm in t_maps])
+        self.delta_e = sum([tm.delta_e for tm in t_maps])
+
+        R = np.eye(6)
+        B = np.zeros((6, 1))
+        T = np.zeros((6, 6, 6))
+        E = energy
+        for tm in t_maps:
+            Rb = tm.R(E)
+            if order == 2 and tm.__class__ == SecondTM:
+                # T_tilt of a tilted element is not in the upper triangular form, see sym_matrix()
+                Tb = tm.T_tilt(E)
+                T = transfer_maps_mult(R, T, Rb, 0.5 * (Tb + np.transpose(Tb, (0, 2, 1))))[1]
+            elif order == 2:
+                T = transfer_maps_mult(R, T, Rb, np.zeros((6, 6, 6)))[1]
+            B = np.dot(Rb, B) + tm.B(E)
+            R = np.dot(Rb, R)
+            E += tm.delta_e
+        self.r_mat = R
+        self.b_vec = B
+        self.t_mat = T if order == 2 else None
+        self.R = lambda energy: self.r_mat
+        self.B = lambda energy: self.b_vec
+        self.map = lambda X, energy: self.fused_map(X, energy)
+
+    def fused_map(self, X, energy):
+        if abs(energy - self.energy) > 1e-10:
+            for tm in self.t_maps:
+                tm.map(X, energy)
+                energy += tm.delta_e
+            return X
+        Xr = np.dot(self.r_mat, X) + self.b_vec
+        if self.t_mat is not None:
+            Xr += np.einsum("ijk,jn,kn->in", self.t_mat, X, X, optimize=True)
+        X[:] = Xr[:]
+        return X
+
+    def __call__(self, s):
+        _logger.error(" FusedTM.__call__: composed map can not be sliced")
+        raise Exception(" FusedTM.__call__: composed map can not be sliced")
+
+
+def kick_kernel_py(X, ops, r_mat, b_vec, kicks, kn):
+    """
+    Applies a run of the linear maps, thin kicks and multipoles to the particles (see KickKernelTM).
+    Particles are in the outer loop and the elements in the inner loop, with NUMBA the loop over the particles
+    is parallel and the coordinates of a particle are kept in a local array for the whole run.
+
+    :param X: array (6, N) of the particles coordinates, changed in place
+    :param ops: array (M, 2), [kind, index], kind: 0 - linear map r_mat[index], b_vec[index],
+                1 - kick with parameters kicks[index], 2 - multipole with coefficients kn[index]
+    :param r_mat: array (K, 6, 6)
+    :param b_vec: array (K, 6)
+    :param kicks: array (L, 12), [dl, angle, k1*dl, k2*dl, k3*dl, nkick, dx, dy, cos(tilt), sin(tilt), coef, shifted]
+    :param kn: array (P, n), kn[index, j] = kn_j/j!
+    :return: X
+    """
+    npart = X.shape[1]
+    for ip in prange(npart):
+        v = np.empty(6)
+        w = np.empty(6)
+        for i in range(6):
+            v[i] = X[i, ip]
+        for k in range(ops.shape[0]):
+            m = ops[k, 1]
+            if ops[k, 0] == 0:
+                for i in range(6):
+                    w[i] = b_vec[m, i]
+                    for j in range(6):
+                        w[i] += r_mat[m, i, j] * v[j]
+                for i in range(6):
+                    v[i] = w[i]
+            elif ops[k, 0] == 1:
+                dl, angle, k1, k2, k3 = kicks[m, 0], kicks[m, 1], kicks[m, 2], kicks[m, 3], kicks[m, 4]
+                dx, dy, cs, sn, coef = kicks[m, 6], kicks[m, 7], kicks[m, 8], kicks[m, 9], kicks[m, 10]
+                shifted = kicks[m, 11] != 0.
+                if shifted:
+                    x = v[0] - dx
+                    y = v[2] - dy
+                    v[0], v[2] = cs * x + sn * y, -sn * x + cs * y
+                    v[1], v[3] = cs * v[1] + sn * v[3], -sn * v[1] + cs * v[3]
+                for n in range(int(kicks[m, 5])):
+                    x = v[0] + v[1] * dl - dx
+                    y = v[2] + v[3] * dl - dy
+                    tau = -v[5] * dl * coef
+                    v[1] -= -angle * v[5] + k1 * x + k2 * (x * x - y * y) + k3 * (x * x * x - 3. * x * y * y)
+                    v[3] += k1 * y + 2. * k2 * x * y + k3 * (3. * x * x * y - y * y * y)
+                    v[4] = tau - angle * v[0]
+                    v[0] = x + v[1] * dl + dx
+                    v[2] = y + v[3] * dl + dy
+                    v[4] -= v[5] * dl * coef
+                if shifted:
+                    x, y = cs * v[0] - sn * v[2], sn * v[0] + cs * v[2]
+                    v[0] = x + dx
+                    v[2] = y + dy
+                    v[1], v[3] = cs * v[1] - sn * v[3], sn * v[1] + cs * v[3]
+            else:
+                re = -kn[m, 0] * v[5]
+                im = 0.
+                zr = 1.
+                zi = 0.
+                for n in range(1, kn.shape[1]):
+                    zr, zi = zr * v[0] - zi * v[2], zr * v[2] + zi * v[0]
+                    re += kn[m, n] * zr
+                    im += kn[m, n] * zi
+                v[1] -= re
+                v[3] += im
+                v[4] -= kn[m, 0] * v[0]
+        for i in range(6):
+            X[i, ip] = v[i]
+    return X
+
+
+def kick_kernel_np(X, ops, r_mat, b_vec, kicks, kn):
+    """
+    The same as kick_kernel_py() but the particles are in the inner (vectorized) loop, used without NUMBA
+    """
+    for kind, m in ops:
+        if kind == 0:
+            X[:] = np.dot(r_mat[m], X) + b_vec[m][:, np.newaxis]
+        elif kind == 1:
+            dl, angle, k1, k2, k3, nkick, dx, dy, cs, sn, coef, shifted = kicks[m]
+            if shifted:
+                x = X[0] - dx
+                y = X[2] - dy
+                X[0], X[2] = cs * x + sn * y, -sn * x + cs * y
+                X[1], X[3] = cs * X[1] + sn * X[3], -sn * X[1] + cs * X[3]
+            for n in range(int(nkick)):
+                x = X[0] + X[1] * dl - dx
+                y = X[2] + X[3] * dl - dy
+                tau = -X[5] * dl * coef
+                X[1] -= -angle * X[5] + k1 * x + k2 * (x * x - y * y) + k3 * (x * x * x - 3. * x * y * y)
+                X[3] += k1 * y + 2. * k2 * x * y + k3 * (3. * x * x * y - y * y * y)
+                X[4] = tau - angle * X[0]
+                X[0] = x + X[1] * dl + dx
+                X[2] = y + X[3] * dl + dy
+                X[4] -= X[5] * dl * coef
+            if shifted:
+                x, y = cs * X[0] - sn * X[2], sn * X[0] + cs * X[2]
+                X[0] = x + dx
+                X[2] = y + dy
+                X[1], X[3] = cs * X[1] - sn * X[3], sn * X[1] + cs * X[3]
+        else:
+            re = -kn[m, 0] * X[5]
+            im = np.zeros(X.shape[1])
+            zr = np.ones(X.shape[1])
+            zi = np.zeros(X.shape[1])
+            for n in range(1, kn.shape[1]):
+                zr, zi = zr * X[0] - zi * X[2], zr * X[2] + zi * X[0]
+                re += kn[m, n] * zr
+                im += kn[m, n] * zi
+            X[1] -= re
+            X[3] += im
+            X[4] -= kn[m, 0] * X[0]
+    return X
+
+
+kick_kernel = kick_kernel_np if not nb_flag else nb.njit(parallel=True)(kick_kernel_py)
+
+
+class KickKernelTM(TransferMap):
+    """
+    Transfer map of a run of linear maps (TransferMap), thin kicks (KickTM) and multipoles (MultipoleTM)
+    applied in one pass by kick_kernel(). Consecutive linear maps are composed into one matrix.
+    The run is compiled into the arrays of the kernel once for every energy.
+    """
+    def __init__(self, t_maps):
+        """
+        :param t_maps: list of TransferMap, KickTM and MultipoleTM
+        """
+        TransferMap.__init__(self)
+        self.t_maps = t_maps
+        self.length = sum([tm.length for tm in t_maps])
+        self.delta_e = sum([tm.delta_e for tm in t_maps])
+        self.programs = {}
+        self.R = lambda energy: self.linear_map(energy)[0]
+        self.B = lambda energy: self.linear_map(energy)[1]
+        self.map = lambda X, energy: kick_kernel(X, *self.program(energy))
+
+    def linear_map(self, energy):
+        R = np.eye(6)
+        B = np.zeros((6, 1))
+        for tm in self.t_maps:
+            Rb = tm.R(energy)
+            B = np.dot(Rb, B) + tm.B(energy)
+            R = np.dot(Rb, R)
+            energy += tm.delta_e
+        return R, B
+
+    def program(self, energy):
+        """
+        :param energy: initial energy
+        :return: ops, r_mat, b_vec, kicks, kn - arrays of kick_kernel()
+        """
+        if energy in self.programs:
+            return self.programs[energy]
+        ops, r_mat, b_vec, kicks, kn = [], [], [], [], []
+        E = energy
+        for tm in self.t_maps:
+            if tm.__class__ == KickTM:
+                gamma = E / m_e_GeV
+                coef = 0.
+                if gamma != 0:
+                    gamma2 = gamma * gamma
+                    beta = 1. - 0.5 / gamma2
+                    coef = 1. / (beta * beta * gamma2)
+                dl = tm.length / tm.nkick / 2.
+                shifted = tm.dx != 0 or tm.dy != 0 or tm.tilt != 0
+                ops.append((1, len(kicks)))
+                kicks.append([dl, tm.angle / tm.nkick, tm.k1 * dl, tm.k2 * dl, tm.k3 * dl, tm.nkick, tm.dx, tm.dy,
+                              np.cos(tm.tilt), np.sin(tm.tilt), coef, shifted])
+            elif tm.__class__ == MultipoleTM:
+                ops.append((2, len(kn)))
+                kn.append([k / factorial(n) for n, k in enumerate(tm.kn)])
+            elif len(ops) > 0 and ops[-1][0] == 0:
+                Rb = tm.R(E)
+                r_mat[-1] = np.dot(Rb, r_mat[-1])
+                b_vec[-1] = np.dot(Rb, b_vec[-1]) + tm.B(E)[:, 0]
+            else:
+                ops.append((0, len(r_mat)))
+                r_mat.append(np.array(tm.R(E), dtype=float))
+                b_vec.append(np.array(tm.B(E), dtype=float)[:, 0])
+            E += tm.delta_e
+
+        nkn = max([len(k) for k in kn] + [1])
+        kn_arr = np.zeros((max(len(kn), 1), nkn))
+        for i, k in enumerate(kn):
+            kn_arr[i, :len(k)] = k
+        program = (np.array(ops, dtype=np.int64).reshape(-1, 2), np.array(r_mat).reshape(-1, 6, 6),
+                   np.array(b_vec).reshape(-1, 6), np.array(kicks, dtype=float).reshape(-1, 12), kn_arr)
+        if len(self.programs) > 7:
+            self.programs.clear()
+        self.programs[energy] = program
+        return program
+
+    def __call__(self, s):
+        _logger.error(" KickKernelTM.__call__: composed map can not be sliced")
+        raise Exception(" KickKernelTM.__call__: composed map can not be sliced")
+
+
+class TrackingPlan:
+    """
+    Flat execution plan of the lattice for tracking (see MagneticLattice.compile()).
+    Runs of the linear elements (TransferMap) are fused into one map R, B and, for order=2, runs of the
+    second order elements (SecondTM without offsets) into one composed map R, T (see FusedTM).
+    If the lattice method has the option 'kick_kernel' (MethodTM({..., 'kick_kernel': True})) runs of the linear
+    maps, kicks and multipoles are applied by one kernel instead (see KickKernelTM).
+    Other maps (cavities, etc) are applied as is.
+
+    usage:
+        plan = lat.compile(energy=E, order=2)
+        navi = Navigator(lat)
+        tracking_step(lat, p_array, lat.totalLen, navi)  # tracking_step and track_nturns use lat.plan
+    """
+    def __init__(self, lattice, energy=0., order=2):
+        """
+        :param lattice: MagneticLattice
+        :param energy: initial energy
+        :param order: 1 - fuse only linear maps, 2 - fuse linear and second order maps
+        """
+        self.lattice = lattice
+        self.energy = energy
+        self.order = order
+        self.kernel = getattr(lattice.method, "kick_kernel", False)
+        self.maps = None
+        self.E = None
+        self.steps = {}  # {index of the first element of the run: (index after the last element, FusedTM)}
+        self.update()
+
+    def _kind(self, tm):
+        """
+        :return: 0 - map is not fused, 1 - linear map, 2 - second order map, 3 - map of the kick kernel
+        """
+        if self.kernel and tm.__class__ in (TransferMap, KickTM, MultipoleTM):
+            return 3
+        if tm.__class__ == TransferMap:
+            return 1
+        if self.order == 2 and tm.__class__ == SecondTM and tm.dx == 0 and tm.dy == 0:
+            return 2
+        return 0
+
+    def _runs(self, maps):
+        runs = []
+        start = 0
+        second_order, offsets, kernel = False, False, False
+        for i, tm in enumerate(maps + [None]):
+            kind = 0 if tm is None else self._kind(tm)
+            shifted = kind == 1 and (tm.dx != 0 or tm.dy != 0)
+            if (kind == 0 or (kind == 2 and offsets) or (shifted and second_order) or
+                    (i > start and kernel != (kind == 3))):
+                if i - start > 1:
+                    runs.append((start, i))
+                start = i if kind != 0 else i + 1
+                second_order, offsets = False, False
+            second_order = second_order or kind == 2
+            offsets = offsets or shifted
+            kernel = kind == 3
+        return runs
+
+    def update(self):
+        """
+        Update the plan after a change of the lattice. Only runs with modified elements are composed again.
+
+        :return: True if the plan was changed
+        """
+        lat = self.lattice
+        lat.update_modified_maps()
+        delta_e = [element.transfer_map.delta_e for element in lat.sequence]
+        E = self.energy + np.append(0., np.cumsum(delta_e))
+        changed = lat.changed_maps(self.maps)
+        if not changed and np.array_equal(E, self.E):
+            return False
+        maps = [element.transfer_map for element in lat.sequence]
+        changed = set(changed)
+        steps = {}
+        for start, stop in self._runs(maps):
+            step = self.steps.get(start)
+            if (step is not None and step[0] == stop and not any(i in changed for i in range(start, stop)) and
+                    E[start] == self.E[start]):
+                steps[start] = step
+            elif self._kind(maps[start]) == 3:
+                steps[start] = (stop, KickKernelTM(maps[start:stop]))
+            else:
+                steps[start] = (stop, FusedTM(maps[start:stop], E[start], order=self.order))
+        self.steps = steps
+        self.maps = maps
+        self.E = E
+        return True
+
+
+def element_r_z(tm, z, energy):
+    """
+    Linear matrices of the element at positions z within the element in one vectorized call.
+    Falls back to a loop over z if the transfer map does not support array arguments.
+
+    :param tm: TransferMap of the element
+    :param z: array (M) of positions within the element
+    :param energy: beam energy at the element entrance
+    :return: array (M, 6, 6)
+    """
+    z = np.asarray(z, dtype=float)
+    if tm.__class__ != TWCavityTM:
+        R = tm.R_z(z, energy)
+        if np.shape(R) == (len(z), 6, 6):
+            return R
+    return np.array([tm.R_z(zi, energy) for zi in z])
+
+
+def twiss_z(tm, tws0, z):
+    """
+    Twiss parameters at positions z within an element. The same result as [tm(zi) * tws0 for zi in z],
+    but the matrices are calculated and applied to the entry Twiss in one vectorized pass.
+
+    :param tm: TransferMap of the element
+    :param tws0: Twiss at the element entrance
+    :param z: array (M) of positions within the element
+    :return: TwissTable with M points
+    """
+    z = np.asarray(z, dtype=float)
+    n = len(z)
+    R = np.array(element_r_z(tm, z, tws0.E), dtype=float).reshape(n, 6, 6)
+    delta_e = np.broadcast_to(tm.delta_e_z(z), (n,))
+    E = np.full(n, float(tws0.E))
+    acc = np.abs(delta_e) > 1.e-10
+    if np.any(acc):
+        k = np.sqrt((tws0.E + delta_e[acc]) / tws0.E)[:, np.newaxis, np.newaxis]
+        R[acc, 0:2, 0:2] *= k
+        R[acc, 2:4, 2:4] *= k
+        E[acc] += delta_e[acc]
+
+    table = TwissTable(n)
+    for key in TwissTable.keys:
+        getattr(table, key)[:] = getattr(tws0, key)
+    table.tau[:] = 0.
+    table.E[:] = E
+    table.s[:] = tws0.s + z
+    for i, plane in ((0, "x"), (2, "y")):
+        b0 = getattr(tws0, "beta_" + plane)
+        a0 = getattr(tws0, "alpha_" + plane)
+        g0 = getattr(tws0, "gamma_" + plane)
+        d0 = getattr(tws0, "D" + plane)
+        dp0 = getattr(tws0, "D" + plane + "p")
+        m11, m12, m21, m22 = R[:, i, i], R[:, i, i + 1], R[:, i + 1, i], R[:, i + 1, i + 1]
+        alpha = -m11 * m21 * b0 + (m12 * m21 + m22 * m11) * a0 - m12 * m22 * g0
+        getattr(table, "beta_" + plane)[:] = m11 * m11 * b0 - 2 * m12 * m11 * a0 + m12 * m12 * g0
+        getattr(table, "alpha_" + plane)[:] = alpha
+        getattr(table, "gamma_" + plane)[:] = (1. + alpha * alpha) / getattr(table, "beta_" + plane)
+        getattr(table, "D" + plane)[:] = m11 * d0 + m12 * dp0 + R[:, i, 5]
+        getattr(table, "D" + plane + "p")[:] = m21 * d0 + m22 * dp0 + R[:, i + 1, 5]
+        denom = m11 * b0 - m12 * a0
+        with np.errstate(divide="ignore", invalid="ignore"):
+            d_mu = np.where(denom == 0., np.pi / 2. * np.sign(m12), np.arctan(m12 / denom))
+        d_mu[d_mu < 0] += np.pi
+        getattr(table, "mu" + plane)[:] = getattr(tws0, "mu" + plane) + d_mu
+    return table
+
+
 def trace_z(lattice, obj0, z_array):
     """
     Z-dependent tracer (twiss(z) and particle(z))
     usage: twiss = trace_z(lattice,twiss_0, [1.23, 2.56, ...]) ,
     to calculate Twiss params at 1.23m, 2.56m etc.
+    For Twiss all points within an element are calculated in one vectorized call (see twiss_z()).
     """
+    if obj0.__class__ == Twiss:
+        z_array = np.asarray(z_array, dtype=float)
+        L_ends = np.cumsum([elem.l for elem in lattice.sequence])
+        elem_ids = np.searchsorted(L_ends, z_array, side="left")
+        bounds = np.concatenate(([0], np.flatnonzero(np.diff(elem_ids)) + 1, [len(z_array)]))
+        obj_list = []
+        obj_elem = obj0
+        i = 0
+        for k1, k2 in zip(bounds[:-1], bounds[1:]):
+            if k1 == k2:
+                continue
+            while i < elem_ids[k1]:
+                obj_elem = lattice.sequence[i].transfer_map * obj_elem
+                i += 1
+            elem = lattice.sequence[i]
+            obj_list.extend(twiss_z(elem.transfer_map, obj_elem, z_array[k1:k2] - (L_ends[i] - elem.l)))
+        return obj_list
+
     obj_list = []
     i = 0
     elem = lattice.sequence[i]
@@ -1037,6 +1749,225 @@ def twiss(lattice, tws0=None, nPoints=None):
         return None
 
 
+def lattice_r_matrices(lattice, energy, deltas=None):
+    """
+    Linear transfer matrices of all lattice elements
+
+    :param lattice: MagneticLattice
+    :param energy: beam energy at the lattice start [GeV]
+    :param deltas: None or array (K) of the relative momentum offsets. If not None, the matrices are calculated
+                   for all momentum offsets at once (see create_r_matrix()).
+    :return: (R, E), R - array (N, 6, 6) of the element matrices or (K, N, 6, 6) if deltas is not None,
+             E - array (N + 1) of the beam energies at the element entrances and at the lattice end
+    """
+    n = len(lattice.sequence)
+    E = np.empty(n + 1)
+    E[0] = energy
+    if deltas is None:
+        R = np.empty((n, 6, 6))
+    else:
+        deltas = np.atleast_1d(np.asarray(deltas, dtype=float))
+        R = np.empty((len(deltas), n, 6, 6))
+    for i, elem in enumerate(lattice.sequence):
+        tm = elem.transfer_map
+        if deltas is None:
+            R[i] = tm.R(E[i])
+        elif tm.__class__ == TWCavityTM:
+            R[:, i] = tm.R(E[i])
+        else:
+            tilt = elem.dtilt + elem.tilt
+            r = create_r_matrix(elem, delta=deltas)(elem.l, E[i])
+            R[:, i] = np.matmul(np.matmul(rot_mtx(-tilt), r), rot_mtx(tilt))
+        E[i + 1] = E[i] + tm.delta_e
+    return R, E
+
+
+def cumulative_products(M):
+    """
+    Cumulative products of a stack of square matrices C[i] = M[i] * M[i-1] * ... * M[0].
+    The products are calculated with log2(N) batched multiplications (parallel prefix scan).
+
+    :param M: array (N, n, n) or (K, N, n, n) for K independent stacks
+    :return: array with the same shape as M
+    """
+    C = np.array(M, dtype=float)
+    n = C.shape[-3]
+    step = 1
+    while step < n:
+        C[..., step:, :, :] = np.matmul(C[..., step:, :, :], C[..., :-step, :, :])
+        step *= 2
+    return C
+
+
+def twiss_propagate(tws0, R, E, lengths, ids):
+    """
+    Vectorized propagation of twiss parameters through a sequence of the linear matrices.
+    The function gives the same result as the successive TransferMap.map_x_twiss() calls
+    (as map_x_twiss() it uses only the uncoupled blocks of the matrices).
+
+    :param tws0: initial Twiss or, for R with shape (K, N, 6, 6), list of K initial Twiss
+    :param R: array (N, 6, 6) of the element matrices or (K, N, 6, 6) for K independent sets of the matrices
+              (e.g. for different momentum offsets, see twiss_chromatic())
+    :param E: array (N + 1) of the beam energies, see lattice_r_matrices()
+    :param lengths: array (N) of the element lengths
+    :param ids: list (N) of the element ids
+    :return: TwissTable with N + 1 points, the first point is tws0. For R with shape (K, N, 6, 6) list of K TwissTable
+    """
+    R = np.array(R, dtype=float)
+    if R.ndim == 3:
+        return twiss_propagate([tws0], R[np.newaxis], E, lengths, ids)[0]
+    K, n = R.shape[:2]
+    tws0 = tws0 if isinstance(tws0, (list, tuple)) else [tws0] * K
+    E = np.asarray(E, dtype=float)
+    dE = E[1:] - E[:-1]
+    acc = np.abs(dE) > 1.e-10
+    if np.any(acc):
+        k = np.sqrt(E[1:][acc] / E[:-1][acc])[:, np.newaxis, np.newaxis]
+        R[:, acc, 0:2, 0:2] *= k
+        R[:, acc, 2:4, 2:4] *= k
+    E = np.append(E[0], np.where(acc, E[1:], E[:-1]))
+
+    tables = []
+    for tw0 in tws0:
+        table = TwissTable(n + 1)
+        for key in TwissTable.keys:
+            getattr(table, key)[:] = getattr(tw0, key)
+        table.tau[1:] = 0.
+        table.id = [tw0.id] + list(ids)
+        table.E[1:] = E[1:]
+        table.s[1:] = tw0.s + np.cumsum(lengths)
+        tables.append(table)
+
+    for i, plane in ((0, "x"), (2, "y")):
+        # augmented matrices [[R_ii, R_ii+1, R_i5], [R_i+1i, R_i+1i+1, R_i+15], [0, 0, 1]]
+        M = np.zeros((K, n, 3, 3))
+        M[..., 0:2, 0:2] = R[..., i:i + 2, i:i + 2]
+        M[..., 0:2, 2] = R[..., i:i + 2, 5]
+        M[..., 2, 2] = 1.
+        b0 = np.array([getattr(tw0, "beta_" + plane) for tw0 in tws0])
+        a0 = np.array([getattr(tw0, "alpha_" + plane) for tw0 in tws0])
+        g0 = np.array([getattr(tw0, "gamma_" + plane) for tw0 in tws0])
+        d0 = np.array([getattr(tw0, "D" + plane) for tw0 in tws0])
+        dp0 = np.array([getattr(tw0, "D" + plane + "p") for tw0 in tws0])
+        mu0 = np.array([getattr(tw0, "mu" + plane) for tw0 in tws0])
+        beta = np.zeros((K, n))
+        alpha = np.zeros((K, n))
+        D = np.zeros((K, n))
+        Dp = np.zeros((K, n))
+
+        # map_x_twiss() recalculates gamma after each element, it is equivalent to the matrix product only
+        # for the blocks with unit determinant (uncoupled elements) and consistent initial twiss parameters.
+        # The sequence is split in segments at the other elements.
+        det = M[..., 0, 0] * M[..., 1, 1] - M[..., 0, 1] * M[..., 1, 0]
+        bounds = {0, n}
+        for k in np.where(np.any(np.abs(det - 1.) > 1.e-10, axis=0))[0]:
+            bounds.update((k, k + 1))
+        if np.any(np.abs(b0 * g0 - a0 * a0 - 1.) > 1.e-10):
+            bounds.add(1)
+        bounds = sorted(b for b in bounds if b <= n)
+        for k1, k2 in zip(bounds[:-1], bounds[1:]):
+            if k1 > 0:
+                b0, a0 = beta[:, k1 - 1], alpha[:, k1 - 1]
+                g0 = (1. + a0 * a0) / b0
+                d0, dp0 = D[:, k1 - 1], Dp[:, k1 - 1]
+            C = cumulative_products(M[:, k1:k2])
+            b0_, a0_, g0_ = b0[:, np.newaxis], a0[:, np.newaxis], g0[:, np.newaxis]
+            beta[:, k1:k2] = (C[..., 0, 0] * C[..., 0, 0] * b0_ - 2 * C[..., 0, 1] * C[..., 0, 0] * a0_
+                              + C[..., 0, 1] * C[..., 0, 1] * g0_)
+            alpha[:, k1:k2] = (-C[..., 0, 0] * C[..., 1, 0] * b0_ + (C[..., 0, 1] * C[..., 1, 0] + C[..., 1, 1] * C[..., 0, 0]) * a0_
+                               - C[..., 0, 1] * C[..., 1, 1] * g0_)
+            D[:, k1:k2] = C[..., 0, 0] * d0[:, np.newaxis] + C[..., 0, 1] * dp0[:, np.newaxis] + C[..., 0, 2]
+            Dp[:, k1:k2] = C[..., 1, 0] * d0[:, np.newaxis] + C[..., 1, 1] * dp0[:, np.newaxis] + C[..., 1, 2]
+
+        # phase advance of each element with twiss parameters at the element entrance
+        beta_in = np.concatenate((np.array([getattr(tw0, "beta_" + plane) for tw0 in tws0])[:, np.newaxis],
+                                  beta[:, :-1]), axis=1)
+        alpha_in = np.concatenate((np.array([getattr(tw0, "alpha_" + plane) for tw0 in tws0])[:, np.newaxis],
+                                   alpha[:, :-1]), axis=1)
+        denom = M[..., 0, 0] * beta_in - M[..., 0, 1] * alpha_in
+        with np.errstate(divide="ignore", invalid="ignore"):
+            d_mu = np.where(denom == 0., np.pi / 2. * np.sign(M[..., 0, 1]), np.arctan(M[..., 0, 1] / denom))
+        d_mu[d_mu < 0] += np.pi
+        mu = mu0[:, np.newaxis] + np.cumsum(d_mu, axis=1)
+
+        for j, table in enumerate(tables):
+            getattr(table, "beta_" + plane)[1:] = beta[j]
+            getattr(table, "alpha_" + plane)[1:] = alpha[j]
+            getattr(table, "gamma_" + plane)[1:] = (1. + alpha[j] * alpha[j]) / beta[j]
+            getattr(table, "D" + plane)[1:] = D[j]
+            getattr(table, "D" + plane + "p")[1:] = Dp[j]
+            getattr(table, "mu" + plane)[1:] = mu[j]
+    return tables
+
+
+def twiss_table(lattice, tws0=None, nPoints=None):
+    """
+    Vectorized twiss parameters calculation. All element matrices are stacked in one array and the twiss parameters
+    are propagated with batched numpy operations. Much faster than twiss() for long lattices.
+
+    :param lattice: lattice, MagneticLattice() object
+    :param tws0: initial twiss parameters, Twiss() object. If None, try to find periodic solution.
+    :param nPoints: number of points per cell. If None, then twiss parameters are calculated at the end of each element.
+    :return: TwissTable, can be used as a list of Twiss() objects
+    """
+    if nPoints is not None:
+        tws = twiss(lattice, tws0, nPoints)
+        return TwissTable.from_list(tws) if tws is not None else None
+
+    energy = 0. if tws0 is None else tws0.E
+    R, E = lattice_r_matrices(lattice, energy)
+    if tws0 is None or tws0.beta_x == 0 or tws0.beta_y == 0:
+        R_lat = cumulative_products(R)[-1] if len(R) > 0 else np.eye(6)
+        tws0 = periodic_twiss(tws0, R_lat)
+        if tws0 is None:
+            _logger.warning(' twiss_table: no periodic solution. return None')
+            return None
+    else:
+        tws0.gamma_x = (1. + tws0.alpha_x ** 2) / tws0.beta_x
+        tws0.gamma_y = (1. + tws0.alpha_y ** 2) / tws0.beta_y
+    lengths = [elem.transfer_map.length for elem in lattice.sequence]
+    ids = [elem.id for elem in lattice.sequence]
+    return twiss_propagate(tws0, R, E, lengths, ids)
+
+
+def twiss_chromatic(lattice, tws0=None, deltas=(0.,)):
+    """
+    Vectorized twiss parameters calculation for many relative momentum offsets in one pass.
+    The strengths of the magnets are scaled by 1/(1 + delta) (see create_r_matrix()), the matrices for all
+    momentum offsets are stacked in one array (K, N, 6, 6) and propagated together.
+
+    :param lattice: lattice, MagneticLattice() object
+    :param tws0: initial twiss parameters, Twiss() object. The same initial parameters are used for all deltas.
+                 If None, the periodic solution is found for each delta.
+    :param deltas: array (K) of the relative momentum offsets
+    :return: list of K TwissTable. If the periodic solution does not exist for a delta, the table is None
+    """
+    deltas = np.atleast_1d(np.asarray(deltas, dtype=float))
+    energy = 0. if tws0 is None else tws0.E
+    R, E = lattice_r_matrices(lattice, energy, deltas=deltas)
+    if tws0 is None or tws0.beta_x == 0 or tws0.beta_y == 0:
+        R_lat = cumulative_products(R)[:, -1] if R.shape[1] > 0 else np.tile(np.eye(6), (len(deltas), 1, 1))
+        tws0_list = [periodic_twiss(tws0, r) for r in R_lat]
+    else:
+        tws0.gamma_x = (1. + tws0.alpha_x ** 2) / tws0.beta_x
+        tws0.gamma_y = (1. + tws0.alpha_y ** 2) / tws0.beta_y
+        tws0_list = [tws0] * len(deltas)
+
+    stable = [i for i, tw0 in enumerate(tws0_list) if tw0 is not None]
+    if len(stable) < len(deltas):
+        _logger.warning(' twiss_chromatic: no periodic solution for deltas: ' + str(
+            [deltas[i] for i in range(len(deltas)) if tws0_list[i] is None]))
+    tables = [None] * len(deltas)
+    if len(stable) == 0:
+        return tables
+    lengths = [elem.transfer_map.length for elem in lattice.sequence]
+    ids = [elem.id for elem in lattice.sequence]
+    tws = twiss_propagate([tws0_list[i] for i in stable], R[stable], E, lengths, ids)
+    for i, table in zip(stable, tws):
+        tables[i] = table
+    return tables
+
+
 def twiss_fast(lattice, tws0=None):
     """
     twiss parameters calculation
@@ -1144,12 +2075,26 @@ class Navigator:
         self.unit_step = 1  # unit step for physics processes
         self.proc_kick_elems = []
         self.kill_process = False # for case when calculations are needed to terminated e.g. from gui
+        self.map_cache = TransferMapCache(maxsize=1000)  # sliced transfer maps, see get_sliced_map()
 
     def go_to_start(self):
         self.z0 = 0.  # current position of navigator
         self.n_elem = 0  # current index of the element in lattice
         self.sum_lengths = 0.  # sum_lengths = Sum[lat.sequence[i].l, {i, 0, n_elem-1}]
 
+    def get_sliced_map(self, elem, dl):
+        """
+        Transfer map of the first dl [m] of the element. The sliced maps are kept in the LRU cache (the key is
+        the transfer map of the element and dl), repeated steps of the same length reuse the same objects.
+        The maps do not depend on energy, the matrices for a given energy are cached by tm_cache.
+
+        :param elem: Element
+        :param dl: length of the slice
+        :return: TransferMap
+        """
+        tm = elem.transfer_map
+        return self.map_cache.get(tm, lambda z, energy: tm(z), dl, None)
+
     def get_phys_procs(self):
         """
         method return list of all physics processes which were added
@@ -1166,7 +2111,7 @@ class Navigator:
         phys_steps_red = phys_steps - dz
         if len(processes) != 0:
             nearest_stop_elem = min([proc.indx1 for proc in processes])
-            L_stop = np.sum(np.array([elem.l for elem in self.lat.sequence[:nearest_stop_elem]]))
+            L_stop = self.lat.element_position(nearest_stop_elem)
             if self.z0 + dz > L_stop:
                dz = L_stop - self.z0
 
@@ -1266,7 +2211,7 @@ class Navigator:
             processes = proc_list
             n_elems = len(self.lat.sequence)
             if n_elems >= self.n_elem + 1:
-                L = np.sum(np.array([elem.l for elem in self.lat.sequence[:self.n_elem + 1]]))
+                L = self.lat.element_position(self.n_elem + 1)
             else:
                 L = self.lat.totalLen
             dz = L - self.z0
@@ -1288,7 +2233,18 @@ class Navigator:
         return dz, processes, phys_steps
 
 
-def get_map(lattice, dz, navi):
+def get_map(lattice, dz, navi, plan=None):
+    """
+    Transfer maps for the step dz from the current position of the navigator.
+    The element positions are accumulated from the lattice passed in (the navigator can be created for
+    another lattice, e.g. a list of lattices), in the same order as the steps of the navigator.
+
+    :param lattice: MagneticLattice
+    :param dz: step in [m]
+    :param navi: Navigator
+    :param plan: TrackingPlan or None. If the step covers a whole run of the plan the fused map of the run is used.
+    :return: list of transfer maps
+    """
     nelems = len(lattice.sequence)
     TM = []
     i = navi.n_elem
@@ -1298,8 +2254,27 @@ def get_map(lattice, dz, navi):
     L = navi.sum_lengths + elem.l
     while z1 + 1e-10 > L:
 
+        if plan is not None and i in plan.steps and abs(L - elem.l - navi.z0) < 1e-10:
+            stop, fused_tm = plan.steps[i]
+            L_stop = L
+            for element in lattice.sequence[i + 1:stop]:
+                L_stop += element.l
+            if z1 + 1e-10 > L_stop:
+                TM.append(fused_tm)
+                dz -= L_stop - navi.z0
+                navi.z0 = L_stop
+                i = stop - 1
+                elem = lattice.sequence[i]
+                L = L_stop
+                if i >= nelems - 1:
+                    break
+                i += 1
+                elem = lattice.sequence[i]
+                L += elem.l
+                continue
+
         dl = L - navi.z0
-        TM.append(elem.transfer_map(dl))
+        TM.append(navi.get_sliced_map(elem, dl))
 
         navi.z0 = L
         dz -= dl
@@ -1309,10 +2284,8 @@ def get_map(lattice, dz, navi):
         i += 1
         elem = lattice.sequence[i]
         L += elem.l
-        #if i in navi.proc_kick_elems:
-        #    break
     if abs(dz) > 1e-10:
-        TM.append(elem.transfer_map(dz))
+        TM.append(navi.get_sliced_map(elem, dz))
     navi.z0 += dz
     navi.sum_lengths = L - elem.l
     navi.n_elem = i
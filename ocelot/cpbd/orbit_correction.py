@@ -714,55 +714,21 @@ class Orbit:
         rmatrix.mode = "radian"
         return rmatrix
 
-    def linac_response_matrix_meas(self, tw_init=None):
+    def linac_response_matrix_meas(self, tw_init=None, order=1, tracking=None):
         """
-        calculation of ideal response matrix
+        calculation of ideal response matrix. All columns are calculated in one pass through the lattice,
+        see orbit_response_matrix()
 
         :param lattice: class MagneticLattice
-        :param tw_init: if tw_init == None, function tries to find periodical solution
+        :param tw_init: Twiss, the initial energy is taken from tw_init.E
+        :param order: 1 - the R matrices, 2 - the second order matrices along the reference orbit
+        :param tracking: None - the tracking is used only for the nonlinear elements, True - always, False - never
         :return: orbit.resp
         """
-        #self.optical_func_params(tw_init=tw_init)
         match_ic = False
-        m = len(self.bpms)
-        nx = len(self.hcors)
-        ny = len(self.vcors)
-        #h_resp = zeros((m, nx))
-        #v_resp = zeros((m, ny))
-        add_i = 0
-        if match_ic:
-            add_i = 4
-        self.resp = np.zeros((2 * m, nx + ny + add_i))
-        s = [bpm.s for bpm in self.bpms]
-        X0, Y0 = self.read_virtual_orbit(p_init=Particle( E=tw_init.E))
-        #plt.plot(s, X0,"ro-",  s, Y0,"bo-")
-        #plt.show()
-        Or0 = np.append(X0, Y0)
-        for j, cor in enumerate([item for sublist in [self.hcors, self.vcors] for item in sublist]):
-            print(j,"/", nx+ny, cor.id)
-            cor.angle = 0.0001
-            self.lat.update_transfer_maps()
-            start = time()
-            X1, Y1 = self.read_virtual_orbit(p_init=Particle(E=tw_init.E))
-            print(time() - start)
-
-            Or1 = np.append(X1, Y1)
-            self.resp[:, j] = (Or1 - Or0)/cor.angle
-            cor.angle = 0.00
-        self.lat.update_transfer_maps()
-        if match_ic:
-            for i, par in enumerate(["x", "px", "y", "py"]):
-                print(i)
-                p_i = Particle(E = tw_init.E)
-                p_i.__dict__[par] = 0.0001
-                #p2 = copy.deepcopy(p_i)
-                print ("measure = ", p_i.x, p_i.y, p_i.px, p_i.py, p_i.E)
-                X1, Y1 = self.read_virtual_orbit(p_init=p_i)
-                #plt.plot(s, X1, "ro-", s, Y1, "bo-")
-                #plt.show()
-                Or1 = np.append(X1, Y1)
-                self.resp[:, nx + ny + i] = (Or1 - Or0) /0.0001
-        X1, Y1 = self.read_virtual_orbit(p_init=Particle(E=tw_init.E))
+        cors = [item for sublist in [self.hcors, self.vcors] for item in sublist]
+        self.resp = orbit_response_matrix(self.lat, cors, self.bpms, p_init=Particle(E=tw_init.E), order=order,
+                                          ic=match_ic, tracking=tracking)
         rmatrix = ResponseMatrix()
         rmatrix.bpm_names = [b.id for b in self.bpms]
         rmatrix.cor_names = np.append(np.array([c.id for c in self.hcors]), np.array([c.id for c in self.vcors]))
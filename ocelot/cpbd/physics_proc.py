@@ -19,9 +19,12 @@ class PhysProc:
     :attribute indx1: - number of stop element in lattice.sequence - assigned in navigator.add_physics_proc()
     :attribute s_start: - position of start element in lattice - assigned in navigator.add_physics_proc()
     :attribute s_stop: - position of stop element in lattice.sequence - assigned in navigator.add_physics_proc()
+    :attribute per_bunch: - if True the process is applied to every bunch of the ensemble separately
+                            (see ParticleArray.bunch_ids), otherwise to the whole ParticleArray
     """
     def __init__(self, step=1):
         self.step = step
+        self.per_bunch = True
         self.energy = None
         self.indx0 = None
         self.indx1 = None
@@ -68,6 +71,7 @@ class EmptyProc(PhysProc):
 class SaveBeam(PhysProc):
     def __init__(self, filename):
         PhysProc.__init__(self)
+        self.per_bunch = False
         self.energy = None
         self.filename = filename
 
@@ -250,34 +254,26 @@ class Aperture(PhysProc):
     def apply(self, p_array, dz):
         _logger.debug(" Apperture applied")
         if self.longitudinal:
-            tau = p_array.tau()[:]
-            tau0 = np.mean(tau)
-            tau = tau - tau0
-            sig = np.std(tau)
-            inds = np.argwhere(np.logical_or(tau < sig * self.zmin, tau > sig * self.zmax))
-            inds = inds.reshape(inds.shape[0])
-            p_array.rparticles = np.delete(p_array.rparticles, inds, 1)
-            p_array.q_array = np.delete(p_array.q_array, inds, 0)
+            self.cut(p_array, p_array.tau(), self.zmin, self.zmax, "longitudinal")
 
         if self.horizontal:
-            x = p_array.x()
-            x0 = np.mean(x)
-            x = x - x0
-            sigx = np.std(x)
-            inds = np.argwhere(np.logical_or(x < sigx * self.xmin, x > sigx * self.xmax))
-            inds = inds.reshape(inds.shape[0])
-            p_array.rparticles = np.delete(p_array.rparticles, inds, 1)
-            p_array.q_array = np.delete(p_array.q_array, inds, 0)
+            self.cut(p_array, p_array.x(), self.xmin, self.xmax, "horizontal")
 
         if self.vertical:
-            y = p_array.y()
-            y0 = np.mean(y)
-            y = y - y0
-            sigy = np.std(y)
-            inds = np.argwhere(np.logical_or(y < sigy * self.ymin, y > sigy * self.ymax))
-            inds = inds.reshape(inds.shape[0])
-            p_array.rparticles = np.delete(p_array.rparticles, inds, 1)
-            p_array.q_array = np.delete(p_array.q_array, inds, 0)
+            self.cut(p_array, p_array.y(), self.ymin, self.ymax, "vertical")
+
+        p_array.compact()
+
+    def cut(self, p_array, u, umin, umax, cause):
+        """
+        Marks the particles outside [umin, umax] sigmas as lost (see ParticleArray.mark_lost())
+        """
+        alive = p_array.alive_mask()
+        u = u - np.mean(u[alive])
+        sig = np.std(u[alive])
+        inds = np.argwhere(np.logical_and(alive, np.logical_or(u < sig * umin, u > sig * umax)))
+        inds = inds.reshape(inds.shape[0])
+        p_array.mark_lost(inds, cause=cause)
 
 
 class BeamTransform(PhysProc):
@@ -19,7 +19,21 @@ def rot_mtx(angle):
                     [0.,  0., 0., 0., 0., 1.]])
 
 
-def uni_matrix(z, k1, hx, sum_tilts=0., energy=0.):
+def uni_matrix(z, k1, hx, sum_tilts=0., energy=0., delta=0.):
+    """
+    First order transfer matrix of the drift, quadrupole or dipole.
+
+    :param z: length
+    :param k1: quadrupole strength
+    :param hx: curvature of the reference orbit
+    :param sum_tilts: tilt of the element
+    :param energy: beam energy [GeV], float or array
+    :param delta: relative momentum offset of the particles, float or array.
+                  The magnet strengths are scaled by 1/(1 + delta).
+    :return: matrix (6, 6) or, if z, energy, delta or k1 is an array, array of matrices (M, 6, 6)
+    """
+    if np.ndim(z) or np.ndim(energy) or np.ndim(delta) or np.ndim(k1) or delta != 0:
+        return uni_matrices(z, k1, hx, sum_tilts=sum_tilts, energy=energy, delta=delta)
     # r = element.l/element.angle
     #  +K - focusing lens , -K - defoc
     gamma = energy/m_e_GeV
@@ -61,7 +75,248 @@ def uni_matrix(z, k1, hx, sum_tilts=0., energy=0.):
     return u_matrix
 
 
-def create_r_matrix(element):
+def uni_matrices(z, k1, hx, sum_tilts=0., energy=0., delta=0.):
+    """
+    Vectorized version of uni_matrix(). The arguments z, k1, energy and delta can be arrays (broadcasted together).
+    The off-momentum particle sees the quadrupole strength k1/(1 + delta) and the dipole field
+    curvature hx/(1 + delta), the reference orbit curvature is hx.
+
+    :return: array of matrices (M, 6, 6), M is the size of the broadcasted arrays
+    """
+    z, k1, energy, delta = np.broadcast_arrays(np.asarray(z, dtype=float), np.asarray(k1, dtype=float),
+                                               np.asarray(energy, dtype=float), np.asarray(delta, dtype=float))
+    z, k1, energy, delta = z.ravel(), k1.ravel(), energy.ravel(), delta.ravel()
+
+    gamma = energy / m_e_GeV
+    igamma2 = np.zeros_like(gamma)
+    igamma2[gamma != 0] = 1. / (gamma[gamma != 0] ** 2)
+    beta2 = 1. - igamma2
+    beta = np.sqrt(beta2)
+
+    k = k1 / (1. + delta)
+    hb = hx / (1. + delta)
+    kx2 = k + hx * hb
+    ky2 = -k
+    kx = np.sqrt(kx2 + 0.j)
+    ky = np.sqrt(ky2 + 0.j)
+    cx = np.cos(z * kx).real
+    cy = np.cos(z * ky).real
+    nonzero_x = kx != 0
+    nonzero_y = ky != 0
+    sx = np.where(nonzero_x, (np.sin(kx * z) / np.where(nonzero_x, kx, 1.)).real, z)
+    sy = np.where(nonzero_y, (np.sin(ky * z) / np.where(nonzero_y, ky, 1.)).real, z)
+    kx2_safe = np.where(nonzero_x, kx2, 1.)
+    dx = np.where(nonzero_x, hb / kx2_safe * (1. - cx), z * z * hb / 2.)
+    r56 = np.where(nonzero_x, hx * hb * (z - sx) / kx2_safe / beta2, hx * hb * z ** 3 / 6. / beta2)
+    r56 -= z / beta2 * igamma2
+
+    u_matrix = np.zeros((len(k1), 6, 6))
+    u_matrix[:, 0, 0] = cx
+    u_matrix[:, 0, 1] = sx
+    u_matrix[:, 0, 5] = dx / beta
+    u_matrix[:, 1, 0] = -kx2 * sx
+    u_matrix[:, 1, 1] = cx
+    u_matrix[:, 1, 5] = sx * hb / beta
+    u_matrix[:, 2, 2] = cy
+    u_matrix[:, 2, 3] = sy
+    u_matrix[:, 3, 2] = -ky2 * sy
+    u_matrix[:, 3, 3] = cy
+    u_matrix[:, 4, 0] = hx * sx / beta
+    u_matrix[:, 4, 1] = dx / beta
+    u_matrix[:, 4, 4] = 1.
+    u_matrix[:, 4, 5] = r56
+    u_matrix[:, 5, 5] = 1.
+    if sum_tilts != 0:
+        u_matrix = np.matmul(np.matmul(rot_mtx(-sum_tilts), u_matrix), rot_mtx(sum_tilts))
+    return u_matrix
+
+
+def _focusing_functions(K, z):
+    """
+    c = cos(sqrt(K) z), s = sin(sqrt(K) z)/sqrt(K), f1 = (1 - c)/K, f2 = (z - s)/K and their derivatives with
+    respect to K. For small K*z^2 the Taylor series are used.
+    """
+    x = K * z * z
+    if abs(x) < 1.e-2:
+        c = 1. - x / 2. + x * x / 24. - x ** 3 / 720. + x ** 4 / 40320.
+        s = z * (1. - x / 6. + x * x / 120. - x ** 3 / 5040. + x ** 4 / 362880.)
+        f1 = z ** 2 * (1. / 2. - x / 24. + x * x / 720. - x ** 3 / 40320.)
+        f2 = z ** 3 * (1. / 6. - x / 120. + x * x / 5040. - x ** 3 / 362880.)
+        s_K = z ** 3 * (-1. / 6. + x / 60. - x * x / 1680. + x ** 3 / 90720.)
+        f1_K = z ** 4 * (-1. / 24. + x / 360. - x * x / 13440.)
+        f2_K = z ** 5 * (-1. / 120. + x / 2520. - x * x / 120960.)
+    else:
+        k = np.sqrt(K + 0.j)
+        c = np.cos(k * z).real
+        s = (np.sin(k * z) / k).real
+        f1 = (1. - c) / K
+        f2 = (z - s) / K
+        s_K = (z * c - s) / (2. * K)
+        f1_K = (z * s / 2. - f1) / K
+        f2_K = (-s_K - f2) / K
+    c_K = -z * s / 2.
+    return c, s, f1, f2, c_K, s_K, f1_K, f2_K
+
+
+def uni_matrix_derivative(z, k1, hx, dz=0., dk1=0., dhx=0., sum_tilts=0., energy=0.):
+    """
+    Directional derivative of uni_matrix(): dR = dR/dz*dz + dR/dk1*dk1 + dR/dhx*dhx.
+
+    :param z: length
+    :param k1: quadrupole strength
+    :param hx: curvature of the reference orbit
+    :param dz: variation of the length
+    :param dk1: variation of the quadrupole strength
+    :param dhx: variation of the curvature
+    :param sum_tilts: tilt of the element
+    :param energy: beam energy [GeV]
+    :return: matrix (6, 6)
+    """
+    gamma = energy / m_e_GeV
+    igamma2 = 1. / (gamma * gamma) if gamma != 0 else 0.
+    beta = np.sqrt(1. - igamma2)
+
+    kx2 = k1 + hx * hx
+    ky2 = -k1
+    cx, sx, f1x, f2x, cx_K, sx_K, f1x_K, f2x_K = _focusing_functions(kx2, z)
+    cy, sy, f1y, f2y, cy_K, sy_K, f1y_K, f2y_K = _focusing_functions(ky2, z)
+    dkx2 = dk1 + 2. * hx * dhx
+    dky2 = -dk1
+    # d/dz: dc = -K*s, ds = c, df1 = s, df2 = f1
+    dcx = cx_K * dkx2 - kx2 * sx * dz
+    dsx = sx_K * dkx2 + cx * dz
+    df1x = f1x_K * dkx2 + sx * dz
+    df2x = f2x_K * dkx2 + f1x * dz
+    dcy = cy_K * dky2 - ky2 * sy * dz
+    dsy = sy_K * dky2 + cy * dz
+
+    d_matrix = np.zeros((6, 6))
+    d_matrix[0, 0] = dcx
+    d_matrix[0, 1] = dsx
+    d_matrix[0, 5] = (dhx * f1x + hx * df1x) / beta
+    d_matrix[1, 0] = -dkx2 * sx - kx2 * dsx
+    d_matrix[1, 1] = dcx
+    d_matrix[1, 5] = (dhx * sx + hx * dsx) / beta
+    d_matrix[2, 2] = dcy
+    d_matrix[2, 3] = dsy
+    d_matrix[3, 2] = -dky2 * sy - ky2 * dsy
+    d_matrix[3, 3] = dcy
+    d_matrix[4, 0] = (dhx * sx + hx * dsx) / beta
+    d_matrix[4, 1] = d_matrix[0, 5]
+    d_matrix[4, 5] = (2. * hx * dhx * f2x + hx * hx * df2x) / beta ** 2 - dz / beta ** 2 * igamma2
+    if sum_tilts != 0:
+        d_matrix = np.dot(np.dot(rot_mtx(-sum_tilts), d_matrix), rot_mtx(sum_tilts))
+    return d_matrix
+
+
+def edge_matrix_derivative(element, dh=1., sum_tilts=0.):
+    """
+    Derivative of the first order matrix of the Edge with respect to its curvature h (see create_r_matrix()).
+
+    :param element: Edge
+    :param dh: variation of the curvature
+    :param sum_tilts: tilt of the element
+    :return: matrix (6, 6)
+    """
+    sec_e = 1. / np.cos(element.edge)
+    phi_h = element.fint * element.gap * sec_e * (1. + np.sin(element.edge) ** 2)
+    psi = element.edge - phi_h * element.h
+    d_matrix = np.zeros((6, 6))
+    d_matrix[1, 0] = np.tan(element.edge) * dh
+    d_matrix[3, 2] = (-np.tan(psi) + element.h * phi_h / np.cos(psi) ** 2) * dh
+    if sum_tilts != 0:
+        d_matrix = np.dot(np.dot(rot_mtx(-sum_tilts), d_matrix), rot_mtx(sum_tilts))
+    return d_matrix
+
+
+def stack_r_matrix(r_z_e):
+    """
+    Wrap function r_z_e(z, energy) which accepts only scalar z and energy. For arrays of z and/or energies
+    (broadcasted together) the matrices are stacked in array (M, 6, 6).
+    """
+    def r_z_e_stack(z, energy):
+        if np.ndim(z) == 0 and np.ndim(energy) == 0:
+            return r_z_e(z, energy)
+        z, energy = np.broadcast_arrays(z, energy)
+        return np.array([r_z_e(zi, e) for zi, e in zip(np.ravel(z), np.ravel(energy))])
+    return r_z_e_stack
+
+
+def chromatic_r_matrix(r, delta, indices):
+    """
+    Scale the matrix elements r[indices] (strengths of the magnet) by 1/(1 + delta).
+
+    :param r: matrix (6, 6)
+    :param delta: relative momentum offset, float or array
+    :param indices: list of the matrix indices, e.g. [(1, 0), (3, 2)]
+    :return: matrix (6, 6) or array of matrices (M, 6, 6) if delta is an array
+    """
+    scale = 1. / (1. + np.asarray(delta, dtype=float))
+    r_delta = np.array(np.broadcast_to(r, scale.shape + (6, 6)))
+    for i, j in indices:
+        r_delta[..., i, j] = r[i, j] * scale
+    return r_delta
+
+
+def cavity_long_coefficients(E, V, freq, phi, z=0.):
+    """
+    Longitudinal coefficients of the cavity map used by cavity_R_z(), CavityTM.long_t_matrix() and
+    the longitudinal tracking (see longitudinal.cavity_long_map()). The arguments can be arrays (broadcasted together),
+    e.g. the settings of a scan.
+
+    :param E: initial energy [GeV]
+    :param V: voltage [GeV]
+    :param freq: frequency [Hz]
+    :param phi: phase [deg]
+    :param z: length
+    :return: r55_cor, r56, r65, r66, T566, T556, T555, T655 - R55 = 1 + r55_cor,
+            tau1 = R55*tau + R56*p + T566*p*p + T556*tau*p + T555*tau*tau, T655 - curvature of the RF.
+            If V = 0 r56 and T566 are the terms of the drift.
+    """
+    E = np.asarray(E, dtype=float)
+    V = np.asarray(V, dtype=float)
+    phi = np.asarray(phi, dtype=float) * np.pi / 180.
+    with np.errstate(divide="ignore", invalid="ignore", over="ignore"):
+        g0 = np.where(E != 0, E / m_e_GeV, 1e10)
+        igamma2 = np.where(E != 0, 1. / (g0 * g0), 0.)
+        beta0 = np.sqrt(1. - igamma2)
+        delta_e = V * np.cos(phi)
+        E1 = E + delta_e
+        g1 = E1 / m_e_GeV
+        beta1 = np.sqrt(1. - 1. / (g1 * g1))
+        k = 2. * np.pi * freq / speed_of_light
+        dgamma = V / m_e_GeV
+
+        acc = (V != 0) & (E != 0)
+        r56 = np.where(acc, - z / (g1 * g1 * g0 * beta1) * (g1 + g0) / (beta1 + beta0), - z / beta0**2 * igamma2)
+        r55_cor = np.where(acc, k * z * beta0 * V / m_e_GeV * np.sin(phi) * (g0 * g1 * (beta0 * beta1 - 1) + 1) / (
+                           beta1 * g1 * (g0 - g1) ** 2), 0.)
+        r65 = k * np.sin(phi) * V / (g1 * beta1 * m_e_GeV)
+        r66 = g0 / g1 * beta0 / beta1
+
+        T655 = np.where(E1 > 0, -0.5 * V * beta0 / (E1 * beta1) * (beta0 * k)**2 * np.cos(phi), 0.)
+        acc = (E1 > 0) & (delta_e > 0)
+        T566 = np.where(acc, z * (beta0**3*g0**3 - beta1**3*g1**3)/(2*beta0*beta1**3*g0*(g0 - g1)*g1**3),
+                        1.5 * z*igamma2/(beta0**3))
+        T556 = np.where(acc, beta0 * k * z * dgamma * g0 * (beta1**3*g1**3 + beta0 * (g0 - g1**3)) * np.sin(phi) / (
+                        beta1**3 * g1**3 * (g0 - g1)**2), 0.)
+        T555 = np.where(acc, beta0**2 * k**2 * z * dgamma/2.*(
+                        dgamma*(2*g0*g1**3*(beta0*beta1**3 - 1) + g0**2 + 3*g1**2 - 2)/(beta1**3*g1**3*(g0 - g1)**3) *
+                        np.sin(phi)**2 - (g1*g0*(beta1*beta0 - 1) + 1)/(beta1*g1*(g0 - g1)**2)*np.cos(phi)), 0.)
+    return r55_cor, r56, r65, r66, T566, T556, T555, T655
+
+
+def create_r_matrix(element, delta=0.):
+    """
+    Function r_z_e(z, energy) of the first order transfer matrix of the element (without tilt).
+    z and energy can be arrays, in that case array of the matrices (M, 6, 6) is returned.
+
+    :param element: Element
+    :param delta: relative momentum offset of the particles, float or array. The strengths of
+                  the quadrupoles, dipoles, edges and multipoles are scaled by 1/(1 + delta),
+                  other elements do not depend on delta.
+    :return: function r_z_e(z, energy)
+    """
 
     k1 = element.k1
     if element.l == 0:
@@ -69,7 +324,7 @@ def create_r_matrix(element):
     else:
         hx = element.angle / element.l
 
-    r_z_e = lambda z, energy: uni_matrix(z, k1, hx=hx, sum_tilts=0, energy=energy)
+    r_z_e = lambda z, energy: uni_matrix(z, k1, hx=hx, sum_tilts=0, energy=energy, delta=delta)
 
     if element.__class__ == Edge:
         sec_e = 1. / np.cos(element.edge)
@@ -78,6 +333,8 @@ def create_r_matrix(element):
         r = np.eye(6)
         r[1, 0] = element.h * np.tan(element.edge)
         r[3, 2] = -element.h * np.tan(element.edge - phi)
+        if np.ndim(delta) or delta != 0:
+            r = chromatic_r_matrix(r, delta, [(1, 0), (3, 2)])
         r_z_e = lambda z, energy: r
 
     if element.__class__ in [Hcor, Vcor]:
@@ -122,6 +379,7 @@ def create_r_matrix(element):
             :param E: initial energy
             :return: matrix
             """
+            phi_deg = phi
             phi = phi * np.pi / 180.
             de = V * np.cos(phi)
             # pure pi-standing-wave case
@@ -147,28 +405,14 @@ def create_r_matrix(element):
 
             r22 = Ei / Ef * (cos_alpha + np.sqrt(2. / eta) * cos_phi * sin_alpha)
 
-            r56 = 0.
-            beta0 = 1
-            beta1 = 1
-
-            k = 2. * np.pi * freq / speed_of_light
-            r55_cor = 0.
             if V != 0 and E != 0:
-                gamma2 = Ei * Ei
-                beta0 = np.sqrt(1. - 1 / gamma2)
-                gamma2 = Ef * Ef
-                beta1 = np.sqrt(1. - 1 / gamma2)
-
-                #r56 = (beta0 / beta1 - 1) * Ei / (Ef - Ei) * z
-                r56 = - z/(Ef * Ef * Ei * beta1) * (Ef + Ei)/(beta1 + beta0)
-                g0 = Ei
-                g1 = Ef
-                r55_cor = k * z * beta0 * V / m_e_GeV * np.sin(phi) * (g0 * g1 * (beta0 * beta1 - 1) + 1) / (
-                            beta1 * g1 * (g0 - g1) ** 2)
-
-
-            r66 = Ei/Ef*beta0/beta1
-            r65 = k*np.sin(phi)*V/(Ef*beta1*m_e_GeV)
+                r55_cor, r56, r65, r66 = cavity_long_coefficients(E, V, freq, phi_deg, z)[:4]
+            else:
+                k = 2. * np.pi * freq / speed_of_light
+                r55_cor = 0.
+                r56 = 0.
+                r66 = Ei/Ef
+                r65 = k*np.sin(phi)*V/(Ef*m_e_GeV)
             cav_matrix = np.array([[r11, r12, 0., 0., 0., 0.],
                                 [r21, r22, 0., 0., 0., 0.],
                                 [0., 0., r11, r12, 0., 0.],
@@ -395,6 +639,8 @@ def create_r_matrix(element):
         r[1, 0] = -element.kn[1]
         r[3, 2] = element.kn[1]
         r[1, 5] = element.kn[0]
+        if np.ndim(delta) or delta != 0:
+            r = chromatic_r_matrix(r, delta, [(1, 0), (3, 2)])
         r_z_e = lambda z, energy: r
 
     elif element.__class__ == XYQuadrupole:
@@ -456,5 +702,8 @@ def create_r_matrix(element):
     # else:
     #    print (element.__class__, " : unknown type of magnetic element. Cannot create transfer map ")
 
+    if element.__class__ in [Edge, Undulator, Cavity, TWCavity, Solenoid, TDCavity, Matrix, Multipole, XYQuadrupole]:
+        r_z_e = stack_r_matrix(r_z_e)
+
     #b_z = lambda z, energy: dot((eye(6) - R_z(z, energy)), array([dx, 0., dy, 0., 0., 0.]))
     return r_z_e
\ No newline at end of file
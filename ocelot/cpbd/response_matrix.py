@@ -1,8 +1,10 @@
 from ocelot.cpbd.optics import *
 from ocelot.cpbd.match import closed_orbit
 from ocelot.cpbd.track import tracking_step
+from ocelot.cpbd.elements import element_fingerprint, ObjectParam
 import copy
 import os
+import hashlib
 import numpy as np
 from scipy.interpolate import splrep, splev
 import json
@@ -11,6 +13,158 @@ from threading import Thread
 import logging
 logger = logging.getLogger(__name__)
 
+
+# attributes which are written to the elements by the orbit correction and do not change the optics
+_volatile_params = ("s", "lat_inx", "x", "y", "x_ref", "y_ref", "E", "p", "Dx", "Dy", "Dx_des", "Dy_des",
+                    "beta_x", "beta_y", "phi_x", "phi_y", "weight", "I", "dI")
+
+
+def _has_objects(param):
+    if isinstance(param, ObjectParam):
+        return True
+    return isinstance(param, tuple) and any(_has_objects(v) for v in param)
+
+
+def element_digest(element):
+    """
+    Content digest of the element parameters (see element_fingerprint()) which can be stored in a file.
+    The attributes written by the orbit correction (BPM readings, positions, optical functions) and the angles of
+    the correctors, which change only the reference orbit, are ignored.
+    The parameters holding objects (e.g. field maps) are left out, they are known only by identity which
+    changes in every session, so the replacement of such an object is not detected.
+
+    :param element: Element
+    :return: str, hex digest
+    """
+    cls, params = element_fingerprint(element)
+    ignore = _volatile_params + ("angle",) if cls in (Hcor, Vcor) else _volatile_params
+    params = tuple(item for item in params if item[0] not in ignore and not _has_objects(item[1]))
+    return hashlib.sha1(repr((cls.__name__, params)).encode()).hexdigest()
+
+
+# transfer maps which are represented by the R (and T) matrices in orbit_response_matrix()
+_matrix_maps = (TransferMap, SecondTM, CorrectorTM, CavityTM, TWCavityTM)
+
+
+def corrector_kick(cor):
+    """
+    derivative of the orbit at the exit of the corrector over the corrector angle (see CorrectorTM.kick_b())
+
+    :param cor: Hcor or Vcor
+    :return: array (6,)
+    """
+    if cor.__class__ == Hcor:
+        return cor.transfer_map.kick_b(cor.l, cor.l, 1., 0.)[:, 0]
+    return cor.transfer_map.kick_b(cor.l, cor.l, 0., 1.)[:, 0]
+
+
+def map_jacobian(tm, X, energy, order=1):
+    """
+    Jacobian of the transfer map at the orbit X. For order=2 the second order matrices of SecondTM and CorrectorTM
+    are taken into account (the feed-down of the orbit offset)
+
+    :param tm: TransferMap
+    :param X: array (6,), coordinates at the entrance
+    :param energy: energy
+    :param order: 1 or 2
+    :return: array (6, 6)
+    """
+    R = tm.R(energy)
+    if order < 2:
+        return R
+    if tm.__class__ == SecondTM:
+        X_loc = transform_vec_ent(np.copy(X).reshape(6, 1), tm.dx, tm.dy, tm.tilt)[:, 0]
+        S = sym_matrix(np.copy(tm.t_mat_z_e(tm.length, energy)))
+        J = tm.r_z_no_tilt(tm.length, energy) + 2. * np.einsum("ijk,k->ij", S, X_loc)
+        return np.dot(np.dot(rot_mtx(-tm.tilt), J), rot_mtx(tm.tilt))
+    if tm.__class__ == CorrectorTM and tm.t_mat_z_e is not None:
+        S = sym_matrix(np.copy(tm.t_mat_z_e(tm.length, energy)))
+        return R + 2. * np.einsum("ijk,k->ij", S, X)
+    return R
+
+
+def orbit_response_matrix(lattice, cors, bpms, p_init=None, order=1, ic=False, tracking=None, delta=1.e-6):
+    """
+    Orbit response matrix in one pass through the lattice. The responses to all correctors are propagated
+    together as the columns of the matrix (6, ncor) with the Jacobians of the element maps along the reference
+    orbit, the energy of the reference particle is changed by the cavities. If the lattice has the maps which
+    are not represented by the matrices (e.g. KickTM, MultipoleTM) the response is calculated by the tracking
+    of all perturbed particles in one ParticleArray (the central differences with the corrector angles +/- delta).
+    The orbit is read in the middle of the BPMs as in MeasureResponseMatrix.read_virtual_orbit().
+
+    :param lattice: MagneticLattice
+    :param cors: list of the correctors (Hcor, Vcor)
+    :param bpms: list of the BPMs
+    :param p_init: Particle, the reference particle at the beginning of the lattice, None - Particle()
+    :param order: 1 - the R matrices, 2 - the feed-down of the second order matrices along the reference orbit
+    :param ic: if True, the responses to the initial coordinates (x, px, y, py) are added as 4 last columns
+    :param tracking: None - the tracking is used only if it is needed, True - always, False - never
+    :param delta: step of the corrector angles and the initial coordinates for the tracking
+    :return: array (2*len(bpms), len(cors) [+ 4]) - responses of x at the BPMs in the first rows, then of y
+    """
+    p_init = Particle() if p_init is None else p_init
+    if tracking is None:
+        tracking = any(elem.transfer_map.__class__ not in _matrix_maps for elem in lattice.sequence)
+    nbpm = len(bpms)
+    ncols = len(cors) + (4 if ic else 0)
+    cor_index = {}
+    for j, cor in enumerate(cors):
+        cor_index.setdefault(id(cor), []).append(j)
+    bpm_index = {}
+    for n, bpm in enumerate(bpms):
+        bpm_index.setdefault(id(bpm), []).append(n)
+
+    X = np.array([p_init.x, p_init.px, p_init.y, p_init.py, p_init.tau, p_init.p])
+    if tracking:
+        p_array = ParticleArray(n=2 * ncols)
+        p_array.E = p_init.E
+        p_array.rparticles[:] = X[:, np.newaxis]
+        if ic:
+            for i, k in enumerate([0, 1, 2, 3]):
+                p_array.rparticles[k, 2 * (len(cors) + i)] += delta
+                p_array.rparticles[k, 2 * (len(cors) + i) + 1] -= delta
+        K = None
+    else:
+        K = np.zeros((6, ncols))
+        if ic:
+            K[[0, 1, 2, 3], len(cors) + np.arange(4)] = 1.
+    energy = p_init.E
+    resp = np.zeros((2 * nbpm, ncols))
+    read = {}
+    for elem in lattice.sequence:
+        tm = elem.transfer_map
+        if id(elem) in bpm_index and id(elem) not in read:
+            half = tm(elem.l / 2.) if elem.l != 0 else None
+            if tracking:
+                p_half = copy.deepcopy(p_array)
+                if half is not None:
+                    half.apply(p_half)
+                D = (p_half.rparticles[:, ::2] - p_half.rparticles[:, 1::2]) / (2. * delta)
+            else:
+                D = K if half is None else np.dot(half.R(energy), K)
+            for n in bpm_index[id(elem)]:
+                resp[n] = D[0]
+                resp[n + nbpm] = D[2]
+            read[id(elem)] = True
+        if tracking:
+            tm.apply(p_array)
+        else:
+            J = map_jacobian(tm, X, energy, order)
+            K = np.dot(J, K)
+            if order > 1:
+                X = tm.map(X.reshape(6, 1), energy)[:, 0]
+        if id(elem) in cor_index:
+            b = corrector_kick(elem)
+            for j in cor_index[id(elem)]:
+                if tracking:
+                    p_array.rparticles[:, 2 * j] += delta * b
+                    p_array.rparticles[:, 2 * j + 1] -= delta * b
+                else:
+                    K[:, j] += b
+        energy += tm.delta_e
+    return resp
+
+
 class MeasureResponseMatrix:
     def __init__(self, lattice, hcors, vcors, bpms):
         self.lat = lattice
@@ -18,7 +172,7 @@ class MeasureResponseMatrix:
         self.vcors = vcors
         self.bpms = bpms
 
-    def calculate(self):
+    def calculate(self, tw_init=None):
         pass
 
     def read_virtual_orbit(self, p_init=None, write2bpms=True):
@@ -216,56 +370,35 @@ class LinacSimRM(MeasureResponseMatrix):
     def __init__(self, lattice, hcors, vcors, bpms):
         super(LinacSimRM, self).__init__(lattice, hcors, vcors, bpms)
 
-    def calculate(self, tw_init=None):
+    def calculate(self, tw_init=None, order=1, tracking=None):
         """
-        calculation of ideal response matrix
+        calculation of ideal response matrix. All columns are calculated in one pass through the lattice,
+        see orbit_response_matrix()
 
         :param lattice: class MagneticLattice
-        :param tw_init: if tw_init == None, function tries to find periodical solution
+        :param tw_init: Twiss, the initial energy is taken from tw_init.E
+        :param order: 1 - the R matrices, 2 - the second order matrices along the reference orbit
+        :param tracking: None - the tracking is used only for the nonlinear elements, True - always, False - never
         :return: orbit.resp
         """
-        #self.optical_func_params(tw_init=tw_init)
         match_ic = False  # for future, fitting the initial conditions
-        m = len(self.bpms)
-        nx = len(self.hcors)
-        ny = len(self.vcors)
-
-        add_i = 0
-        if match_ic:
-            add_i = 4
-        self.resp = np.zeros((2 * m, nx + ny + add_i))
-        s = [bpm.s for bpm in self.bpms]
-        X0, Y0 = self.read_virtual_orbit(p_init=Particle( E=tw_init.E))
+        cors = [item for sublist in [self.hcors, self.vcors] for item in sublist]
+        self.resp = orbit_response_matrix(self.lat, cors, self.bpms, p_init=Particle(E=tw_init.E), order=order,
+                                          ic=match_ic, tracking=tracking)
+        return self.resp
 
-        Or0 = np.append(X0, Y0)
-        for j, cor in enumerate([item for sublist in [self.hcors, self.vcors] for item in sublist]):
-            print(j,"/", nx+ny, cor.id)
-            cor.angle = 0.0001
-            self.lat.update_transfer_maps()
-            #start = time()
-            X1, Y1 = self.read_virtual_orbit(p_init=Particle(E=tw_init.E))
-            #print(time() - start)
+    def calculate_columns(self, cors, tw_init=None, order=1, tracking=None):
+        """
+        columns of the ideal response matrix for the correctors cors, see orbit_response_matrix()
 
-            Or1 = np.append(X1, Y1)
-            self.resp[:, j] = (Or1 - Or0)/cor.angle
-            cor.angle = 0.00
-        self.lat.update_transfer_maps()
-        if match_ic:
-            for i, par in enumerate(["x", "px", "y", "py"]):
-                #print(i)
-                p_i = Particle(E = tw_init.E)
-                p_i.__dict__[par] = 0.0001
-                #print ("measure = ", p_i.x, p_i.y, p_i.px, p_i.py, p_i.E)
-                X1, Y1 = self.read_virtual_orbit(p_init=p_i)
-                Or1 = np.append(X1, Y1)
-                self.resp[:, nx + ny + i] = (Or1 - Or0) /0.0001
-        X1, Y1 = self.read_virtual_orbit(p_init=Particle(E=tw_init.E))
-        #rmatrix = ResponseMatrix()
-        #rmatrix.bpm_names = [b.id for b in self.bpms]
-        #rmatrix.cor_names = np.append(np.array([c.id for c in self.hcors]), np.array([c.id for c in self.vcors]))
-        #rmatrix.matrix = self.resp
-        #rmatrix.mode = "radian"
-        return self.resp
+        :param cors: list of correctors
+        :param tw_init: Twiss, the initial energy is taken from tw_init.E
+        :param order: 1 - the R matrices, 2 - the second order matrices along the reference orbit
+        :param tracking: None - the tracking is used only for the nonlinear elements, True - always, False - never
+        :return: array (2*len(bpms), len(cors))
+        """
+        return orbit_response_matrix(self.lat, cors, self.bpms, p_init=Particle(E=tw_init.E), order=order,
+                                     tracking=tracking)
 
 
 class LinacRmatrixRM(MeasureResponseMatrix):
@@ -413,23 +546,86 @@ class ResponseMatrix:
         self.tw_init = None   # for self.run()
         self.filename = None  # for self.run()
 
-    def calculate(self, tw_init=None):
-        """
-        rewrites cor_name, bpm_name and matrix
+        self.fingerprint = None  # digests of the lattice elements, see element_digest()
+        self.energy = None       # initial energy of the lattice
 
-        :param method:
+    def calculate(self, tw_init=None, filename=None):
+        """
+        rewrites cor_name, bpm_name and matrix.
+        If filename (*.npz) is given and the file exists, the stored matrix is reused: only the columns of the
+        correctors upstream of the changed elements (and downstream of the changed cavities) are recalculated
+        if the method calculates the columns separately (has calculate_columns(), e.g. LinacSimRM), otherwise
+        the whole matrix is recalculated if any column is changed. The new matrix is written to the file.
+
+        :param tw_init: Twiss
+        :param filename: None or path to the response matrix store *.npz
         :return:
         """
         if self.method != None:
             hcors = self.method.hcors
             vcors = self.method.vcors
             bpms = self.method.bpms
-            self.cor_names = np.append([cor.id for cor in hcors], [cor.id for cor in vcors])
-            self.bpm_names = [bpm.id for bpm in bpms]
-            self.matrix = self.method.calculate(tw_init=tw_init)
+            cor_names = np.append([cor.id for cor in hcors], [cor.id for cor in vcors])
+            bpm_names = [bpm.id for bpm in bpms]
+            fingerprint = [element_digest(elem) for elem in self.method.lat.sequence]
+            energy = tw_init.E if tw_init is not None else 0.
+            columns = None
+            if filename is not None and os.path.exists(filename):
+                stored = ResponseMatrix()
+                stored.load(filename)
+                columns = stored.changed_columns(self.method.lat, fingerprint, energy, cor_names, bpm_names)
+                if columns and not hasattr(self.method, "calculate_columns"):
+                    logger.info(" ResponseMatrix.calculate: " + self.method.__class__.__name__ +
+                                " calculates the whole matrix")
+                    columns = None
+            if columns is None:
+                self.matrix = self.method.calculate(tw_init=tw_init)
+            else:
+                cors = list(hcors) + list(vcors)
+                logger.info(" ResponseMatrix.calculate: " + str(len(columns)) + " of " + str(len(cors)) +
+                            " columns are recalculated")
+                self.matrix = np.array(stored.matrix)
+                if len(columns) > 0:
+                    self.matrix[:, columns] = self.method.calculate_columns([cors[i] for i in columns],
+                                                                            tw_init=tw_init)
+            self.cor_names = cor_names
+            self.bpm_names = bpm_names
+            self.fingerprint = fingerprint
+            self.energy = energy
+            if filename is not None:
+                self.dump(filename)
         else:
             print("ResponseMatrix.method = None, Add the method, e.g. MeasureResponseMatrix")
 
+    def changed_columns(self, lattice, fingerprint, energy, cor_names, bpm_names):
+        """
+        Indices of the columns which have to be recalculated for the lattice with the fingerprint.
+        A column depends on the elements between the corrector and the last BPM and on the energy at the corrector,
+        the changes of the reference orbit upstream of the corrector are neglected.
+
+        :param lattice: MagneticLattice
+        :param fingerprint: list of the element digests of the lattice, see element_digest()
+        :param energy: initial energy
+        :param cor_names: list of the corrector names
+        :param bpm_names: list of the BPM names
+        :return: list of the column indices or None if the whole matrix has to be recalculated
+        """
+        if (self.fingerprint is None or len(self.fingerprint) != len(fingerprint) or self.energy != energy or
+                list(self.cor_names) != list(cor_names) or list(self.bpm_names) != list(bpm_names)):
+            return None
+        index = {}
+        for i, elem in enumerate(lattice.sequence):
+            index.setdefault(elem.id, i)
+        last_bpm = max([index[name] for name in bpm_names]) if len(bpm_names) > 0 else -1
+        changed = [i for i, (d1, d2) in enumerate(zip(self.fingerprint, fingerprint)) if d1 != d2]
+        columns = []
+        for j, name in enumerate(cor_names):
+            k = index[name]
+            if any(k <= i <= last_bpm or (i < k and lattice.sequence[i].__class__ in (Cavity, TWCavity))
+                   for i in changed):
+                columns.append(j)
+        return columns
+
     def get_matrix(self):
         return self.matrix
 
@@ -517,6 +713,26 @@ class ResponseMatrix:
         return self.matrix
 
     def dump(self, filename):
+        """
+        writes the response matrix to the file, *.npz - binary format with the lattice fingerprint, otherwise json
+
+        :param filename: path to the file
+        :return:
+        """
+        directory = os.path.dirname(filename)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+
+        if filename.endswith(".npz"):
+            fingerprint = self.fingerprint if self.fingerprint is not None else []
+            energy = self.energy if self.energy is not None else np.nan
+            np.savez_compressed(filename, matrix=np.array(self.matrix, dtype=float),
+                                cor_names=np.array(self.cor_names, dtype=str),
+                                bpm_names=np.array(self.bpm_names, dtype=str),
+                                method_name=self.method.__class__.__name__ if self.method != None else "None",
+                                mode=self.mode, fingerprint=np.array(fingerprint, dtype=str), energy=energy)
+            return
+
         dict_rmatrix = {}
         dict_rmatrix["cor_names"] = list(self.cor_names)
         dict_rmatrix["bpm_names"] = list(self.bpm_names)
@@ -525,14 +741,29 @@ class ResponseMatrix:
         dict_rmatrix["method_name"] = self.method.__class__.__name__ if self.method != None else "None"
         dict_rmatrix["mode"] = self.mode
 
-        directory = os.path.dirname(filename)
-        if not os.path.exists(directory):
-            os.makedirs(directory)
-
         with open(filename, 'w+') as f:
             json.dump(dict_rmatrix, f)
 
     def load(self, filename):
+        """
+        reads the response matrix from the file written by dump()
+
+        :param filename: path to the file
+        :return: 1
+        """
+        if filename.endswith(".npz"):
+            with np.load(filename) as data:
+                self.cor_names = [str(name) for name in data["cor_names"]]
+                self.bpm_names = [str(name) for name in data["bpm_names"]]
+                self.method_name = str(data["method_name"])
+                self.matrix = data["matrix"].reshape(2 * len(self.bpm_names), len(self.cor_names))
+                self.mode = str(data["mode"])
+                fingerprint = [str(digest) for digest in data["fingerprint"]]
+                energy = float(data["energy"])
+            self.fingerprint = fingerprint if len(fingerprint) > 0 else None
+            self.energy = None if np.isnan(energy) else energy
+            return 1
+
         with open(filename, 'r') as f:
             dict_rmatrix = json.load(f)
         self.cor_names = dict_rmatrix["cor_names"]
@@ -541,6 +772,8 @@ class ResponseMatrix:
         r_matrix = np.array(dict_rmatrix["matrix"])
         self.matrix = r_matrix.reshape(2*len(self.bpm_names),len(self.cor_names))
         self.mode = dict_rmatrix["mode"]
+        self.fingerprint = None
+        self.energy = None
         return 1
 
 
@@ -0,0 +1,335 @@
+"""
+Truncated power series algebra (TPSA) and Taylor maps of the lattice.
+
+The one-turn Taylor map is extracted by the propagation of the truncated power series of the six coordinates
+through the transfer maps of the elements. The map is then applied to the particles as a polynomial,
+instead of the element by element tracking.
+
+usage:
+    otm = one_turn_map(lat, energy=0., order=3)
+    otm.apply(p_array)
+    track_list = track_nturns(lat, nturns, track_list, tpsa_order=3)
+"""
+
+from itertools import combinations_with_replacement
+from math import factorial
+import logging
+
+import numpy as np
+
+from ocelot.cpbd.optics import TransferMap, SecondTM, KickTM, MultipoleTM, CorrectorTM, Navigator, get_map
+from ocelot.cpbd.r_matrix import rot_mtx
+from ocelot.common.globals import m_e_GeV
+
+_logger = logging.getLogger(__name__)
+
+
+class TPSA:
+    """
+    Truncated power series algebra in nvar variables up to the total order 'order'.
+    A power series is stored as a vector of the coefficients of the monomials (see self.exponents),
+    the monomials are sorted by the total order. c[0] is the constant term, c[1 + i] is the coefficient of x_i.
+    """
+    _algebras = {}
+
+    def __init__(self, order=3, nvar=6):
+        """
+        :param order: maximum total order of the monomials
+        :param nvar: number of the variables
+        """
+        self.order = order
+        self.nvar = nvar
+        exponents = []
+        for deg in range(order + 1):
+            for comb in combinations_with_replacement(range(nvar), deg):
+                exponents.append(tuple(np.bincount(comb, minlength=nvar)))
+        self.exponents = np.array(exponents, dtype=int)
+        self.degree = np.sum(self.exponents, axis=1)
+        self.size = len(exponents)
+        index = {e: i for i, e in enumerate(exponents)}
+
+        # monomial k = monomial parent[k] * x[var[k]], used for the evaluation of the series
+        self.parent = np.zeros(self.size, dtype=int)
+        self.var = np.zeros(self.size, dtype=int)
+        for k, e in enumerate(exponents[1:], 1):
+            v = np.nonzero(e)[0][-1]
+            p = list(e)
+            p[v] -= 1
+            self.parent[k] = index[tuple(p)]
+            self.var[k] = v
+
+        # table of the products of the monomials with the total order <= order
+        n_deg = [np.sum(self.degree <= d) for d in range(order + 1)]
+        ia, ib, ic = [], [], []
+        for a, ea in enumerate(exponents):
+            for b in range(n_deg[order - self.degree[a]]):
+                ia.append(a)
+                ib.append(b)
+                ic.append(index[tuple(np.add(ea, exponents[b]))])
+        self.ia = np.array(ia, dtype=int)
+        self.ib = np.array(ib, dtype=int)
+        self.ic = np.array(ic, dtype=int)
+
+    @classmethod
+    def get(cls, order=3, nvar=6):
+        """
+        Cached algebra, the product table is calculated only once for every (order, nvar)
+        """
+        key = (order, nvar)
+        if key not in cls._algebras:
+            cls._algebras[key] = cls(order=order, nvar=nvar)
+        return cls._algebras[key]
+
+    def identity(self):
+        """
+        :return: array (nvar, size), power series of the variables x_i
+        """
+        C = np.zeros((self.nvar, self.size))
+        C[:, 1:self.nvar + 1] = np.eye(self.nvar)
+        return C
+
+    def mul(self, a, b):
+        """
+        Truncated product of two power series
+
+        :param a: array (size) of the coefficients
+        :param b: array (size) of the coefficients
+        :return: array (size)
+        """
+        return np.bincount(self.ic, weights=a[self.ia] * b[self.ib], minlength=self.size)
+
+    def monomials(self, X):
+        """
+        Values of all monomials for the points X
+
+        :param X: array (nvar, n)
+        :return: array (size, n)
+        """
+        M = np.empty((self.size,) + np.shape(X[0]))
+        M[0] = 1.
+        for k in range(1, self.size):
+            M[k] = M[self.parent[k]] * X[self.var[k]]
+        return M
+
+    def evaluate(self, C, X):
+        """
+        Values of the power series C for the points X
+
+        :param C: array (m, size) of the coefficients of m power series
+        :param X: array (nvar, n)
+        :return: array (m, n)
+        """
+        return np.dot(C, self.monomials(X))
+
+
+def tps_shift_rotate(C, dx, dy, tilt):
+    """
+    Entrance transformation of the element with offsets and tilt (see transform_vec_ent())
+    """
+    C = np.copy(C)
+    C[0, 0] -= dx
+    C[2, 0] -= dy
+    return np.dot(rot_mtx(tilt), C)
+
+
+def tps_rotate_shift(C, dx, dy, tilt):
+    """
+    Exit transformation of the element with offsets and tilt (see transform_vec_ext())
+    """
+    C = np.dot(rot_mtx(-tilt), C)
+    C[0, 0] += dx
+    C[2, 0] += dy
+    return C
+
+
+def tps_second_order(algebra, C, R, T):
+    """
+    X_i = sum_j R_ij X_j + sum_jk T_ijk X_j X_k (see SecondOrderMult)
+    """
+    Cr = np.dot(R, C)
+    for j, k in zip(*np.nonzero(np.any(T != 0, axis=0))):
+        Cr += np.outer(T[:, j, k], algebra.mul(C[j], C[k]))
+    return Cr
+
+
+def tps_kick(algebra, tm, C, energy):
+    """
+    The same kicks as KickTM.kick_apply() for the power series
+    """
+    mul = algebra.mul
+    if tm.dx != 0 or tm.dy != 0 or tm.tilt != 0:
+        C = tps_shift_rotate(C, tm.dx, tm.dy, tm.tilt)
+    C = np.copy(C)
+    gamma = energy / m_e_GeV
+    coef = 0
+    if gamma != 0:
+        gamma2 = gamma * gamma
+        beta = 1. - 0.5 / gamma2
+        coef = 1. / (beta * beta * gamma2)
+    l = tm.length / tm.nkick
+    angle = tm.angle / tm.nkick
+    dl = l / 2.
+    k1 = tm.k1 * dl
+    k2 = tm.k2 * dl
+    k3 = tm.k3 * dl
+    for i in range(tm.nkick):
+        x = C[0] + C[1] * dl
+        x[0] -= tm.dx
+        y = C[2] + C[3] * dl
+        y[0] -= tm.dy
+        tau = -C[5] * dl * coef
+        x2, y2, xy = mul(x, x), mul(y, y), mul(x, y)
+        re = -angle * C[5] + k1 * x + k2 * (x2 - y2) + k3 * (mul(x2, x) - 3. * mul(xy, y))
+        im = k1 * y + k2 * 2. * xy + k3 * (3. * mul(x2, y) - mul(y2, y))
+        C[1] = C[1] - re
+        C[3] = C[3] + im
+        C[4] = tau - angle * C[0]
+        C[0] = x + C[1] * dl
+        C[0, 0] += tm.dx
+        C[2] = y + C[3] * dl
+        C[2, 0] += tm.dy
+        C[4] -= C[5] * dl * coef
+    if tm.dx != 0 or tm.dy != 0 or tm.tilt != 0:
+        C = tps_rotate_shift(C, tm.dx, tm.dy, tm.tilt)
+    return C
+
+
+def tps_multipole(algebra, tm, C):
+    """
+    The same kick as MultipoleTM.kick() for the power series
+    """
+    C = np.copy(C)
+    kn = tm.kn
+    re = -kn[0] * C[5]
+    im = np.zeros(algebra.size)
+    # (x + i*y)**n
+    zr, zi = C[0], C[2]
+    for n in range(1, len(kn)):
+        if n > 1:
+            zr, zi = algebra.mul(zr, C[0]) - algebra.mul(zi, C[2]), algebra.mul(zr, C[2]) + algebra.mul(zi, C[0])
+        re = re + kn[n] * zr / factorial(n)
+        im = im + kn[n] * zi / factorial(n)
+    C[1] = C[1] - re
+    C[3] = C[3] + im
+    C[4] = C[4] - kn[0] * C[0]
+    return C
+
+
+def tps_transfer_map(algebra, tm, C, energy):
+    """
+    Propagation of the power series of the coordinates through the transfer map of the element.
+    The maps which are not supported (e.g. CavityTM, RungeKuttaTM) are approximated by the linear maps.
+
+    :param algebra: TPSA
+    :param tm: TransferMap
+    :param C: array (6, algebra.size), power series of the coordinates
+    :param energy: beam energy
+    :return: array (6, algebra.size)
+    """
+    if tm.__class__ == TransferMap:
+        C = np.dot(tm.R(energy), C)
+        C[:, 0] += tm.B(energy)[:, 0]
+    elif tm.__class__ == SecondTM:
+        if tm.dx != 0 or tm.dy != 0 or tm.tilt != 0:
+            C = tps_shift_rotate(C, tm.dx, tm.dy, tm.tilt)
+        C = tps_second_order(algebra, C, tm.r_z_no_tilt(tm.length, energy), tm.t_mat_z_e(tm.length, energy))
+        if tm.dx != 0 or tm.dy != 0 or tm.tilt != 0:
+            C = tps_rotate_shift(C, tm.dx, tm.dy, tm.tilt)
+    elif tm.__class__ == KickTM:
+        C = tps_kick(algebra, tm, C, energy)
+    elif tm.__class__ == MultipoleTM:
+        C = tps_multipole(algebra, tm, C)
+    elif tm.__class__ == CorrectorTM:
+        if tm.multiplication is not None and tm.t_mat_z_e is not None:
+            C = tps_second_order(algebra, C, tm.R(energy), tm.t_mat_z_e(tm.length, energy))
+        else:
+            C = np.dot(tm.R(energy), C)
+        C[:, 0] += tm.kick_b(tm.length, tm.length, tm.angle_x, tm.angle_y)[:, 0]
+    else:
+        _logger.warning(" tps_transfer_map: " + tm.__class__.__name__ + " is approximated by the linear map")
+        C = np.dot(tm.R(energy), C)
+        C[:, 0] += tm.B(energy)[:, 0]
+    return C
+
+
+def symplectify(R):
+    """
+    Symplectic matrix close to R (Cayley transform): V = (I - R)(I + R)^-1 = J*S with symmetric S
+    for the symplectic R, S is replaced by its symmetric part. The symplectic R is not changed.
+
+    :param R: 6x6 matrix
+    :return: 6x6 symplectic matrix
+    """
+    I = np.eye(6)
+    # tau = -c*dt in ocelot, the sign of the longitudinal block of J is opposite to (x, px) and (y, py)
+    J = np.zeros((6, 6))
+    for i in range(0, 6, 2):
+        J[i, i + 1] = 1.
+        J[i + 1, i] = -1.
+    J[4:, 4:] = -J[4:, 4:]
+    V = np.dot(I - R, np.linalg.inv(I + R))
+    S = -np.dot(J, V)
+    V = np.dot(J, 0.5 * (S + S.T))
+    return np.dot(I - V, np.linalg.inv(I + V))
+
+
+class TaylorMap(TransferMap):
+    """
+    Taylor map of a sequence of the transfer maps (e.g. one-turn map of a ring) for a fixed initial energy.
+    The map is applied to the particles as a polynomial of the order 'order'.
+    If the energy of the particles differs from the energy of the map the maps of the elements
+    are applied one by one.
+    """
+    def __init__(self, t_maps, energy=0., order=3, symplectic=False):
+        """
+        :param t_maps: list of transfer maps
+        :param energy: initial energy
+        :param order: order of the Taylor map
+        :param symplectic: if True the linear part of the map is symplectified (see symplectify())
+        """
+        TransferMap.__init__(self)
+        self.t_maps = t_maps
+        self.energy = energy
+        self.order = order
+        self.algebra = TPSA.get(order=order)
+        self.length = sum([tm.length for tm in t_maps])
+        self.delta_e = sum([tm.delta_e for tm in t_maps])
+
+        C = self.algebra.identity()
+        E = energy
+        for tm in t_maps:
+            C = tps_transfer_map(self.algebra, tm, C, E)
+            E += tm.delta_e
+        if symplectic:
+            C[:, 1:7] = symplectify(C[:, 1:7])
+        self.coef = C
+        self.R = lambda energy: self.coef[:, 1:7]
+        self.B = lambda energy: self.coef[:, :1]
+        self.map = lambda X, energy: self.taylor_map(X, energy)
+
+    def taylor_map(self, X, energy):
+        if abs(energy - self.energy) > 1e-10:
+            for tm in self.t_maps:
+                tm.map(X, energy)
+                energy += tm.delta_e
+            return X
+        X[:] = self.algebra.evaluate(self.coef, X)
+        return X
+
+    def __call__(self, s):
+        _logger.error(" TaylorMap.__call__: Taylor map can not be sliced")
+        raise Exception(" TaylorMap.__call__: Taylor map can not be sliced")
+
+
+def one_turn_map(lattice, energy=0., order=3, symplectic=False):
+    """
+    Taylor map of the whole lattice
+
+    :param lattice: MagneticLattice
+    :param energy: beam energy
+    :param order: order of the map
+    :param symplectic: if True the linear part of the map is symplectified
+    :return: TaylorMap
+    """
+    t_maps = get_map(lattice, lattice.totalLen, Navigator(lattice))
+    return TaylorMap(t_maps, energy=energy, order=order, symplectic=symplectic)
@@ -4,11 +4,13 @@ from ocelot.cpbd.optics import *
 from ocelot.cpbd.beam import *
 from ocelot.cpbd.errors import *
 from ocelot.cpbd.elements import *
+from ocelot.cpbd.tpsa import one_turn_map
 from time import time
 from scipy.stats import truncnorm
 import copy
 import sys
 import logging
+import multiprocessing
 
 _logger = logging.getLogger(__name__)
 
@@ -18,6 +20,21 @@ try:
 except:
     extrema_chk = 0
 
+try:
+    import h5py
+    h5py_avail = True
+except:
+    _logger.debug(" track.py: module h5py is not installed. Install it if you want to use HDF5 TurnRecorder")
+    h5py_avail = False
+
+try:
+    from concurrent.futures import ProcessPoolExecutor
+    from multiprocessing import shared_memory
+    shared_memory_avail = True
+except:
+    _logger.debug(" track.py: multiprocessing.shared_memory is not available. track_nturns_pool() is disabled")
+    shared_memory_avail = False
+
 def aperture_limit(lat, xlim = 1, ylim = 1):
     tws=twiss(lat, Twiss(), nPoints=1000)
     bxmax = max([tw.beta_x for tw in tws])
@@ -121,24 +138,200 @@ def harmonic_position(data1D, nu = None, diap = 0.1, nearest = False):
     return nearest_nu
 
 
-def freq_analysis(track_list, lat, nturns, harm=True, diap=0.10, nearest=False, nsuperperiods=1):
+def _goertzel(XW, f):
+    """
+    absolute value of the Fourier integral of the columns of XW at the frequencies f (Goertzel algorithm)
 
-    def beta_freq(lat):
+    :param XW: array (nturns, n) of the windowed data
+    :param f: array (n) or (m, n) of the frequencies
+    :return: array of the shape of f
+    """
+    c = 2.*np.cos(2.*np.pi*f)
+    s1 = np.zeros(c.shape)
+    s2 = np.zeros(c.shape)
+    for a in XW:
+        s = c*s1
+        s -= s2
+        s += a
+        s2 = s1
+        s1 = s
+    return np.sqrt(np.maximum(s1**2 + s2**2 - c*s1*s2, 0.))
+
+
+def naff(data, nu=None, diap=0.1, niter=2, block=2**22):
+    """
+    numerical analysis of the fundamental frequencies (NAFF) of the turn by turn data of all particles at once.
+    The data are windowed by the Hanning window, the highest peak of the spectrum is interpolated between
+    the FFT bins and refined by the maximization of the windowed Fourier integral.
+
+    :param data: array (nturns, n) of the coordinate of n particles or array (nturns) of one particle
+    :param nu: None - the highest harmonic, otherwise the highest harmonic in the range nu +/- diap
+    :param diap: half width of the range of the search around nu
+    :param niter: number of the iterations of the maximization
+    :param block: the FFT is done for blocks of about 'block' numbers to limit the memory
+    :return: tunes and amplitudes, arrays (n) or floats, NaN for the data with NaN (lost particles)
+    """
+    data = np.asarray(data, dtype=float)
+    X = data.reshape(len(data), -1)
+    N, n = X.shape
+    ids = np.flatnonzero(np.all(np.isfinite(X), axis=0))
+    f = np.full(n, np.nan)
+    amp = np.full(n, np.nan)
+    XW = X[:, ids] - np.mean(X[:, ids], axis=0)
+    XW *= (1. - np.cos(2.*np.pi*np.arange(N)/N))[:, np.newaxis]
+
+    freq = np.arange(N//2 + 1)/N
+    mask = freq > 0
+    if nu is not None:
+        mask &= np.abs(freq - nu) <= diap
+    f_ids = np.zeros(len(ids))
+    step = max(1, block//N)
+    for j in range(0, len(ids), step):
+        spec = np.abs(np.fft.rfft(XW[:, j:j + step].T))
+        cols = np.arange(len(spec))
+        i = np.argmax(np.where(mask, spec, -1.), axis=1)
+        i = np.clip(i, 1, len(freq) - 2)
+        a0, am, ap = spec[cols, i], spec[cols, i - 1], spec[cols, i + 1]
+        # interpolation of the peak of the Hanning window
+        right = ap > am
+        alpha = np.where(right, ap, am)/np.where(a0 > 0, a0, 1.)
+        delta = (2.*alpha - 1.)/(alpha + 1.)
+        f_ids[j:j + step] = (i + np.where(right, delta, -delta))/N
+
+    h = 0.1/N
+    for it in range(niter):
+        A = _goertzel(XW, f_ids + np.array([[-h], [0.], [h]]))
+        denom = A[0] - 2.*A[1] + A[2]
+        shift = 0.5*h*(A[0] - A[2])/np.where(denom < 0, denom, -np.inf)
+        f_ids += np.clip(shift, -h, h)
+        h *= 0.1
+    f[ids] = f_ids
+    amp[ids] = 2.*_goertzel(XW, f_ids)/N
+    if data.ndim == 1:
+        return f[0], amp[0]
+    return f, amp
+
+
+def naff_fma(x, y, nux=None, nuy=None, diap=0.1, niter=2, alive=None):
+    """
+    frequency map analysis of the turn by turn data by NAFF (see naff()).
+    The input arrays are rectangular, e.g. TurnRecorder.plane() (NaN after the loss) or Track_info.get_x()
+    of the particles which were not lost. The lost particles are excluded with the mask alive.
+
+    :param x: array (nturns, n) of the horizontal coordinate of n particles
+    :param y: array (nturns, n) of the vertical coordinate
+    :param nux: None - the highest harmonic, otherwise the highest harmonic in the range nux +/- diap
+    :param nuy: the same for the vertical plane
+    :param diap: half width of the range of the search around nux and nuy
+    :param niter: number of the iterations of the maximization
+    :param alive: None - all particles, otherwise boolean array (n,) of the particles tracked for all turns
+                (e.g. TurnRecorder.turn == nturns - 1), the results of the other particles are NaN
+    :return: mux, muy, diffusion, ax, ay - tunes and amplitudes for all turns and the tune diffusion
+            log10(sqrt(dmux**2 + dmuy**2)) between the first and the second half of the turns
+    """
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    if alive is not None:
+        alive = np.asarray(alive, dtype=bool)
+        results = []
+        for res in naff_fma(x[:, alive], y[:, alive], nux, nuy, diap, niter):
+            full = np.full(x.shape[1], np.nan)
+            full[alive] = res
+            results.append(full)
+        return tuple(results)
+    half = len(x)//2
+    mux, ax = naff(x, nux, diap, niter)
+    muy, ay = naff(y, nuy, diap, niter)
+    mux1, _ = naff(x[:half], nux, diap, niter)
+    muy1, _ = naff(y[:half], nuy, diap, niter)
+    mux2, _ = naff(x[half:2*half], nux, diap, niter)
+    muy2, _ = naff(y[half:2*half], nuy, diap, niter)
+    with np.errstate(divide="ignore"):
+        diffusion = np.log10(np.sqrt((mux2 - mux1)**2 + (muy2 - muy1)**2))
+    return mux, muy, diffusion, ax, ay
+
+
+def lattice_tunes(lat, nsuperperiods=1, verbose=True):
+    """
+    distances of the lattice tunes to the nearest integers, the centers of the harmonic search in freq_analysis()
 
-        tws = twiss(lat, Twiss())
-        nux = tws[-1].mux/2./pi*nsuperperiods
-        nuy = tws[-1].muy/2./pi*nsuperperiods
+    :param lat: MagneticLattice
+    :param nsuperperiods: number of the superperiods
+    :param verbose: if True the tunes are printed
+    :return: nux, nuy
+    """
+    tws = twiss(lat, Twiss())
+    nux = tws[-1].mux/2./pi*nsuperperiods
+    nuy = tws[-1].muy/2./pi*nsuperperiods
+    if verbose:
         print ("freq. analysis: Qx = ", nux, " Qy = ", nuy)
-        nux = abs(int(nux+0.5) - nux)
-        nuy = abs(int(nuy+0.5) - nuy)
+    nux = abs(int(nux+0.5) - nux)
+    nuy = abs(int(nuy+0.5) - nuy)
+    if verbose:
         print("freq. analysis: nux = ", nux)
         print("freq. analysis: nuy = ", nuy)
-        return nux, nuy
+    return nux, nuy
+
+
+def recorder_tunes(recorder, nturns, nux=None, nuy=None, diap=0.10, nearest=False, method="fft"):
+    """
+    tunes of the particles of the TurnRecorder which "lived" nturns, see freq_analysis()
+
+    :param recorder: TurnRecorder with x and y planes
+    :param nturns: number of turns
+    :param nux: None - the highest harmonic, otherwise the harmonic is searched in the range nux +/- diap
+    :param nuy: the same for the vertical plane
+    :param diap: half width of the range of the search
+    :param nearest: if True (method "fft") the nearest harmonic to nux, nuy is taken
+    :param method: "fft" - FFT spectrum of every particle, "naff" - NAFF for all particles at once (see naff())
+    :return: arrays mux, muy, -0.001 for the lost particles
+    """
+    mux = np.full(recorder.n, -0.001)
+    muy = np.full(recorder.n, -0.001)
+    x, y = recorder.plane(0), recorder.plane(2)
+    stable = np.flatnonzero(recorder.turn == nturns-1)
+    if method == "naff":
+        mux[stable] = naff(x[:, stable], nux, diap)[0]
+        muy[stable] = naff(y[:, stable], nuy, diap)[0]
+        return mux, muy
+    for n in stable:
+        mux[n] = harmonic_position(x[:, n], nux, diap, nearest)
+        muy[n] = harmonic_position(y[:, n], nuy, diap, nearest)
+    return mux, muy
+
+
+def freq_analysis(track_list, lat, nturns, harm=True, diap=0.10, nearest=False, nsuperperiods=1, method="fft"):
+    """
+    tunes of the particles which "lived" nturns from the turn by turn coordinates
+
+    :param track_list: list of Track_info tracked with save_track=True or TurnRecorder with x and y planes
+    :param lat: MagneticLattice
+    :param nturns: number of turns
+    :param harm: if True the highest harmonic near the tune of the lattice is searched
+    :param diap: half width of the range of the search around the tune of the lattice
+    :param nearest: if True (method "fft") the nearest harmonic to the tune of the lattice is taken
+    :param nsuperperiods: number of the superperiods
+    :param method: "fft" - FFT spectrum of every particle, "naff" - NAFF for all particles at once (see naff())
+    :return: track_list with Track_info.mux and Track_info.muy or arrays mux, muy for TurnRecorder
+    """
 
     nux, nuy = None, None
     if harm == True:
-        nux, nuy = beta_freq(lat)
+        nux, nuy = lattice_tunes(lat, nsuperperiods)
     #fma(pxy_list, nux = nux, nuy = nuy)
+    if track_list.__class__ == TurnRecorder:
+        # returns arrays mux, muy, -0.001 for the lost particles
+        return recorder_tunes(track_list, nturns, nux, nuy, diap, nearest, method)
+
+    if method == "naff":
+        stable = [pxy for pxy in track_list if pxy.turn == nturns-1 and len(pxy.p_list) > 1]
+        if len(stable) > 0:
+            mux = naff(np.array([pxy.get_x() for pxy in stable]).T, nux, diap)[0]
+            muy = naff(np.array([pxy.get_y() for pxy in stable]).T, nuy, diap)[0]
+            for pxy, mux_i, muy_i in zip(stable, mux, muy):
+                pxy.mux, pxy.muy = float(mux_i), float(muy_i)
+        return track_list
+
     for n, pxy in enumerate(track_list):
         if pxy.turn == nturns-1:
             if len(pxy.p_list) == 1:
@@ -153,6 +346,107 @@ def freq_analysis(track_list, lat, nturns, harm=True, diap=0.10, nearest=False,
     return track_list
 
 
+class TurnRecorder:
+    """
+    Turn by turn coordinates of the particles in the preallocated array data[record, plane, particle].
+    Record 0 is the initial coordinates, record k - the coordinates after the turn k*every - 1.
+    The coordinates of the lost particles are NaN after the loss.
+
+    The file of the memmap or hdf5 backend is written by flush() and closed by close() or at the end of the with block.
+
+    usage:
+        with TurnRecorder(n=len(track_list), nturns=1000, every=1, planes=[0, 2], filename="track.dat") as recorder:
+            track_list = track_nturns(lat, 1000, track_list, recorder=recorder)
+            x = recorder.plane(0)  # array (nrecords, n), x of all particles
+    """
+    def __init__(self, n, nturns, every=1, planes=None, filename=None, backend="memmap"):
+        """
+        :param n: number of the particles
+        :param nturns: number of the turns
+        :param every: the coordinates are saved every k-th turn
+        :param planes: indices of the saved coordinates (0 - x, 1 - px, 2 - y, 3 - py, 4 - tau, 5 - p),
+                        None - all coordinates
+        :param filename: None - the array is in memory, otherwise the array is in the file
+        :param backend: "memmap" - np.memmap, "hdf5" - h5py dataset "track"
+        """
+        self.n = n
+        self.every = every
+        self.planes = list(range(6)) if planes is None else list(planes)
+        self.file = None  # h5py.File of the hdf5 backend
+        shape = (nturns // every + 1, len(self.planes), n)
+        if filename is None:
+            self.data = np.full(shape, np.nan)
+        elif backend == "memmap":
+            self.data = np.memmap(filename, dtype=np.float64, mode="w+", shape=shape)
+            self.data[:] = np.nan
+        elif backend == "hdf5" and h5py_avail:
+            self.file = h5py.File(filename, "w")
+            self.data = self.file.create_dataset("track", shape=shape, dtype=np.float64, fillvalue=np.nan)
+        else:
+            raise ValueError(" TurnRecorder: unknown backend '" + str(backend) + "' or h5py is not installed")
+        self.n_records = np.zeros(n, dtype=int)  # number of the saved records of every particle
+        self.turn = np.zeros(n, dtype=int)  # the last turn when the particle was alive
+
+    def record(self, turn, ids, X):
+        """
+        :param turn: turn number, -1 for the initial coordinates
+        :param ids: indices of the particles
+        :param X: array (6, len(ids)) of the coordinates
+        """
+        if (turn + 1) % self.every != 0:
+            return
+        k = (turn + 1) // self.every
+        if isinstance(self.data, np.ndarray):
+            self.data[k][:, ids] = X[self.planes]
+        else:
+            row = np.full((len(self.planes), self.n), np.nan)
+            row[:, ids] = X[self.planes]
+            self.data[k] = row
+        self.n_records[ids] = k + 1
+
+    def plane(self, plane):
+        """
+        :param plane: 0 - x, 1 - px, 2 - y, 3 - py, 4 - tau, 5 - p
+        :return: array (nrecords, n) of the coordinate of all particles
+        """
+        return self.data[:, self.planes.index(plane)]
+
+    def particle(self, index, plane=None):
+        """
+        :param index: index of the particle
+        :param plane: None - all saved planes, otherwise the index of the coordinate
+        :return: saved records of the particle, array (nrecords, nplanes) or (nrecords) for the plane
+        """
+        if plane is None:
+            return self.data[:self.n_records[index], :, index]
+        return self.data[:self.n_records[index], self.planes.index(plane), index]
+
+    def flush(self):
+        """
+        writes the saved records to the file of the memmap or hdf5 backend
+        """
+        if isinstance(self.data, np.memmap):
+            self.data.flush()
+        elif self.file is not None:
+            self.file.flush()
+
+    def close(self):
+        """
+        flushes and closes the file. The data of the hdf5 backend is not available after closing,
+        the memmap array can still be read.
+        """
+        self.flush()
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
 class Track_info:
     def __init__(self, particle, x=0., y=0.):
         self.particle = particle
@@ -188,21 +482,25 @@ def contour_da(track_list, nturns, lvl = 0.9):
     elif lvl<=0:
         lvl = 1
 
-    ctr_da = []
-    for pxy in track_list:
-        if pxy.turn >= lvl*(nturns-1):
-            ctr_da.append(nturns)
-        else:
-            ctr_da.append(0)
-    return np.array(ctr_da)
+    return np.where(turns_alive(track_list) >= lvl*(nturns-1), nturns, 0)
 
 def stable_particles(track_list, nturns):
-    pxy_list_sbl = []
-    for pxy in track_list:
-        if pxy.turn >= nturns-1:
-            pxy_list_sbl.append(pxy)
+    """
+    :return: particles which "lived" nturns, for TurnRecorder - indices of the particles
+    """
+    stable = turns_alive(track_list) >= nturns-1
+    if track_list.__class__ == TurnRecorder:
+        return np.flatnonzero(stable)
+    return np.array(track_list)[stable]
 
-    return np.array(pxy_list_sbl)
+def turns_alive(track_list):
+    """
+    :param track_list: list of Track_info or TurnRecorder
+    :return: array of the last turns when the particles were alive
+    """
+    if track_list.__class__ == TurnRecorder:
+        return track_list.turn
+    return np.array([pxy.turn for pxy in track_list])
 
 def phase_space_transform(x,y, tws):
     """
@@ -254,32 +552,75 @@ def ellipse_track_list(beam, n_t_sigma = 3, num = 1000, type = "contour"):
 
 
 
-def track_nturns(lat, nturns, track_list, nsuperperiods=1, save_track=True, print_progress=True):
+def track_nturns(lat, nturns, track_list, nsuperperiods=1, save_track=True, print_progress=True, tpsa_order=None,
+                 compact_threshold=0.2, recorder=None):
+    """
+    tracking of the particles for nturns
+
+    :param lat: MagneticLattice
+    :param nturns: number of turns
+    :param track_list: list of Track_info (see create_track_list())
+    :param nsuperperiods: number of the superperiods
+    :param save_track: if True the coordinates after every turn are saved
+    :param print_progress: if True the number of the turn is printed
+    :param tpsa_order: None - element by element tracking, otherwise the order of the one-turn Taylor map
+                        which is used instead (see ocelot.cpbd.tpsa)
+    :param compact_threshold: lost particles are removed from the particle array when their fraction exceeds
+                        the threshold (see ParticleArray.compact())
+    :param recorder: TurnRecorder for save_track=True. If None the coordinates are saved in memory and appended
+                        to Track_info.p_list as the views of the recorder array, otherwise p_list is not changed
+    :return: track_list
+    """
     xlim, ylim, px_lim, py_lim = aperture_limit(lat, xlim = 1, ylim = 1)
     navi = Navigator(lat)
 
-    t_maps = get_map(lat, lat.totalLen, navi)
     track_list_const = copy.copy(track_list)
     p_array = ParticleArray()
     p_list = [p.particle for p in track_list]
     p_array.list2array(p_list)
 
+    if tpsa_order is not None:
+        t_maps = [one_turn_map(lat, energy=p_array.E, order=tpsa_order)]
+    else:
+        if lat.plan is not None:
+            lat.plan.update()
+        t_maps = get_map(lat, lat.totalLen, navi, plan=lat.plan)
+
+    # lost particles stay in p_array until their fraction exceeds compact_threshold, see ParticleArray.mark_lost()
+    p_array.compact_threshold = compact_threshold
+    eid = lat.sequence[-1].id
+    turns = np.array([pxy.turn for pxy in track_list_const])
+    own_recorder = save_track and recorder is None
+    if own_recorder:
+        recorder = TurnRecorder(len(track_list_const), nturns)
+    if save_track:
+        recorder.record(-1, p_array.particle_ids(), p_array.rparticles)
     for i in range(nturns):
         if print_progress: print(i)
         for n in range(nsuperperiods):
             for tm in t_maps:
                 tm.apply(p_array)
-            p_indx = p_array.rm_tails(xlim, ylim, px_lim, py_lim)
-
-            track_list = np.delete(track_list, p_indx)
-        for n, pxy in enumerate(track_list):
-            pxy.turn = i
-            if save_track:
-                pxy.p_list.append(p_array.rparticles[:, n])
+            p_array.rm_tails(xlim, ylim, px_lim, py_lim, turn=i, eid=eid)
+
+        alive = p_array.alive_mask()
+        ids = p_array.particle_ids()[alive]
+        turns[ids] = i
+        if save_track:
+            recorder.record(i, ids, p_array.rparticles[:, alive])
+    for pxy, turn in zip(track_list_const, turns):
+        pxy.turn = int(turn)
+    if save_track:
+        recorder.turn[:] = turns
+        if own_recorder:
+            for k, pxy in enumerate(track_list_const):
+                pxy.p_list.extend(recorder.particle(k)[1:])
+            recorder.close()
+        else:
+            recorder.flush()
     return np.array(track_list_const)
 
 
-def track_nturns_mpi(mpi_comm, lat, nturns, track_list, errors=None, nsuperperiods=1, save_track=True):
+def track_nturns_mpi(mpi_comm, lat, nturns, track_list, errors=None, nsuperperiods=1, save_track=True, tpsa_order=None):
     size = mpi_comm.Get_size()
     rank = mpi_comm.Get_rank()
     lat_copy = create_copy(lat, nsuperperiods = nsuperperiods)
@@ -305,7 +646,7 @@ def track_nturns_mpi(mpi_comm, lat, nturns, track_list, errors=None, nsuperperio
         # but for nturns = 1000 program crashes with error in mpi_comm.gather()
         # the same situation if treads not so much - solution increase number of treads.
         print("nsuperperiods = ", nsuperperiods)
-        track_list = track_nturns(lat, nturns, track_list, nsuperperiods, save_track=save_track)
+        track_list = track_nturns(lat, nturns, track_list, nsuperperiods, save_track=save_track, tpsa_order=tpsa_order)
         return track_list
 
     if rank == 0:
@@ -322,7 +663,7 @@ def track_nturns_mpi(mpi_comm, lat, nturns, track_list, errors=None, nsuperperio
     track_list = mpi_comm.scatter(chunks_track_list, root=0)
     print(" scatter time = ", time() - start, " sec, rank = ", rank, "  len(pxy_list) = ", len(track_list) )
     start = time()
-    track_list = track_nturns(lat, nturns, track_list, nsuperperiods, save_track =save_track)
+    track_list = track_nturns(lat, nturns, track_list, nsuperperiods, save_track=save_track, tpsa_order=tpsa_order)
     print( " scanning time = ", time() - start, " sec, rank = ", rank)
     start = time()
     out_track_list = mpi_comm.gather(track_list, root=0)
@@ -339,12 +680,12 @@ def track_nturns_mpi(mpi_comm, lat, nturns, track_list, errors=None, nsuperperio
 
 
 
-def fma(lat, nturns, x_array, y_array, nsuperperiods = 1):
+def fma(lat, nturns, x_array, y_array, nsuperperiods = 1, tpsa_order=None):
     from mpi4py import MPI
     mpi_comm = MPI.COMM_WORLD
     rank = mpi_comm.Get_rank()
     track_list = create_track_list(x_array, y_array, p_array=[0])
-    track_list = track_nturns_mpi(mpi_comm, lat, nturns, track_list, nsuperperiods=nsuperperiods)
+    track_list = track_nturns_mpi(mpi_comm, lat, nturns, track_list, nsuperperiods=nsuperperiods, tpsa_order=tpsa_order)
     if rank == 0:
         nx = len(x_array)
         ny = len(y_array)
@@ -356,13 +697,14 @@ def fma(lat, nturns, x_array, y_array, nsuperperiods = 1):
         return ctr_da.reshape(ny,nx), da_mux.reshape(ny,nx), da_muy.reshape(ny,nx)
 
 
-def da_mpi(lat, nturns, x_array, y_array, errors=None, nsuperperiods=1):
+def da_mpi(lat, nturns, x_array, y_array, errors=None, nsuperperiods=1, tpsa_order=None):
     from mpi4py import MPI
     mpi_comm = MPI.COMM_WORLD
     rank = mpi_comm.Get_rank()
 
     track_list = create_track_list(x_array, y_array, p_array=[0])
-    track_list = track_nturns_mpi(mpi_comm, lat, nturns, track_list, errors=errors, nsuperperiods=nsuperperiods, save_track=False)
+    track_list = track_nturns_mpi(mpi_comm, lat, nturns, track_list, errors=errors, nsuperperiods=nsuperperiods, save_track=False,
+                                  tpsa_order=tpsa_order)
 
     if rank == 0:
         da = np.array(map(lambda track: track.turn, track_list))#.reshape((len(y_array), len(x_array)))
@@ -371,19 +713,160 @@ def da_mpi(lat, nturns, x_array, y_array, errors=None, nsuperperiods=1):
         return da.reshape(ny, nx)
 
 
-def tracking_step(lat, particle_list, dz, navi):
+_pool_worker = {}
+
+
+def _pool_init(sequence, method, nturns, nsuperperiods, tpsa_order, energy, tunes, names, n):
+    """
+    initializer of the worker process of track_nturns_pool(). The lattice is built once per worker
+    and the shared arrays are attached. The lattice tunes for the frequency analysis are calculated in the parent.
+    """
+    shms = [shared_memory.SharedMemory(name=name) for name in names]
+    _pool_worker.update(lat=MagneticLattice(sequence, method=method), nturns=nturns, nsuperperiods=nsuperperiods,
+                        tpsa_order=tpsa_order, energy=energy, tunes=tunes, shms=shms,
+                        X=np.ndarray((6, n), dtype=np.float64, buffer=shms[0].buf),
+                        turns=np.ndarray(n, dtype=np.int64, buffer=shms[1].buf),
+                        mu=np.ndarray((2, n), dtype=np.float64, buffer=shms[2].buf))
+
+
+def _pool_track(start, stop, freq):
+    """
+    tracking of the particles [start:stop] of the shared array in the worker process
+    """
+    w = _pool_worker
+    track_list = []
+    for x, px, y, py, tau, p in w["X"][:, start:stop].T:
+        track_list.append(Track_info(Particle(x=x, px=px, y=y, py=py, tau=tau, p=p, E=w["energy"]), x, y))
+    recorder = TurnRecorder(len(track_list), w["nturns"], planes=[0, 2]) if freq else None
+    track_list = track_nturns(w["lat"], w["nturns"], track_list, w["nsuperperiods"], save_track=freq,
+                              print_progress=False, tpsa_order=w["tpsa_order"], recorder=recorder)
+    w["turns"][start:stop] = [pxy.turn for pxy in track_list]
+    if freq:
+        w["mu"][:, start:stop] = recorder_tunes(recorder, w["nturns"], *w["tunes"])
+        recorder.close()
+    return stop - start
+
+
+def track_nturns_pool(lat, nturns, track_list, errors=None, nsuperperiods=1, tpsa_order=None, freq=False,
+                      workers=None, nchunks=None):
+    """
+    tracking of the particles for nturns in the local process pool, the alternative to track_nturns_mpi()
+    which does not need MPI. The particles are split into chunks, the initial coordinates, the turns and the tunes
+    are exchanged through the shared memory, the lattice is built once per worker.
+    On the platforms where the processes are spawned the call must be protected by if __name__ == "__main__".
+
+    :param lat: MagneticLattice
+    :param nturns: number of turns
+    :param track_list: list of Track_info (see create_track_list())
+    :param errors: dictionary of the errors (see errors_seed())
+    :param nsuperperiods: number of the superperiods
+    :param tpsa_order: None - element by element tracking, otherwise the order of the one-turn Taylor map
+    :param freq: if True the tunes are calculated in the workers (see recorder_tunes()) around the lattice tunes
+                    calculated once in this process and saved in Track_info.mux and Track_info.muy
+    :param workers: number of the worker processes, None - number of CPUs
+    :param nchunks: number of the chunks of the particles, None - 4*workers
+    :return: track_list, the coordinates after every turn are not saved
+    """
+    if not shared_memory_avail:
+        raise ImportError(" track_nturns_pool: multiprocessing.shared_memory (python >= 3.8) is needed")
+    workers = multiprocessing.cpu_count() if workers is None else workers
+    nchunks = 4*workers if nchunks is None else nchunks
+
+    if errors is not None:
+        lat = create_copy(lat, nsuperperiods=nsuperperiods)
+        nsuperperiods = 1
+        errors_seed(lat, errors)
+    # transfer maps are not picklable, they are created again in the workers
+    copies = {}
+    for elem in lat.sequence:
+        if id(elem) not in copies:
+            copies[id(elem)] = copy.copy(elem)
+            copies[id(elem)].__dict__.pop("transfer_map", None)
+    sequence = [copies[id(elem)] for elem in lat.sequence]
+
+    n = len(track_list)
+    sizes = [6*n*8, n*8, 2*n*8]
+    shms = [shared_memory.SharedMemory(create=True, size=max(size, 1)) for size in sizes]
+    try:
+        X = np.ndarray((6, n), dtype=np.float64, buffer=shms[0].buf)
+        turns = np.ndarray(n, dtype=np.int64, buffer=shms[1].buf)
+        mu = np.ndarray((2, n), dtype=np.float64, buffer=shms[2].buf)
+        for i, pxy in enumerate(track_list):
+            p = pxy.particle
+            X[:, i] = [p.x, p.px, p.y, p.py, p.tau, p.p]
+        turns[:] = [pxy.turn for pxy in track_list]
+        mu[:] = -0.001
+        energy = track_list[0].particle.E if n > 0 else 0.
+        tunes = lattice_tunes(lat, nsuperperiods, verbose=False) if freq else (None, None)
+        _logger.debug(" track_nturns_pool: nux, nuy = " + str(tunes))
+
+        bounds = np.linspace(0, n, num=min(nchunks, n) + 1).astype(int)
+        initargs = (sequence, lat.method, nturns, nsuperperiods, tpsa_order, energy, tunes,
+                    [shm.name for shm in shms], n)
+        start = time()
+        with ProcessPoolExecutor(max_workers=workers, initializer=_pool_init, initargs=initargs) as executor:
+            futures = [executor.submit(_pool_track, i1, i2, freq) for i1, i2 in zip(bounds[:-1], bounds[1:])]
+            for future in futures:
+                future.result()
+        _logger.debug(" track_nturns_pool: scanning time = " + str(time() - start) + " sec, workers = " + str(workers))
+
+        for i, pxy in enumerate(track_list):
+            pxy.turn = int(turns[i])
+            if freq:
+                pxy.mux, pxy.muy = float(mu[0, i]), float(mu[1, i])
+        del X, turns, mu
+    finally:
+        for shm in shms:
+            shm.close()
+            shm.unlink()
+    return track_list
+
+
+def da_pool(lat, nturns, x_array, y_array, errors=None, nsuperperiods=1, tpsa_order=None, workers=None):
+    """
+    dynamic aperture in the local process pool (see track_nturns_pool())
+
+    :return: array (len(y_array), len(x_array)) of the last turns when the particles were alive
+    """
+    track_list = create_track_list(x_array, y_array, p_array=[0])
+    track_list = track_nturns_pool(lat, nturns, track_list, errors=errors, nsuperperiods=nsuperperiods,
+                                   tpsa_order=tpsa_order, workers=workers)
+    return turns_alive(track_list).reshape(len(y_array), len(x_array))
+
+
+def fma_pool(lat, nturns, x_array, y_array, nsuperperiods=1, tpsa_order=None, workers=None):
+    """
+    frequency map analysis in the local process pool (see track_nturns_pool())
+
+    :return: contour_da, mux, muy - arrays (len(y_array), len(x_array))
+    """
+    track_list = create_track_list(x_array, y_array, p_array=[0])
+    track_list = track_nturns_pool(lat, nturns, track_list, nsuperperiods=nsuperperiods, tpsa_order=tpsa_order,
+                                   freq=True, workers=workers)
+    shape = (len(y_array), len(x_array))
+    da_mux = np.array([pxy.mux for pxy in track_list])
+    da_muy = np.array([pxy.muy for pxy in track_list])
+    return contour_da(track_list, nturns).reshape(shape), da_mux.reshape(shape), da_muy.reshape(shape)
+
+
+def tracking_step(lat, particle_list, dz, navi, update_plan=True):
     """
-    tracking for a fixed step dz
+    tracking for a fixed step dz. If the lattice was compiled (see MagneticLattice.compile()) the fused maps
+    of the plan are used.
     :param lat: Magnetic Lattice
     :param particle_list: ParticleArray or Particle list
     :param dz: step in [m]
     :param navi: Navigator
+    :param update_plan: if True the plan of the compiled lattice is updated before the step (see TrackingPlan.update()),
+                        track() updates it once before the first step
     :return: None
     """
     if navi.z0 + dz > lat.totalLen:
         dz = lat.totalLen - navi.z0
 
-    t_maps = get_map(lat, dz, navi)
+    if lat.plan is not None and update_plan:
+        lat.plan.update()
+    t_maps = get_map(lat, dz, navi, plan=lat.plan)
     for tm in t_maps:
         start = time()
         tm.apply(particle_list)
@@ -392,38 +875,73 @@ def tracking_step(lat, particle_list, dz, navi):
     return
 
 
+def apply_phys_proc(proc, p_array, dz):
+    """
+    applies the physics process to the ParticleArray. If the ParticleArray is the ensemble of bunches
+    (see ensemble_array()) and proc.per_bunch is True the process is applied to every bunch separately.
+
+    :param proc: PhysProc
+    :param p_array: ParticleArray
+    :param dz: step
+    :return: None
+    """
+    # the physics processes see only the alive particles, the lost ones are removed regardless of compact_threshold
+    p_array.compact(threshold=0.)
+    if p_array.bunch_ids is None or not proc.per_bunch:
+        proc.apply(p_array, dz)
+        return
+    alive = p_array.alive_mask()
+    for inds in p_array.bunch_indices():
+        if not np.any(alive[inds]):
+            continue
+        bunch = p_array.sub_array(inds)
+        proc.apply(bunch, dz)
+        p_array.set_sub_array(inds, bunch)
+    p_array.compact()
+
+
 def track(lattice, p_array, navi, print_progress=True, calc_tws=True, bounds=None):
     """
     tracking through the lattice
 
     :param lattice: Magnetic Lattice
-    :param p_array: ParticleArray
+    :param p_array: ParticleArray. If it is the ensemble of bunches (see ensemble_array()) all bunches are
+                    tracked in one sweep, the physics processes are applied to every bunch separately
     :param navi: Navigator
     :param print_progress: True, print tracking progress
     :param calc_tws: True, during the tracking twiss parameters are calculated from the beam distribution
     :param bounds: None, optional, [left_bound, right_bound] - bounds in units of std(p_array.tau())
     :return: twiss_list, ParticleArray. In case calc_tws=False, twiss_list is list of empty Twiss classes.
+            For the ensemble of bunches twiss_list is the list of TwissTable of every bunch.
     """
-
-    tw0 = get_envelope(p_array, bounds=bounds) if calc_tws else Twiss()
-    tws_track = [tw0]
+    if lattice.plan is not None:
+        # the plan is updated once, the elements changed during the tracking require lattice.plan.update()
+        lattice.plan.update()
+    ensemble = p_array.bunch_ids is not None
+    if ensemble:
+        envelope = lambda p_array: get_envelopes(p_array, bounds=bounds) if calc_tws else \
+            [Twiss() for i in range(p_array.n_bunches())]
+    else:
+        envelope = lambda p_array: get_envelope(p_array, bounds=bounds) if calc_tws else Twiss()
+    tws_track = [envelope(p_array)]
     L = 0.
 
     while np.abs(navi.z0 - lattice.totalLen) > 1e-10:
         if navi.kill_process:
             _logger.info("Killing tracking ... ")
-            return tws_track, p_array
+            break
 
         dz, proc_list, phys_steps = navi.get_next()
-        tracking_step(lat=lattice, particle_list=p_array, dz=dz, navi=navi)
+        tracking_step(lat=lattice, particle_list=p_array, dz=dz, navi=navi, update_plan=False)
         #part = p_array[0]
         for p, z_step in zip(proc_list, phys_steps):
             p.z0 = navi.z0
-            p.apply(p_array, z_step)
+            apply_phys_proc(p, p_array, z_step)
         #p_array[0] = part
-        tw = get_envelope(p_array, bounds=bounds) if calc_tws else Twiss()
+        tw = envelope(p_array)
         L += dz
-        tw.s += L
+        for tw_i in (tw if ensemble else [tw]):
+            tw_i.s += L
         tws_track.append(tw)
 
         if print_progress:
@@ -431,10 +949,13 @@ def track(lattice, p_array, navi, print_progress=True, calc_tws=True, bounds=Non
             sys.stdout.write( "\r" + "z = " + str(navi.z0)+" / "+str(lattice.totalLen) + " : applied: " + ", ".join(poc_names)  )
             sys.stdout.flush()
 
-    # finalize PhysProcesses
-    for p in navi.get_phys_procs():
-        p.finalize()
+    if not navi.kill_process:
+        # finalize PhysProcesses
+        for p in navi.get_phys_procs():
+            p.finalize()
 
+    if ensemble:
+        tws_track = [TwissTable.from_list(tws_bunch) for tws_bunch in zip(*tws_track)]
     return tws_track, p_array
 
 
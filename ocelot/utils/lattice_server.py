@@ -0,0 +1,416 @@
+"""
+Warm tracking server. The long-lived local process holds the lattices together with the transfer maps,
+the caches of the matrices (tm_cache, map trees, compiled tracking plans) and the compiled kernels, and answers
+the twiss, tracking and matching requests of the clients (e.g. GUI or optimizer in the control room).
+
+The elements and the lattices registered at the server are sent as references, the parameters of the elements
+which were changed on the client side since the last request are sent as deltas before every call and the
+changes made by the server (e.g. by match()) are applied back to the client elements, so the calls look like
+the in-process calls:
+
+    client = start_server()
+    client.load(lat)
+    tws = client.twiss(lat, tws0)
+    Q1.k1 = 1.5                                 # only the parameters of Q1 are sent with the next request
+    tws = client.twiss(lat, tws0)
+    res = client.match(lat, constr, [Q1, Q2], tws0, verbose=False)     # Q1.k1 and Q2.k1 are updated
+    client.shutdown()
+
+The functions are sent by name (any importable function can be called with client.call(func, *args)),
+the in-place changes of the arrays of the elements are detected only after element.fingerprint(update=True).
+On the platforms where the processes are spawned start_server() must be protected by if __name__ == "__main__".
+
+Security: the requests are unpickled and client.call() runs any importable function, so a connected client can run
+any code with the rights of the server process. Only trusted clients may connect: the server does not start without
+a non-empty authentication key (start_server() generates a random one), share the key only with the trusted
+clients and do not expose the address outside of the machine.
+"""
+import io
+import os
+import pickle
+import logging
+import multiprocessing
+import traceback
+from time import time
+from multiprocessing.connection import Listener, Client
+
+from ocelot.cpbd.elements import Element
+from ocelot.cpbd.magnetic_lattice import MagneticLattice
+from ocelot.cpbd.optics import Navigator, twiss
+from ocelot.cpbd.track import track
+from ocelot.cpbd.match import match
+
+_logger = logging.getLogger(__name__)
+
+
+def element_params(element):
+    """
+    Public parameters of the element which are sent to the other side (transfer map and id are skipped).
+
+    :param element: Element
+    :return: dict
+    """
+    return {key: value for key, value in element.__dict__.items() if key[0] != "_" and key not in ("transfer_map", "id")}
+
+
+def lattice_copy(lattice):
+    """
+    Picklable copy of the sequence of the lattice. The transfer maps are not picklable, they are created again by
+    the server. The repeated elements stay the same objects.
+
+    :param lattice: MagneticLattice
+    :return: dict with the sequence and the method of the lattice
+    """
+    copies = {}
+    for element in lattice.sequence:
+        if id(element) not in copies:
+            copy = element.__class__.__new__(element.__class__)
+            copy.__dict__.update(element.__dict__)
+            copy.__dict__.pop("transfer_map", None)
+            copy.__dict__.pop("_fingerprint", None)
+            copies[id(element)] = copy
+    return {"sequence": [copies[id(element)] for element in lattice.sequence], "method": lattice.method}
+
+
+class LatticeRegistry:
+    """
+    Lattices registered on one side of the connection. The elements and the lattices are replaced by the references
+    (name of the lattice, index of the element) during pickling and resolved back during unpickling.
+    """
+    def __init__(self):
+        self.lattices = {}
+        self.lat_names = {}
+        self.elements = {}
+        self.fingerprints = {}
+
+    def add(self, name, lattice):
+        self.lattices[name] = lattice
+        self.lat_names[id(lattice)] = name
+        for index, element in enumerate(lattice.sequence):
+            self.elements.setdefault(id(element), (name, index))
+        self.fingerprints[name] = self.snapshot(name)
+
+    def remove(self, name):
+        lattice = self.lattices.pop(name)
+        del self.lat_names[id(lattice)]
+        del self.fingerprints[name]
+        self.elements = {key: ref for key, ref in self.elements.items() if ref[0] != name}
+
+    def unique_indices(self, name):
+        sequence = self.lattices[name].sequence
+        return [i for i, element in enumerate(sequence) if self.elements.get(id(element)) == (name, i)]
+
+    def snapshot(self, name):
+        sequence = self.lattices[name].sequence
+        return {i: sequence[i].fingerprint() for i in self.unique_indices(name)}
+
+    def changes(self):
+        """
+        Parameters of the elements changed since the last call, the fingerprints are updated.
+
+        :return: dict {name: {index: params}}
+        """
+        deltas = {}
+        for name, fingerprints in self.fingerprints.items():
+            sequence = self.lattices[name].sequence
+            for i, params in fingerprints.items():
+                fingerprint = sequence[i].fingerprint()
+                if fingerprint is not params and fingerprint != params:
+                    deltas.setdefault(name, {})[i] = element_params(sequence[i])
+                    fingerprints[i] = fingerprint
+        return deltas
+
+    def apply(self, deltas):
+        """
+        Sets the parameters of the elements and recreates the modified transfer maps.
+
+        :param deltas: dict {name: {index: params}}
+        """
+        for name, elements in deltas.items():
+            lattice = self.lattices[name]
+            for i, params in elements.items():
+                for key, value in params.items():
+                    setattr(lattice.sequence[i], key, value)
+                self.fingerprints[name][i] = lattice.sequence[i].fingerprint()
+            lattice.update_modified_maps()
+
+    def persistent_id(self, obj):
+        if isinstance(obj, Element):
+            ref = self.elements.get(id(obj))
+            return None if ref is None else ("element",) + ref
+        if isinstance(obj, MagneticLattice):
+            name = self.lat_names.get(id(obj))
+            return None if name is None else ("lattice", name)
+        if isinstance(obj, Navigator) and id(obj.lat) in self.lat_names:
+            procs = [(proc, proc.start_elem, proc.end_elem) for proc in obj.process_table.proc_list]
+            return ("navigator", obj.lat, obj.unit_step, procs)
+        return None
+
+    def persistent_load(self, pid):
+        if pid[0] == "lattice":
+            return self.lattices[pid[1]]
+        if pid[0] == "navigator":
+            navi = Navigator(pid[1])
+            navi.unit_step = pid[2]
+            for proc, elem1, elem2 in pid[3]:
+                navi.add_physics_proc(proc, elem1, elem2)
+            return navi
+        return self.lattices[pid[1]].sequence[pid[2]]
+
+    def dumps(self, obj):
+        buffer = io.BytesIO()
+        pickler = pickle.Pickler(buffer, protocol=pickle.HIGHEST_PROTOCOL)
+        pickler.persistent_id = self.persistent_id
+        pickler.dump(obj)
+        return buffer.getvalue()
+
+    def loads(self, data):
+        unpickler = pickle.Unpickler(io.BytesIO(data))
+        unpickler.persistent_load = self.persistent_load
+        return unpickler.load()
+
+
+def _match(lat, constr, vars, tw, **kwargs):
+    """
+    match() on the server side, the initial Twiss can be changed by match() and is returned as well
+    """
+    res = match(lat, constr, vars, tw, **kwargs)
+    return res, tw
+
+
+class LatticeServer:
+    """
+    State of the server: registered lattices with warm transfer maps and caches.
+    """
+    def __init__(self):
+        self.registry = LatticeRegistry()
+        self.ncalls = 0
+
+    def handle(self, request):
+        """
+        :param request: tuple (command, args)
+        :return: tuple (status, result) or None to stop the server
+        """
+        command = request[0]
+        if command == "ping":
+            return "ok", None
+        if command == "load":
+            name, data = request[1], request[2]
+            if name in self.registry.lattices:
+                self.registry.remove(name)
+            lattice = MagneticLattice(data["sequence"], method=data["method"])
+            self.registry.add(name, lattice)
+            return "ok", len(lattice.sequence)
+        if command == "drop":
+            self.registry.remove(request[1])
+            return "ok", None
+        if command == "call":
+            deltas, data = request[1], request[2]
+            self.registry.apply(deltas)
+            func, args, kwargs = self.registry.loads(data)
+            result = func(*args, **kwargs)
+            self.ncalls += 1
+            return "ok", (self.registry.dumps(result), self.registry.changes())
+        if command == "shutdown":
+            return None
+        raise ValueError("LatticeServer: unknown command " + str(command))
+
+
+def serve(address=None, authkey=None, conn=None):
+    """
+    Runs the server until the shutdown request. The clients are served one after another.
+
+    :param address: address of the Listener, None - the Unix socket (or the named pipe) is chosen automatically
+    :param authkey: bytes, authentication key of the connections, must not be empty
+    :param conn: Connection, the address of the Listener is sent through it
+    :return: None
+    """
+    if not authkey:
+        raise ValueError("serve: the lattice server runs the requests of the clients, authkey must not be empty")
+    server = LatticeServer()
+    with Listener(address, authkey=authkey) as listener:
+        _logger.info(" serve: lattice server is listening on " + str(listener.address))
+        if conn is not None:
+            conn.send(listener.address)
+            conn.close()
+        running = True
+        while running:
+            try:
+                client = listener.accept()
+            except (multiprocessing.AuthenticationError, EOFError, ConnectionError) as exc:
+                _logger.warning(" serve: connection is rejected: " + repr(exc))
+                continue
+            with client:
+                while True:
+                    try:
+                        request = pickle.loads(client.recv_bytes())
+                    except EOFError:
+                        break
+                    try:
+                        response = server.handle(request)
+                    except Exception as exc:
+                        _logger.warning(" serve: request " + str(request[0]) + " failed: " + repr(exc))
+                        try:
+                            error = pickle.dumps(exc)
+                        except Exception:
+                            error = pickle.dumps(RuntimeError(repr(exc)))
+                        response = "error", (error, traceback.format_exc())
+                    if response is None:
+                        client.send_bytes(pickle.dumps(("ok", None)))
+                        running = False
+                        break
+                    client.send_bytes(pickle.dumps(response, protocol=pickle.HIGHEST_PROTOCOL))
+    _logger.info(" serve: lattice server stopped")
+
+
+def start_server(address=None, authkey=None):
+    """
+    Starts the server in the new process and connects to it.
+
+    :param address: address of the Listener, None - chosen automatically
+    :param authkey: bytes, authentication key, None - random key
+    :return: LatticeClient
+    """
+    authkey = os.urandom(16) if authkey is None else authkey
+    if not authkey:
+        raise ValueError("start_server: authkey must not be empty")
+    parent_conn, child_conn = multiprocessing.Pipe(duplex=False)
+    process = multiprocessing.Process(target=serve, args=(address, authkey, child_conn), daemon=True)
+    process.start()
+    child_conn.close()
+    address = parent_conn.recv()
+    parent_conn.close()
+    return LatticeClient(address, authkey, process=process)
+
+
+class LatticeClient:
+    """
+    Client proxy of the lattice server. The methods twiss(), track() and match() have the signatures of
+    the in-process functions.
+    """
+    def __init__(self, address, authkey, process=None):
+        """
+        :param address: address of the server
+        :param authkey: bytes, authentication key
+        :param process: server process started by start_server()
+        """
+        self.conn = Client(address, authkey=authkey)
+        self.process = process
+        self.registry = LatticeRegistry()
+        self.latency = 0.
+        self.nloaded = 0
+
+    def request(self, *request):
+        start = time()
+        self.conn.send_bytes(pickle.dumps(request, protocol=pickle.HIGHEST_PROTOCOL))
+        status, result = pickle.loads(self.conn.recv_bytes())
+        self.latency = time() - start
+        if status == "error":
+            exc, tb = result
+            _logger.error(" LatticeClient: request " + str(request[0]) + " failed on the server:\n" + tb)
+            raise pickle.loads(exc)
+        return result
+
+    def ping(self):
+        """
+        :return: round trip time [sec]
+        """
+        self.request("ping")
+        return self.latency
+
+    def load(self, lattice, name=None):
+        """
+        Registers the lattice at the server. The lattice is registered automatically in the first call.
+
+        :param lattice: MagneticLattice
+        :param name: name of the lattice, None - generated
+        :return: name
+        """
+        if name is None:
+            name = self.registry.lat_names.get(id(lattice), "lat" + str(self.nloaded))
+        self.nloaded += 1
+        if name in self.registry.lattices:
+            self.registry.remove(name)
+        self.request("load", name, lattice_copy(lattice))
+        self.registry.add(name, lattice)
+        return name
+
+    def drop(self, lattice):
+        """
+        Removes the lattice from the server.
+
+        :param lattice: MagneticLattice
+        """
+        name = self.registry.lat_names[id(lattice)]
+        self.request("drop", name)
+        self.registry.remove(name)
+
+    def call(self, func, *args, **kwargs):
+        """
+        Calls func(*args, **kwargs) on the server. The function must be importable by the server (no lambdas).
+
+        :return: result of the function
+        """
+        for arg in list(args) + list(kwargs.values()):
+            if isinstance(arg, MagneticLattice):
+                name = self.registry.lat_names.get(id(arg))
+                if name is None or len(self.registry.lattices[name].sequence) != len(arg.sequence):
+                    self.load(arg, name)
+        data = self.registry.dumps((func, args, kwargs))
+        deltas = self.registry.changes()
+        data, changes = self.request("call", deltas, data)
+        self.registry.apply(changes)
+        return self.registry.loads(data)
+
+    def twiss(self, lattice, tws0=None, nPoints=None):
+        """
+        see ocelot.cpbd.optics.twiss()
+        """
+        return self.call(twiss, lattice, tws0, nPoints=nPoints)
+
+    def track(self, lattice, p_array, navi, print_progress=False, calc_tws=True, bounds=None):
+        """
+        see ocelot.cpbd.track.track(), p_array is updated in place, the state of navi is not changed
+        """
+        tws_track, p = self.call(track, lattice, p_array, navi, print_progress=print_progress, calc_tws=calc_tws,
+                                 bounds=bounds)
+        p_array.__dict__.update(p.__dict__)
+        return tws_track, p_array
+
+    def match(self, lat, constr, vars, tw, **kwargs):
+        """
+        see ocelot.cpbd.match.match(), the varied elements of the client are updated
+        """
+        res, tw_new = self.call(_match, lat, constr, vars, tw, **kwargs)
+        tw.__dict__.update(tw_new.__dict__)
+        return res
+
+    def close(self):
+        self.conn.close()
+
+    def shutdown(self):
+        """
+        Stops the server and closes the connection.
+        """
+        self.request("shutdown")
+        self.close()
+        if self.process is not None:
+            self.process.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        if self.process is not None:
+            self.shutdown()
+        else:
+            self.close()
+
+
+if __name__ == "__main__":
+    # python -m ocelot.utils.lattice_server <address> ; the authentication key is taken from OCELOT_SERVER_KEY
+    import sys
+    authkey = os.environ.get("OCELOT_SERVER_KEY", "").encode()
+    if not authkey:
+        sys.exit("lattice_server: OCELOT_SERVER_KEY must be set to the authentication key of the clients")
+    serve(sys.argv[1] if len(sys.argv) > 1 else None, authkey=authkey)
@@ -282,6 +282,28 @@ class SectionTrack:
 
         self.lattice.update_transfer_maps()
 
+    def longitudinal_scan(self, phi, v, particles=None):
+        """
+        Fast scan of the cavity settings (see update_cavity()). Only (tau, p) of the particles are tracked
+        for all settings at once (see LongitudinalLattice), LSC and wake processes are applied as lumped kicks.
+
+        :param phi: array of the phases [deg]
+        :param v: array of the voltages [GeV]
+        :param particles: ParticleArray, if None the beam is read from the input beam file
+        :return: tau, p, E - arrays (K, n), (K, n) and (K,) for K settings
+        """
+        if particles is None:
+            particles = self.read_beam_file()
+            if particles is None:
+                return None
+        cavities = [elem for elem in self.lattice.sequence if elem.__class__ == Cavity and
+                    (self.cav_name_pref is None or self.cav_name_pref in elem.id)]
+        long_lat = LongitudinalLattice(self.lattice)
+        for physics_process in self.physics_processes_array:
+            if ((physics_process[0].__class__ == LSC and self.sc_flag) or
+                    (physics_process[0].__class__ in [Wake, WakeKick] and self.wake_flag)):
+                long_lat.add_physics_proc(physics_process[0], physics_process[1], physics_process[2])
+        return long_lat.track(particles, v=v, phi=phi, cavities=cavities)
 
     def init_navigator(self):
 
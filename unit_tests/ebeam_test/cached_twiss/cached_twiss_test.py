@@ -0,0 +1,72 @@
+"""Test of the incremental recalculation of twiss and transfer map"""
+
+import os
+import sys
+import time
+
+FILE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+from unit_tests.params import *
+from cached_twiss_conf import *
+
+
+def test_cached_twiss_incremental(lattice, tws0):
+    """incremental recalculation of twiss and first order map after change of the element parameters"""
+
+    tws = lattice.cached_twiss(tws0)
+    beta_x_start = np.copy(tws.beta_x)
+    R_start, B_start = lattice.cached_transfer_map(tws0.E)
+
+    # the last quadrupole and bends are changed without update of the transfer maps
+    Qd.k1 = -1.25
+    B.angle = 0.06
+    tws = lattice.cached_twiss(tws0)
+    R, B_vec = lattice.cached_transfer_map(tws0.E)
+
+    lattice.update_transfer_maps()
+    tws_ref = twiss(lattice, tws0)
+    R_ref = lattice_transfer_map(lattice, tws0.E)
+    B_ref = lattice.B
+
+    Qd.k1 = -1.2
+    B.angle = 0.05
+    lattice.update_transfer_maps()
+
+    first = lattice.sequence.index(B) - 1
+    result1 = check_matrix(tws.beta_x, np.array([tw.beta_x for tw in tws_ref]), TOL, assert_info=' beta_x - ')
+    result2 = check_matrix(tws.muy, np.array([tw.muy for tw in tws_ref]), TOL, assert_info=' muy - ')
+    result3 = check_matrix(tws.Dx, np.array([tw.Dx for tw in tws_ref]), TOL, 'absotute', assert_info=' Dx - ')
+    result4 = check_matrix(R, R_ref, TOL, 'absotute', assert_info=' R - ')
+    result5 = check_matrix(B_vec, B_ref, TOL, 'absotute', assert_info=' B - ')
+    result6 = check_matrix(tws.beta_x[:first + 1], beta_x_start[:first + 1], TOL, assert_info=' upstream beta_x - ')
+    assert check_result(result1 + result2 + result3 + result4 + result5 + result6)
+    assert np.max(np.abs(R - R_start)) > 1e-3
+
+
+def setup_module(module):
+
+    f = open(pytest.TEST_RESULTS_FILE, 'a')
+    f.write('### CACHED TWISS START ###\n\n')
+    f.close()
+
+
+def teardown_module(module):
+
+    f = open(pytest.TEST_RESULTS_FILE, 'a')
+    f.write('### CACHED TWISS END ###\n\n\n')
+    f.close()
+
+
+def setup_function(function):
+
+    f = open(pytest.TEST_RESULTS_FILE, 'a')
+    f.write(function.__name__)
+    f.close()
+
+    pytest.t_start = time.time()
+
+
+def teardown_function(function):
+    f = open(pytest.TEST_RESULTS_FILE, 'a')
+    f.write(' execution time is ' + '{:.3f}'.format(time.time() - pytest.t_start) + ' sec\n\n')
+    f.close()
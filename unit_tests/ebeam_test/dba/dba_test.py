@@ -9,6 +9,7 @@ REF_RES_DIR = FILE_DIR + '/ref_results/'
 
 from unit_tests.params import *
 from dba_conf import *
+from ocelot.cpbd.optics import twiss_z
 
 
 def test_lattice_transfer_map(lattice, update_ref_values=False):
@@ -41,6 +42,55 @@ def test_twiss(lattice, update_ref_values=False):
     assert check_result(result)
 
 
+def test_twiss_table(lattice, update_ref_values=False):
+    """Vectorized twiss calculation test, reference is twiss()"""
+
+    tws_table = twiss_table(lattice, Twiss())
+    tws_ref = twiss(lattice, Twiss())
+
+    result = check_dict(obj2dict(tws_table.to_list()), obj2dict(tws_ref), TOL, 'absotute', assert_info=' tws - ')
+    result2 = check_matrix(tws_table.beta_x, np.array([tw.beta_x for tw in tws_ref]), TOL, assert_info=' beta_x - ')
+    assert check_result(result + result2)
+    assert len(tws_table) == len(tws_ref)
+    assert tws_table[-1].id == tws_ref[-1].id
+
+
+def test_twiss_chromatic(lattice, update_ref_values=False):
+    """Twiss for many momentum offsets test, references are twiss_table() and lattice with scaled quadrupoles"""
+
+    tws_chrom = twiss_chromatic(lattice, Twiss(), deltas=[0., 0.01])
+    tws_ref = twiss_table(lattice, Twiss())
+    result = check_dict(obj2dict(tws_chrom[0].to_list()), obj2dict(tws_ref.to_list()), TOL, 'absotute',
+                        assert_info=' tws - ')
+
+    delta = 0.01
+    quads = [Quadrupole(l=q.l, k1=q.k1) for q in (Q1, Q2, Q3, Q4)]
+    quads_scaled = [Quadrupole(l=q.l, k1=q.k1 / (1. + delta)) for q in (Q1, Q2, Q3, Q4)]
+    lat = MagneticLattice((D1, quads[0], D2, quads[1], D3, quads[2], D4, quads[3], D4, quads[2], D3, quads[1], D2,
+                           quads[0], D1))
+    lat_scaled = MagneticLattice((D1, quads_scaled[0], D2, quads_scaled[1], D3, quads_scaled[2], D4, quads_scaled[3],
+                                  D4, quads_scaled[2], D3, quads_scaled[1], D2, quads_scaled[0], D1))
+    tws0 = Twiss()
+    tws0.beta_x, tws0.beta_y = 10., 5.
+    tws_chrom = twiss_chromatic(lat, tws0, deltas=[delta])
+    tws_scaled = twiss_table(lat_scaled, tws0)
+    result2 = check_dict(obj2dict(tws_chrom[0].to_list()), obj2dict(tws_scaled.to_list()), TOL, 'absotute',
+                         assert_info=' tws delta - ')
+    assert check_result(result + result2)
+
+
+def test_twiss_z(lattice, update_ref_values=False):
+    """Vectorized sampling of twiss parameters within element test, reference is sliced transfer map"""
+
+    tws0 = twiss(lattice, Twiss())[0]
+    z = np.linspace(0, B.l, num=7, endpoint=True)
+    tws_z = twiss_z(B.transfer_map, tws0, z)
+    tws_ref = [B.transfer_map(zi) * tws0 for zi in z]
+
+    result = check_dict(obj2dict(tws_z.to_list()), obj2dict(tws_ref), TOL, 'absotute', assert_info=' tws - ')
+    assert check_result(result)
+
+
 def test_lattice_transfer_map_after_matching(lattice, update_ref_values=False):
     """After matching R maxtrix calculcation test"""
     
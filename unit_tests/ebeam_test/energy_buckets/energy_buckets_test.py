@@ -0,0 +1,116 @@
+"""Test of the tracking of the particles with different reference energies"""
+
+import os
+import sys
+import time
+
+FILE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+from unit_tests.params import *
+from energy_buckets_conf import *
+from ocelot.cpbd.optics import tm_cache
+
+def test_energy_buckets(cell, method):
+    """tracking of the particles with different reference energies, reference is tracking of every energy separately"""
+
+    C = Cavity(l=0.5, v=0.01, freq=1.3e9, phi=10., eid="C")
+    lat = MagneticLattice(cell + (C,) + cell, method=method)
+    energies = np.array([1., 1.5, 2.])
+
+    np.random.seed(10)
+    X = np.random.randn(6, 90) * 1e-5
+    E_array = energies[np.arange(90) % 3]
+
+    def track(rparticles, E_array, energy):
+        p_array = ParticleArray(n=rparticles.shape[1])
+        p_array.rparticles[:] = rparticles
+        p_array.E = energy
+        p_array.E_array = None if E_array is None else np.copy(E_array)
+        for elem in lat.sequence:
+            elem.transfer_map.apply(p_array)
+        return p_array
+
+    tm_cache.clear()
+    p_array = track(X, E_array, 1.)
+    misses = tm_cache.misses
+    track(X, E_array, 1.)
+    result = [check_value(tm_cache.misses, misses, TOL, assert_info=' cache misses - ')]
+    X_ref = np.zeros_like(X)
+    for energy in energies:
+        inds = E_array == energy
+        p_ref = track(X[:, inds], None, energy)
+        X_ref[:, inds] = p_ref.rparticles
+        result.append(check_value(p_array.E_array[inds][0], p_ref.E, TOL, assert_info=' E - '))
+    result1 = check_matrix(p_array.rparticles.flatten(), X_ref.flatten(), 1e-15, 'absotute', assert_info=' buckets - ')
+
+    p_list = [Particle(x=x, px=px, y=y, py=py, tau=tau, p=p, E=E) for (x, px, y, py, tau, p), E in zip(X.T, E_array)]
+    for elem in lat.sequence:
+        elem.transfer_map.apply(p_list)
+    X_list = np.array([[p.x, p.px, p.y, p.py, p.tau, p.p] for p in p_list]).T
+    result2 = check_matrix(X_list.flatten(), X_ref.flatten(), 1e-15, 'absotute', assert_info=' list - ')
+    result3 = check_matrix(np.array([p.E for p in p_list]), p_array.E_array, TOL, assert_info=' list E - ')
+
+    # the energies within the bucket are rounded to the bucket energy
+    p_array = ParticleArray(n=90)
+    p_array.rparticles[:] = X
+    p_array.E_array = E_array + np.random.uniform(-1e-4, 1e-4, 90)
+    p_array.dE_bucket = 0.01
+    buckets = p_array.energy_buckets()
+    for elem in lat.sequence:
+        elem.transfer_map.apply(p_array)
+    result4 = check_matrix(p_array.rparticles.flatten(), X_ref.flatten(), 1e-13, 'absotute', assert_info=' dE bucket - ')
+    assert check_result(result + result1 + result2 + result3 + result4)
+    assert [energy for energy, inds in buckets] == list(energies)
+
+
+def test_energy_buckets_cache(cell, method):
+    """the buckets are reused by the maps without the energy change and recalculated when E_array changes"""
+
+    p_array = ParticleArray(n=90)
+    p_array.E = 1.
+    p_array.E_array = np.array([1., 1.5, 2.])[np.arange(90) % 3]
+    buckets = p_array.energy_buckets()
+    for elem in cell:
+        elem.transfer_map.apply(p_array)
+    assert p_array.energy_buckets() is buckets
+
+    # in place change of the energies, e.g. by a cavity map
+    p_array.E_array[::3] = 3.
+    buckets = p_array.energy_buckets()
+    assert [energy for energy, inds in buckets] == [1.5, 2., 3.]
+    assert np.array_equal(buckets[2][1], np.arange(0, 90, 3))
+    assert p_array.energy_buckets(dE=1.) is not buckets
+
+    # the lost particles are removed from E_array
+    p_array.mark_lost(np.arange(90) % 3 != 0)
+    p_array.compact()
+    assert p_array.energy_buckets() == [(3., slice(None))]
+
+
+def setup_module(module):
+
+    f = open(pytest.TEST_RESULTS_FILE, 'a')
+    f.write('### ENERGY BUCKETS START ###\n\n')
+    f.close()
+
+
+def teardown_module(module):
+
+    f = open(pytest.TEST_RESULTS_FILE, 'a')
+    f.write('### ENERGY BUCKETS END ###\n\n\n')
+    f.close()
+
+
+def setup_function(function):
+
+    f = open(pytest.TEST_RESULTS_FILE, 'a')
+    f.write(function.__name__)
+    f.close()
+
+    pytest.t_start = time.time()
+
+
+def teardown_function(function):
+    f = open(pytest.TEST_RESULTS_FILE, 'a')
+    f.write(' execution time is ' + '{:.3f}'.format(time.time() - pytest.t_start) + ' sec\n\n')
+    f.close()
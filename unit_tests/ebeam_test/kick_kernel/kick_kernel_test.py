@@ -0,0 +1,76 @@
+"""Test of the fused kick kernel"""
+
+import os
+import sys
+import time
+
+FILE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+from unit_tests.params import *
+from kick_kernel_conf import *
+from ocelot.cpbd.optics import KickKernelTM, kick_kernel_py, kick_kernel_np
+
+def test_kick_kernel(cell):
+    """tracking with the kick kernel, reference is element by element tracking"""
+
+    Sk = Sextupole(l=0.1, k2=-20., tilt=0.02, eid="Sk")
+    Sk.dx = 1e-4
+    M = Multipole(kn=[0.001, 0.01, 2., 20.], eid="M")
+    C = Cavity(l=0.5, v=0.01, freq=1.3e9, phi=10., eid="C")
+    seq = cell + (Sk, D, M) + (C,) + cell
+    method = MethodTM({'global': TransferMap, Sextupole: KickTM, 'nkick': 2, 'kick_kernel': True})
+    lat = MagneticLattice(seq, method=method)
+    lat_ref = MagneticLattice(seq, method=MethodTM({'global': TransferMap, Sextupole: KickTM, 'nkick': 2}))
+
+    def track(lattice, energy):
+        np.random.seed(10)
+        p_array = ParticleArray(n=100)
+        p_array.rparticles[:] = np.random.randn(6, 100) * 1e-4
+        p_array.E = energy
+        navi = Navigator(lattice)
+        tracking_step(lattice, p_array, lattice.totalLen, navi)
+        return p_array
+
+    kernel_tm = lat.plan.steps[0][1]
+    X = np.random.randn(6, 10) * 1e-3
+    X_py = kick_kernel_py(np.copy(X), *kernel_tm.program(1.))
+    X_np = kick_kernel_np(np.copy(X), *kernel_tm.program(1.))
+    result = check_matrix(X_py.flatten(), X_np.flatten(), 1e-15, 'absotute', assert_info=' kernel py - ')
+    for energy in [1., 2.]:
+        p_array = track(lat, energy)
+        p_ref = track(lat_ref, energy)
+        result += check_matrix(p_array.rparticles.flatten(), p_ref.rparticles.flatten(), 1e-14, 'absotute',
+                               assert_info=' kernel - ')
+    assert check_result(result)
+    n = lat.sequence.index(C)
+    assert sorted([(start, stop) for start, (stop, tm) in lat.plan.steps.items()]) == [(0, n), (n + 1, len(lat.sequence))]
+    assert kernel_tm.__class__ == KickKernelTM
+
+
+def setup_module(module):
+
+    f = open(pytest.TEST_RESULTS_FILE, 'a')
+    f.write('### KICK KERNEL START ###\n\n')
+    f.close()
+
+
+def teardown_module(module):
+
+    f = open(pytest.TEST_RESULTS_FILE, 'a')
+    f.write('### KICK KERNEL END ###\n\n\n')
+    f.close()
+
+
+def setup_function(function):
+
+    f = open(pytest.TEST_RESULTS_FILE, 'a')
+    f.write(function.__name__)
+    f.close()
+
+    pytest.t_start = time.time()
+
+
+def teardown_function(function):
+    f = open(pytest.TEST_RESULTS_FILE, 'a')
+    f.write(' execution time is ' + '{:.3f}'.format(time.time() - pytest.t_start) + ' sec\n\n')
+    f.close()
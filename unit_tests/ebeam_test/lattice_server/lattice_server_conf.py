@@ -0,0 +1,48 @@
+"""Test parameters description file"""
+
+import pytest
+import numpy as np
+
+from ocelot import *
+from ocelot.utils.lattice_server import start_server
+
+"""Lattice elements definition"""
+
+D = Drift(l=0.5, eid="D")
+Qf = Quadrupole(l=0.3, k1=1.2, eid="Qf")
+Qd = Quadrupole(l=0.3, k1=-1.2, eid="Qd")
+B = SBend(l=1.0, angle=0.05, e1=0.025, e2=0.025, eid="B")
+Sf = Sextupole(l=0.1, k2=10., eid="Sf")
+m_end = Marker(eid="m_end")
+
+
+"""pytest fixtures definition"""
+
+@pytest.fixture(scope='module')
+def lattice():
+    cell = (Qf, D, Sf, B, D, Qd, D, B, D, Qf)
+    return MagneticLattice(4*cell + (m_end,), method=MethodTM({'global': SecondTM}))
+
+
+@pytest.fixture(scope='module')
+def tws0():
+    tws = Twiss()
+    tws.beta_x = 5.
+    tws.beta_y = 8.
+    tws.E = 1.
+    return tws
+
+
+@pytest.fixture(scope='module')
+def client(lattice):
+    client = start_server()
+    client.load(lattice)
+    yield client
+    client.shutdown()
+
+
+@pytest.fixture(scope='function')
+def p_array():
+    np.random.seed(11)
+    return generate_parray(sigma_x=1e-4, sigma_px=2e-5, sigma_y=1e-4, sigma_py=2e-5, sigma_tau=1e-4, sigma_p=1e-3,
+                           charge=0.5e-9, nparticles=1000, energy=1.)
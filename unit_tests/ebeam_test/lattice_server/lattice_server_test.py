@@ -0,0 +1,135 @@
+"""Test of the warm lattice server"""
+
+import os
+import sys
+import time
+import copy
+import multiprocessing
+from multiprocessing.connection import Client
+
+FILE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+from unit_tests.params import *
+from lattice_server_conf import *
+from ocelot.utils.lattice_server import serve, LatticeClient
+
+
+def test_twiss(lattice, tws0, client):
+    """twiss on the server and in the process"""
+
+    tws = client.twiss(lattice, tws0)
+    tws_ref = twiss(lattice, tws0)
+
+    result1 = check_value(tws[-1].beta_x, tws_ref[-1].beta_x, TOL, assert_info=' beta_x - ')
+    result2 = check_value(tws[-1].mux, tws_ref[-1].mux, TOL, assert_info=' mux - ')
+    assert check_result([result1, result2])
+    assert client.ping() < 1.
+
+
+def test_deltas(lattice, tws0, client):
+    """changed elements are sent before the call"""
+
+    k1 = Qd.k1
+    Qd.k1 = -1.3
+    tws = client.twiss(lattice, tws0)
+    lattice.update_modified_maps()
+    tws_ref = twiss(lattice, tws0)
+    Qd.k1 = k1
+    tws_back = client.twiss(lattice, tws0)
+    lattice.update_modified_maps()
+
+    result1 = check_value(tws[-1].beta_y, tws_ref[-1].beta_y, TOL, assert_info=' beta_y - ')
+    result2 = check_value(tws_back[-1].beta_y, twiss(lattice, tws0)[-1].beta_y, TOL, assert_info=' beta_y back - ')
+    assert check_result([result1, result2])
+    assert abs(tws[-1].beta_y - tws_back[-1].beta_y) > 1e-3
+
+
+def test_match(lattice, tws0, client):
+    """elements varied on the server are updated in the client"""
+
+    k1 = (Qf.k1, Qd.k1)
+    constr = {m_end: {"beta_x": 10., "beta_y": 12.}}
+    res = client.match(lattice, constr, [Qf, Qd], tws0, verbose=False)
+    k1_server = (Qf.k1, Qd.k1)
+    tws = twiss(lattice, tws0)
+    tws_server = client.twiss(lattice, tws0)
+
+    Qf.k1, Qd.k1 = k1
+    lattice.update_modified_maps()
+    res_ref = match(lattice, constr, [Qf, Qd], tws0, verbose=False)
+    k1_ref = (Qf.k1, Qd.k1)
+    Qf.k1, Qd.k1 = k1
+    lattice.update_modified_maps()
+
+    result1 = check_matrix(np.array(k1_server), np.array(k1_ref), TOL, assert_info=' k1 - ')
+    result2 = check_matrix(np.array(res), np.array(res_ref), TOL, assert_info=' res - ')
+    result3 = check_value(tws_server[-1].beta_x, tws[-1].beta_x, TOL, assert_info=' server beta_x - ')
+    assert check_result(result1 + result2 + [result3])
+
+
+def test_track(lattice, tws0, p_array, client):
+    """tracking with the physics process on the server and in the process"""
+
+    p_array_ref = copy.deepcopy(p_array)
+    navi = Navigator(lattice)
+    navi.unit_step = 0.5
+    navi.add_physics_proc(BeamTransform(tws=tws0), lattice.sequence[10], lattice.sequence[10])
+    tws_track, p = client.track(lattice, p_array, navi)
+
+    navi = Navigator(lattice)
+    navi.unit_step = 0.5
+    navi.add_physics_proc(BeamTransform(tws=tws0), lattice.sequence[10], lattice.sequence[10])
+    tws_ref, p_ref = track(lattice, p_array_ref, navi, print_progress=False)
+
+    result1 = check_matrix(p.rparticles, p_ref.rparticles, TOL, assert_info=' rparticles - ')
+    result2 = check_value(tws_track[-1].beta_x, tws_ref[-1].beta_x, TOL, assert_info=' beta_x - ')
+    assert check_result(result1 + [result2])
+    assert p is p_array
+
+
+def test_authkey():
+    """the server does not start without the key and keeps running after the client with a wrong key"""
+
+    with pytest.raises(ValueError):
+        serve(authkey=None)
+    parent_conn, child_conn = multiprocessing.Pipe(duplex=False)
+    process = multiprocessing.Process(target=serve, args=(None, b"key", child_conn), daemon=True)
+    process.start()
+    child_conn.close()
+    address = parent_conn.recv()
+    parent_conn.close()
+    with pytest.raises(multiprocessing.AuthenticationError):
+        Client(address, authkey=b"wrong")
+    client = LatticeClient(address, b"key", process=process)
+    assert client.ping() < 1.
+    client.shutdown()
+    assert not process.is_alive()
+
+
+def setup_module(module):
+
+    f = open(pytest.TEST_RESULTS_FILE, 'a')
+    f.write('### LATTICE SERVER START ###\n\n')
+    f.close()
+
+
+def teardown_module(module):
+
+    f = open(pytest.TEST_RESULTS_FILE, 'a')
+    f.write('### LATTICE SERVER END ###\n\n\n')
+    f.close()
+
+
+def setup_function(function):
+
+    f = open(pytest.TEST_RESULTS_FILE, 'a')
+    f.write(function.__name__)
+    f.close()
+
+    pytest.t_start = time.time()
+
+
+def teardown_function(function):
+    f = open(pytest.TEST_RESULTS_FILE, 'a')
+    f.write(' execution time is ' + '{:.3f}'.format(time.time() - pytest.t_start) + ' sec\n\n')
+    f.close()
@@ -0,0 +1,66 @@
+"""Test of the segment tree of the composed transfer maps"""
+
+import os
+import sys
+import time
+
+FILE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+from unit_tests.params import *
+from map_tree_conf import *
+from ocelot.cpbd.optics import TransferMapTree
+
+def test_map_tree(lattice, tws0):
+    """segment tree of transfer maps, reference is lattice_transfer_map()"""
+
+    tree = TransferMapTree(lattice, energy=tws0.E, order=2)
+    Qf.k1 = 1.25
+    updated = tree.update()
+    R, B_vec, T = tree.transfer_map()
+
+    R_ref = lattice_transfer_map(lattice, tws0.E)
+    B_ref = lattice.B
+    T_ref = lattice.T
+
+    n = 7
+    R_part, B_part, T_part = tree.transfer_map(start=2, stop=n)
+    R_part_ref = lattice_transfer_map(MagneticLattice(lattice.sequence[2:n], method=lattice.method), tws0.E)
+
+    Qf.k1 = 1.2
+    lattice.update_transfer_maps()
+
+    result1 = check_matrix(R, R_ref, TOL, 'absotute', assert_info=' R - ')
+    result2 = check_matrix(B_vec, B_ref, TOL, 'absotute', assert_info=' B - ')
+    result3 = check_matrix(T.flatten(), T_ref.flatten(), TOL, 'absotute', assert_info=' T - ')
+    result4 = check_matrix(R_part, R_part_ref, TOL, 'absotute', assert_info=' R part - ')
+    assert check_result(result1 + result2 + result3 + result4)
+    assert len(updated) == lattice.sequence.count(Qf)
+
+
+def setup_module(module):
+
+    f = open(pytest.TEST_RESULTS_FILE, 'a')
+    f.write('### MAP TREE START ###\n\n')
+    f.close()
+
+
+def teardown_module(module):
+
+    f = open(pytest.TEST_RESULTS_FILE, 'a')
+    f.write('### MAP TREE END ###\n\n\n')
+    f.close()
+
+
+def setup_function(function):
+
+    f = open(pytest.TEST_RESULTS_FILE, 'a')
+    f.write(function.__name__)
+    f.close()
+
+    pytest.t_start = time.time()
+
+
+def teardown_function(function):
+    f = open(pytest.TEST_RESULTS_FILE, 'a')
+    f.write(' execution time is ' + '{:.3f}'.format(time.time() - pytest.t_start) + ' sec\n\n')
+    f.close()
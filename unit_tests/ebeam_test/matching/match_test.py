@@ -9,6 +9,7 @@ REF_RES_DIR = FILE_DIR + '/ref_results/'
 
 from unit_tests.params import *
 from match_conf import *
+from ocelot.cpbd.match import twiss_sensitivities, match_multistart
 
 
 def test_lattice_transfer_map(lattice, update_ref_values=False):
@@ -174,6 +175,89 @@ def test_bend_angle_match(lattice, update_ref_values=False):
     result = check_dict(tws, tws_ref, TOL, 'absotute', assert_info=' tws after matching - ')
     assert check_result(result)
 
+def test_twiss_sensitivities(lattice):
+    """analytic derivatives of twiss parameters in comparison with finite differences"""
+    tws0 = Twiss()
+    tws0.beta_x = 8.4
+    tws0.beta_y = 8.4
+    tws0.alpha_x = -55.8
+    tws0.alpha_y = -55.8
+    tws0.E = 0.005071
+    tws0.gamma_x = (1. + tws0.alpha_x ** 2) / tws0.beta_x
+    tws0.gamma_y = (1. + tws0.alpha_y ** 2) / tws0.beta_y
+
+    tws, derivs = twiss_sensitivities(lattice, tws0, [q1, d2, b1], vary_bend_angle=True)
+    result = []
+    for j, (elem, attr) in enumerate([(q1, "k1"), (d2, "l"), (b1, "angle")]):
+        value = getattr(elem, attr)
+        h = 1.e-6 * (1. + abs(value))
+        setattr(elem, attr, value + h)
+        lattice.update_modified_maps()
+        tws_plus = twiss_table(lattice, Twiss(tws0))
+        setattr(elem, attr, value - h)
+        lattice.update_modified_maps()
+        tws_minus = twiss_table(lattice, Twiss(tws0))
+        setattr(elem, attr, value)
+        lattice.update_modified_maps()
+        for key in ["beta_x", "alpha_y", "Dx", "mux", "muy"]:
+            numeric = (getattr(tws_plus, key) - getattr(tws_minus, key)) / (2. * h)
+            result += check_matrix(derivs[key][:, j], numeric, tolerance=1.0e-5, tolerance_type='absotute',
+                                   assert_info=" d" + key + "/d" + attr + " - ")
+    assert check_result(result)
+
+
+def test_quad_match_lm(lattice):
+    """Levenberg-Marquardt matching in comparison with simplex"""
+    tws0 = Twiss()
+    tws0.beta_x = 8.4
+    tws0.beta_y = 8.4
+    tws0.alpha_x = -55.8
+    tws0.alpha_y = -55.8
+    tws0.E = 0.005071
+    q1_k1 = q1.k1
+    q2_k1 = q2.k1
+    constr = {end: {"beta_x": 10, "beta_y": 10}}
+
+    res_ref = match(lattice, constr, [q1, q2], tws0, verbose=False)
+    q1.k1 = q1_k1
+    q2.k1 = q2_k1
+    res = match(lattice, constr, [q1, q2], tws0, verbose=False, method="lm")
+    tws = twiss(lattice, tws0)
+    q1.k1 = q1_k1
+    q2.k1 = q2_k1
+    lattice.update_transfer_maps()
+
+    result1 = check_matrix(np.array(res), np.array(res_ref), tolerance=1.0e-5, assert_info=' k1 - ')
+    result2 = check_value(tws[-1].beta_x, 10., tolerance=1.0e-10, assert_info=' beta_x - ')
+    result3 = check_value(tws[-1].beta_y, 10., tolerance=1.0e-10, assert_info=' beta_y - ')
+    assert check_result(result1 + [result2, result3])
+
+
+def test_quad_match_multistart(lattice):
+    """matching from several starts in the process pool, the best solution is set to the elements"""
+    tws0 = Twiss()
+    tws0.beta_x = 8.4
+    tws0.beta_y = 8.4
+    tws0.alpha_x = -55.8
+    tws0.alpha_y = -55.8
+    tws0.E = 0.005071
+    q1_k1 = q1.k1
+    q2_k1 = q2.k1
+    constr = {end: {"beta_x": 10, "beta_y": 10}}
+
+    res = match_multistart(lattice, constr, [q1, q2], tws0, n_starts=4, workers=2, seed=1)
+    k1 = np.array([q1.k1, q2.k1])
+    tws = twiss(lattice, tws0)
+    q1.k1 = q1_k1
+    q2.k1 = q2_k1
+    lattice.update_transfer_maps()
+
+    result1 = check_matrix(k1, np.array(res), tolerance=1.0e-12, assert_info=' k1 - ')
+    result2 = check_value(tws[-1].beta_x, 10., tolerance=1.0e-10, assert_info=' beta_x - ')
+    result3 = check_value(tws[-1].beta_y, 10., tolerance=1.0e-10, assert_info=' beta_y - ')
+    assert check_result(result1 + [result2, result3])
+
+
 def setup_module(module):
 
     f = open(pytest.TEST_RESULTS_FILE, 'a')
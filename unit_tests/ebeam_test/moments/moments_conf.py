@@ -0,0 +1,55 @@
+"""Test parameters description file"""
+
+import copy
+import pytest
+import numpy as np
+
+from ocelot import *
+from ocelot.cpbd.beam import generate_parray
+
+"""Lattice elements definition"""
+
+D0 = Drift(l=0.1)
+D1 = Drift(l=0.1)
+D2 = Drift(l=1.5)
+D3 = Drift(l=1.)
+Q1 = Quadrupole(l=0.2, k1=2.)
+B1 = SBend(l=0.2, angle=-0.1, e2=-0.1)
+B2 = SBend(l=0.2, angle=0.1, e1=0.1)
+B3 = SBend(l=0.2, angle=0.1, e2=0.1)
+B4 = SBend(l=0.2, angle=-0.1, e1=-0.1)
+C1 = Cavity(l=1., v=0.02, phi=20., freq=1.3e9)
+
+start = Marker()
+stop = Marker()
+
+"""pytest fixtures definition"""
+
+
+@pytest.fixture(scope='module')
+def cell():
+    return (start, C1, D0, Q1, D0, B1, D1, B2, D2, B3, D1, B4, D3, stop)
+
+
+@pytest.fixture(scope='module')
+def method():
+    m = MethodTM()
+    m.global_method = SecondTM
+    return m
+
+
+@pytest.fixture(scope='module')
+def lattice(cell, method):
+    return MagneticLattice(cell, method=method)
+
+
+@pytest.fixture(scope='module')
+def linear_lattice(cell):
+    return MagneticLattice(copy.deepcopy(cell[:1] + cell[2:]))
+
+
+@pytest.fixture(scope='function')
+def p_array():
+    np.random.seed(11)
+    return generate_parray(sigma_x=1.2e-4, sigma_px=1.8e-5, sigma_y=1.6e-4, sigma_py=4.e-5, sigma_tau=3.e-4,
+                           sigma_p=3.e-4, chirp=0.002, charge=0.5e-9, nparticles=100000, energy=0.13)
@@ -0,0 +1,140 @@
+"""Test of the propagation of the beam moments"""
+
+import os
+import sys
+import time
+import copy
+
+FILE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+from unit_tests.params import *
+from moments_conf import *
+from ocelot.cpbd.moments import BeamMoments, get_moments, moments_from_twiss, track_moments
+
+
+def test_linear_moments(linear_lattice, p_array):
+    """moments with the linear maps are the moments of the tracked particles"""
+
+    moments = get_moments(p_array)
+    tws_m, moments = track_moments(linear_lattice, moments, Navigator(linear_lattice))
+    tws_p, p_array = track(linear_lattice, p_array, Navigator(linear_lattice), print_progress=False)
+    moments_ref = get_moments(p_array)
+
+    result1 = check_matrix(moments.sigma, moments_ref.sigma, tolerance=1.0e-12, tolerance_type='absotute',
+                           assert_info=' sigma - ')
+    result2 = check_matrix(moments.mean, moments_ref.mean, tolerance=1.0e-12, tolerance_type='absotute',
+                           assert_info=' mean - ')
+    result3 = check_value(tws_m[-1].beta_x, tws_p[-1].beta_x, TOL, assert_info=' beta_x - ')
+    result4 = check_value(tws_m[-1].s, tws_p[-1].s, TOL, assert_info=' s - ')
+    assert check_result(result1 + result2 + [result3, result4])
+    assert len(tws_m) == len(tws_p)
+
+
+def test_second_order_moments(lattice, p_array):
+    """second order maps and cavity in comparison with tracking"""
+
+    moments = get_moments(p_array)
+    tws_m, moments = track_moments(lattice, moments, Navigator(lattice), order=2)
+    tws_p, p_array = track(lattice, p_array, Navigator(lattice), print_progress=False)
+    moments_ref = get_moments(p_array)
+
+    result1 = check_matrix(np.diag(moments.sigma), np.diag(moments_ref.sigma), tolerance=1.0e-3,
+                           assert_info=' sigma - ')
+    result2 = check_value(moments.mean[5], moments_ref.mean[5], tolerance=1.0e-3, assert_info=' mean p - ')
+    result3 = check_value(moments.E, p_array.E, TOL, assert_info=' E - ')
+    assert check_result(result1 + [result2, result3])
+
+
+def test_sliced_cavity_moments(method, p_array):
+    """second order moments through the sliced cavity, reference is the cavity in one step"""
+
+    C = Cavity(l=1., v=0.02, phi=20., freq=1.3e9)
+    lat = MagneticLattice((start, C, stop), method=method)
+    tws_m, moments_ref = track_moments(lat, get_moments(p_array), Navigator(lat), order=2)
+
+    navi = Navigator(lat)
+    navi.unit_step = 0.1
+    navi.add_physics_proc(PhysProc(), start, stop)
+    tws_m, moments = track_moments(lat, get_moments(p_array), navi, order=2)
+
+    result1 = check_matrix(np.diag(moments.sigma), np.diag(moments_ref.sigma), tolerance=1.0e-4,
+                           assert_info=' sigma - ')
+    result2 = check_value(moments.mean[5], moments_ref.mean[5], tolerance=1.0e-9, tolerance_type='absotute',
+                          assert_info=' mean p - ')
+    assert check_result(result1 + [result2])
+    # the sliced maps keep the voltage of the whole cavity
+    assert C.transfer_map(0.1).v == C.v
+
+
+def test_lsc_moments(p_array):
+    """linearized LSC in comparison with tracking"""
+
+    lat = MagneticLattice((start, Drift(l=5.), stop))
+    moments = get_moments(p_array)
+    navi = Navigator(lat)
+    navi.unit_step = 0.5
+    navi.add_physics_proc(LSC(), start, stop)
+    tws_m, moments = track_moments(lat, moments, navi)
+
+    navi = Navigator(lat)
+    navi.unit_step = 0.5
+    navi.add_physics_proc(LSC(), start, stop)
+    tws_p, p_array = track(lat, p_array, navi, print_progress=False)
+    moments_ref = get_moments(p_array)
+
+    result1 = check_value(moments.mean[5], moments_ref.mean[5], tolerance=2.0e-2, assert_info=' mean p - ')
+    result2 = check_value(moments.sigma[4, 5], moments_ref.sigma[4, 5], tolerance=2.0e-2, assert_info=' chirp - ')
+    assert check_result([result1, result2])
+
+
+def test_moments_from_twiss():
+    """sigma matrix of the Twiss parameters"""
+
+    tws = Twiss()
+    tws.beta_x = 10.
+    tws.alpha_x = -1.
+    tws.emit_x = 1e-9
+    tws.beta_y = 5.
+    tws.alpha_y = 0.5
+    tws.emit_y = 2e-9
+    tws.Dx = 0.1
+    tws.E = 0.13
+    moments = moments_from_twiss(tws, sigma_tau=1e-4, sigma_p=1e-3)
+    D = np.array([tws.Dx, 0., 0., 0., 0., 1.])
+    tws_m = BeamMoments(moments.mean, moments.sigma - 1e-6 * np.outer(D, D), E=tws.E).twiss()
+
+    result1 = check_value(tws_m.beta_x, tws.beta_x, TOL, assert_info=' beta_x - ')
+    result2 = check_value(tws_m.alpha_y, tws.alpha_y, TOL, assert_info=' alpha_y - ')
+    result3 = check_value(tws_m.emit_y, tws.emit_y, TOL, assert_info=' emit_y - ')
+    result4 = check_value(moments.sigma[0, 5], 1e-7, TOL, assert_info=' Dx - ')
+    result5 = check_value(moments.sigma[4, 4], 1e-8, TOL, assert_info=' tautau - ')
+    assert check_result([result1, result2, result3, result4, result5])
+
+
+def setup_module(module):
+
+    f = open(pytest.TEST_RESULTS_FILE, 'a')
+    f.write('### MOMENTS START ###\n\n')
+    f.close()
+
+
+def teardown_module(module):
+
+    f = open(pytest.TEST_RESULTS_FILE, 'a')
+    f.write('### MOMENTS END ###\n\n\n')
+    f.close()
+
+
+def setup_function(function):
+
+    f = open(pytest.TEST_RESULTS_FILE, 'a')
+    f.write(function.__name__)
+    f.close()
+
+    pytest.t_start = time.time()
+
+
+def teardown_function(function):
+    f = open(pytest.TEST_RESULTS_FILE, 'a')
+    f.write(' execution time is ' + '{:.3f}'.format(time.time() - pytest.t_start) + ' sec\n\n')
+    f.close()
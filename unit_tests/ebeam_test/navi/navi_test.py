@@ -404,6 +404,43 @@ def test_kick_with_one_elem(lattice, p_array, parameter=None, update_ref_values=
     assert check_result([result0] + result1 + result2 + result3 + result4 + result5)
 
 
+def test_positions_and_sliced_maps(lattice, p_array, parameter=None, update_ref_values=False):
+    """
+    test cumulative positions of the elements and reuse of the sliced transfer maps
+    """
+
+    p_array_track = copy.deepcopy(p_array)
+
+    navi = Navigator(lattice)
+    navi.unit_step = 0.05
+
+    t = LogProc()
+    navi.add_physics_proc(t, D0, D2)
+
+    tws_track_wo, p_array_wo = track(lattice, p_array_track, navi, calc_tws=False)
+
+    # the same summation as Sum[lat.sequence[k].l, {k, 0, i-1}] by np.sum
+    lengths = [elem.l for elem in lattice.sequence]
+    positions = [np.sum(np.array(lengths[:i])) for i in range(len(lengths) + 1)]
+    result0 = check_value(p_array_wo.s, lattice.totalLen, tolerance=TOL, assert_info=' p.s - ')
+    assert check_result([result0])
+    assert [lattice.element_position(i) for i in range(len(lengths) + 1)] == positions
+    assert navi.map_cache.hits > 0
+    assert navi.get_sliced_map(D2, 0.05) is navi.get_sliced_map(D2, 0.05)
+
+    # the positions are recalculated when the lengths of the elements are changed, even if the lattice length is not
+    i = lattice.sequence.index(D2)
+    D1.l += 0.25
+    D2.l -= 0.25
+    lattice.update_modified_maps()
+    assert lattice.element_position(i) == np.sum(np.array([elem.l for elem in lattice.sequence[:i]]))
+    assert lattice.element_position(i) != positions[i]
+    D1.l -= 0.25
+    D2.l += 0.25
+    lattice.update_transfer_maps()
+    assert lattice.element_position(i) == positions[i]
+
+
 def setup_module(module):
 
     f = open(pytest.TEST_RESULTS_FILE, 'a')
@@ -0,0 +1,48 @@
+"""Test parameters description file"""
+
+import copy
+import pytest
+
+from ocelot import *
+
+"""Lattice elements definition"""
+
+D1 = Drift(l=0.5)
+Q1 = Quadrupole(l=0.3, k1=2.)
+Q1.dx = 0.0005
+Q2 = Quadrupole(l=0.3, k1=-2., tilt=0.1)
+Q2.dy = -0.0003
+S1 = Sextupole(l=0.1, k2=50.)
+C1 = Cavity(l=1., v=0.02, freq=1.3e9, phi=10.)
+
+"""pytest fixtures definition"""
+
+
+@pytest.fixture(scope='module')
+def cell():
+    cell = []
+    for i in range(4):
+        cell += [Hcor(l=0.1), D1, Q1, D1, Monitor(), Vcor(), D1, Q2, D1, Monitor(l=0.2), C1, S1, D1]
+    return cell
+
+
+@pytest.fixture(scope='module')
+def method():
+    m = MethodTM()
+    m.global_method = SecondTM
+    return m
+
+
+@pytest.fixture(scope='module')
+def lattice(cell, method):
+    return MagneticLattice(cell, method=method)
+
+
+@pytest.fixture(scope='module')
+def linear_lattice(cell):
+    return MagneticLattice(copy.deepcopy(cell))
+
+
+@pytest.fixture(scope='module')
+def multipole_lattice(cell):
+    return MagneticLattice(copy.deepcopy(cell) + [Multipole(kn=[0., 0.5, 20.]), D1, Monitor()])
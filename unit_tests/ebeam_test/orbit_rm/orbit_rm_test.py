@@ -0,0 +1,173 @@
+"""Test of the orbit response matrix calculated in one pass through the lattice"""
+
+import os
+import sys
+import time
+import copy
+
+FILE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+from unit_tests.params import *
+from orbit_rm_conf import *
+from ocelot.cpbd.orbit_correction import NewOrbit
+from ocelot.cpbd.response_matrix import MeasureResponseMatrix, LinacSimRM, ResponseMatrix, orbit_response_matrix
+from ocelot.cpbd.response_matrix import LinacRmatrixRM, element_digest
+
+
+def retracking_rm(lattice, orbit, energy, shift=1.e-7):
+    """response matrix with the angles of the correctors set in turn"""
+
+    rm = MeasureResponseMatrix(lattice, orbit.hcors, orbit.vcors, orbit.bpms)
+    cors = orbit.hcors + orbit.vcors
+    X0, Y0 = rm.read_virtual_orbit(p_init=Particle(E=energy))
+    resp = np.zeros((2 * len(orbit.bpms), len(cors)))
+    for j, cor in enumerate(cors):
+        cor.angle = shift
+        lattice.update_transfer_maps()
+        X1, Y1 = rm.read_virtual_orbit(p_init=Particle(E=energy))
+        resp[:, j] = (np.append(X1, Y1) - np.append(X0, Y0)) / shift
+        cor.angle = 0.
+    lattice.update_transfer_maps()
+    return resp
+
+
+def test_linac_sim_rm(linear_lattice):
+    """first order response matrix with cavities in comparison with retracking"""
+
+    orbit = NewOrbit(linear_lattice)
+    resp_ref = retracking_rm(linear_lattice, orbit, 0.1)
+
+    tws0 = Twiss()
+    tws0.E = 0.1
+    rm = LinacSimRM(linear_lattice, orbit.hcors, orbit.vcors, orbit.bpms)
+    resp = rm.calculate(tw_init=tws0)
+
+    result = check_matrix(resp, resp_ref, tolerance=1.0e-6, tolerance_type='absotute', assert_info=' resp - ')
+    assert check_result(result)
+
+
+def test_second_order_rm(lattice):
+    """response matrix along the orbit with the second order maps in comparison with retracking"""
+
+    orbit = NewOrbit(lattice)
+    resp_ref = retracking_rm(lattice, orbit, 0.1)
+    cors = orbit.hcors + orbit.vcors
+
+    resp = orbit_response_matrix(lattice, cors, orbit.bpms, p_init=Particle(E=0.1), order=2, ic=True)
+    resp_track = orbit_response_matrix(lattice, cors, orbit.bpms, p_init=Particle(E=0.1), order=2, ic=True,
+                                       tracking=True)
+
+    result1 = check_matrix(resp[:, :len(cors)], resp_ref, tolerance=1.0e-4, tolerance_type='absotute',
+                           assert_info=' resp - ')
+    result2 = check_matrix(resp, resp_track, tolerance=1.0e-5, tolerance_type='absotute',
+                           assert_info=' tracking - ')
+    assert check_result(result1 + result2)
+    assert resp.shape == (2 * len(orbit.bpms), len(cors) + 4)
+
+
+def test_multipole_rm(multipole_lattice):
+    """tracking of the perturbed particles for the nonlinear elements in comparison with retracking"""
+
+    orbit = NewOrbit(multipole_lattice)
+    resp_ref = retracking_rm(multipole_lattice, orbit, 0.1)
+
+    resp = orbit_response_matrix(multipole_lattice, orbit.hcors + orbit.vcors, orbit.bpms, p_init=Particle(E=0.1))
+
+    result = check_matrix(resp, resp_ref, tolerance=1.0e-3, tolerance_type='absotute', assert_info=' resp - ')
+    assert check_result(result)
+
+
+def test_rm_store(cell, tmp_path):
+    """stored response matrix is reused and only the columns of the changed lattice segments are recalculated"""
+
+    lat = MagneticLattice(copy.deepcopy(cell))
+    orbit = NewOrbit(lat)
+    tws0 = Twiss()
+    tws0.E = 0.1
+    filename = str(tmp_path / "rm.npz")
+    rmatrix = ResponseMatrix(method=LinacSimRM(lat, orbit.hcors, orbit.vcors, orbit.bpms))
+    rmatrix.calculate(tw_init=tws0, filename=filename)
+
+    stored = ResponseMatrix()
+    stored.load(filename)
+    result1 = check_matrix(stored.matrix, rmatrix.matrix, tolerance=1.0e-12, tolerance_type='absotute',
+                           assert_info=' stored - ')
+    fingerprint = rmatrix.fingerprint
+    assert stored.changed_columns(lat, fingerprint, 0.1, rmatrix.cor_names, rmatrix.bpm_names) == []
+    assert stored.changed_columns(lat, fingerprint, 0.2, rmatrix.cor_names, rmatrix.bpm_names) is None
+
+    # BPM in the second cell, the columns of the correctors downstream are not changed
+    bpm = lat.sequence[17]
+    bpm.l = 0.1
+    orbit.hcors[0].angle = 0.001
+    lat.update_transfer_maps()
+    rmatrix.calculate(tw_init=tws0, filename=filename)
+    cors = orbit.hcors + orbit.vcors
+    columns = [j for j, cor in enumerate(cors) if lat.sequence.index(cor) < 17]
+
+    resp_ref = LinacSimRM(lat, orbit.hcors, orbit.vcors, orbit.bpms).calculate(tw_init=tws0)
+    result2 = check_matrix(rmatrix.matrix, resp_ref, tolerance=1.0e-12, tolerance_type='absotute',
+                           assert_info=' resp - ')
+    assert check_result(result1 + result2)
+    assert stored.changed_columns(lat, rmatrix.fingerprint, 0.1, rmatrix.cor_names, rmatrix.bpm_names) == columns
+    assert len(columns) == 3
+
+
+def test_rm_store_whole_matrix(cell, tmp_path):
+    """the method without calculate_columns() recalculates the whole matrix after any change"""
+
+    lat = MagneticLattice(copy.deepcopy(cell))
+    orbit = NewOrbit(lat)
+    tws0 = Twiss()
+    tws0.E = 0.1
+    filename = str(tmp_path / "rm.npz")
+    rmatrix = ResponseMatrix(method=LinacRmatrixRM(lat, orbit.hcors, orbit.vcors, orbit.bpms))
+    rmatrix.calculate(tw_init=tws0, filename=filename)
+
+    lat.sequence[17].l = 0.1
+    lat.update_transfer_maps()
+    rmatrix.calculate(tw_init=tws0, filename=filename)
+    resp_ref = LinacRmatrixRM(lat, orbit.hcors, orbit.vcors, orbit.bpms).calculate(tw_init=tws0)
+    result = check_matrix(rmatrix.matrix, resp_ref, tolerance=1.0e-12, tolerance_type='absotute',
+                          assert_info=' resp - ')
+    assert check_result(result)
+
+
+def test_digest_object_params():
+    """object parameters are left out of the digest, it does not change with the new session"""
+
+    q1 = Quadrupole(l=0.2, k1=1., eid="Q")
+    q2 = Quadrupole(l=0.2, k1=1., eid="Q")
+    q1.field = object()
+    q2.field = object()
+    assert element_digest(q1) == element_digest(q2)
+    q2.k1 = 1.1
+    assert element_digest(q1) != element_digest(q2)
+
+def setup_module(module):
+
+    f = open(pytest.TEST_RESULTS_FILE, 'a')
+    f.write('### ORBIT RM START ###\n\n')
+    f.close()
+
+
+def teardown_module(module):
+
+    f = open(pytest.TEST_RESULTS_FILE, 'a')
+    f.write('### ORBIT RM END ###\n\n\n')
+    f.close()
+
+
+def setup_function(function):
+
+    f = open(pytest.TEST_RESULTS_FILE, 'a')
+    f.write(function.__name__)
+    f.close()
+
+    pytest.t_start = time.time()
+
+
+def teardown_function(function):
+    f = open(pytest.TEST_RESULTS_FILE, 'a')
+    f.write(' execution time is ' + '{:.3f}'.format(time.time() - pytest.t_start) + ' sec\n\n')
+    f.close()
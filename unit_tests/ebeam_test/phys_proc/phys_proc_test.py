@@ -10,6 +10,7 @@ REF_RES_DIR = FILE_DIR + '/ref_results/'
 
 from unit_tests.params import *
 from phys_proc_conf import *
+from ocelot.cpbd.track import apply_phys_proc
 
 
 def test_generate_parray(lattice, p_array, parameter=None, update_ref_values=False):
@@ -287,6 +288,127 @@ def test_track_spontan_rad_effects(lattice, p_array, parameter=None, update_ref_
     assert check_result(result1 + result2)
 
 
+def test_track_ensemble(lattice, p_array):
+    """
+    tracking of the ensemble of bunches with charge, offset and energy jitter in one sweep,
+    reference is tracking of every bunch separately
+    """
+    bunches = [p_array.thin_out(nth=10, n0=i) for i in range(3)]
+    bunches[0].q_array *= 1.1
+    bunches[1].x()[:] += 1e-4
+    bunches[2].E = 0.131
+
+    def navigator():
+        navi = Navigator(lattice)
+        navi.unit_step = 0.1
+        lsc = LSC()
+        lsc.smooth_param = 0.1
+        navi.add_physics_proc(lsc, lattice.sequence[0], lattice.sequence[-1])
+        tws = Twiss()
+        tws.beta_x = 20.0
+        tws.beta_y = 15.0
+        bt = BeamTransform(tws=tws)
+        bt.remove_offsets = True
+        navi.add_physics_proc(bt, lattice.sequence[-1], lattice.sequence[-1])
+        return navi
+
+    p_ensemble = ensemble_array([copy.deepcopy(p) for p in bunches])
+    tws_ensemble, p_ensemble = track(lattice, p_ensemble, navigator(), print_progress=False)
+
+    result = []
+    for i, bunch in enumerate(bunches):
+        tws_track, p_track = track(lattice, copy.deepcopy(bunch), navigator(), print_progress=False)
+        p = p_ensemble.bunch(i)
+        result += check_matrix(p.rparticles.flatten(), p_track.rparticles.flatten(), 1.0e-12, 'absotute',
+                               assert_info=' rparticles - ')
+        result.append(check_value(p.E, p_track.E, TOL, assert_info=' E - '))
+        result += check_matrix(tws_ensemble[i].beta_x, np.array([tw.beta_x for tw in tws_track]), TOL,
+                               assert_info=' beta_x - ')
+        result += check_matrix(tws_ensemble[i].emit_y, np.array([tw.emit_y for tw in tws_track]), TOL,
+                               assert_info=' emit_y - ')
+        result += check_matrix(tws_ensemble[i].s, np.array([tw.s for tw in tws_track]), TOL, assert_info=' s - ')
+    assert check_result(result)
+    assert p_ensemble.n_bunches() == 3
+
+
+def test_longitudinal_tracking(cell, method, p_array):
+    """
+    longitudinal tracking of the scan of the cavity settings, reference is 6D tracking of every setting
+    with zero transverse coordinates, LSC is applied with the initial transverse coordinates
+    """
+    C = Cavity(l=1.0, v=0.02, freq=1.3e9, phi=20., eid="C")
+    lat = MagneticLattice((D0, C, D3) + cell, method=method)
+    phi = np.array([0., 10., -25.])
+    v = np.array([0.02, 0.015, 0.01])
+
+    long_lat = LongitudinalLattice(lat)
+    lsc = LSC()
+    long_lat.add_physics_proc(lsc, D0, C)
+    tau, p, E = long_lat.track(p_array, v=v, phi=phi)
+    tau_wo, p_wo, E_wo = LongitudinalLattice(lat).track(p_array, v=v, phi=phi)
+
+    result = []
+    for k in range(len(phi)):
+        C.v = v[k]
+        C.phi = phi[k]
+        lat.update_transfer_maps()
+        p_ref = copy.deepcopy(p_array)
+        p_ref.rparticles[:4] = 0.
+        for i, elem in enumerate(lat.sequence):
+            if i == 1:
+                p_ref.rparticles[:4] = p_array.rparticles[:4]
+                lsc.apply(p_ref, D0.l)
+                p_ref.rparticles[:4] = 0.
+            elem.transfer_map.apply(p_ref)
+        result += check_matrix(tau[k], p_ref.tau(), 1.0e-9, 'absotute', assert_info=' tau - ')
+        result += check_matrix(p[k], p_ref.p(), 1.0e-15, 'absotute', assert_info=' p - ')
+        result.append(check_value(E[k], p_ref.E, TOL, assert_info=' E - '))
+
+    # the cavities are tracked without truncation
+    lat = MagneticLattice((D0, C, D0), method=method)
+    tau_cav, p_cav, E_cav = LongitudinalLattice(lat).track(p_array, v=v, phi=phi)
+    for k in range(len(phi)):
+        C.v = v[k]
+        C.phi = phi[k]
+        lat.update_transfer_maps()
+        p_ref = copy.deepcopy(p_array)
+        p_ref.rparticles[:4] = 0.
+        for elem in lat.sequence:
+            elem.transfer_map.apply(p_ref)
+        result += check_matrix(tau_cav[k], p_ref.tau(), 1.0e-15, 'absotute', assert_info=' cavity tau - ')
+        result += check_matrix(p_cav[k], p_ref.p(), 1.0e-15, 'absotute', assert_info=' cavity p - ')
+    assert check_result(result)
+    assert np.max(np.abs(p - p_wo)) > 1e-6
+
+
+def test_lost_particles(p_array):
+    """
+    the particles marked as lost but not removed from the array yet (see ParticleArray.mark_lost()) are excluded
+    from the envelope and from the physics processes, reference is the array without the lost particles
+    """
+    p_array.compact_threshold = 1.
+    lost = np.arange(0, p_array.size(), 7)
+    p_array.mark_lost(lost, cause="test")
+    p_ref = copy.deepcopy(p_array)
+    p_ref.compact(threshold=0.)
+    assert p_array.size() > p_ref.size() == p_array.n_alive()
+
+    tws = get_envelope(p_array)
+    tws_ref = get_envelope(p_ref)
+    result = [check_value(tws.beta_x, tws_ref.beta_x, TOL, assert_info=' beta_x - '),
+              check_value(tws.emit_y, tws_ref.emit_y, TOL, assert_info=' emit_y - '),
+              check_value(tws.tautau, tws_ref.tautau, TOL, assert_info=' tautau - ')]
+
+    lsc = LSC()
+    lsc.smooth_param = 0.1
+    apply_phys_proc(lsc, p_array, 0.5)
+    lsc.apply(p_ref, 0.5)
+    result += check_matrix(p_array.rparticles.flatten(), p_ref.rparticles.flatten(), 1.0e-15, 'absotute',
+                           assert_info=' rparticles - ')
+    assert check_result(result)
+    assert np.array_equal(p_array.particle_ids(), p_ref.particle_ids())
+
+
 def setup_module(module):
 
     f = open(pytest.TEST_RESULTS_FILE, 'a')
@@ -6,6 +6,7 @@ import time
 
 from ocelot.cpbd.orbit_correction import *
 from ocelot.cpbd.response_matrix import *
+from ocelot.cpbd.match import closed_orbits
 
 FILE_DIR = os.path.dirname(os.path.abspath(__file__))
 REF_RES_DIR = FILE_DIR + '/ref_results/'
@@ -113,6 +114,28 @@ def test_lattice_track(lattice, update_ref_values=False):
     assert check_result(result)
 
 
+def test_closed_orbit(lattice, update_ref_values=False):
+    """Closed orbit test, reference is the orbit after one turn of tracking"""
+
+    method = MethodTM()
+    method.params[Sextupole] = KickTM
+    lat = MagneticLattice(lattice.sequence, method=method)
+    deltas = [-0.005, 0., 0.005]
+
+    X = closed_orbits(lat, deltas, jacobian="tracking", eps_xy=1e-12, eps_angle=1e-12)
+    X_lin = closed_orbits(lat, deltas, eps_xy=1e-12, eps_angle=1e-12)
+    p_array = ParticleArray(n=len(deltas))
+    p_array.rparticles[:] = X.T
+    tracking_step(lat, p_array, lat.totalLen, Navigator(lat))
+
+    result = check_matrix(p_array.rparticles[:4], X.T[:4], TOL, 'absotute', assert_info=' one turn - ')
+    result += check_matrix(X_lin, X, TOL, 'absotute', assert_info=' linear jacobian - ')
+    p0 = closed_orbit(lat, p=0.005)
+    result += check_matrix(np.array([p0.x, p0.px, p0.y, p0.py]), X[2, :4], TOL, 'absotute',
+                           assert_info=' closed_orbit - ')
+    assert check_result(result)
+
+
 def correction_wrapper(orb, ring_method):
     
     x_bpm_b, y_bpm_b = ring_method.read_virtual_orbit()
@@ -0,0 +1,41 @@
+"""Test parameters description file"""
+
+import pytest
+import numpy as np
+
+from ocelot import *
+
+"""Lattice elements definition"""
+
+D = Drift(l=0.5, eid="D")
+Qf = Quadrupole(l=0.3, k1=1.2, tilt=0.01, eid="Qf")
+Qd = Quadrupole(l=0.3, k1=-1.2, eid="Qd")
+B = SBend(l=1.0, angle=0.05, e1=0.025, e2=0.025, eid="B")
+Sf = Sextupole(l=0.1, k2=10., eid="Sf")
+
+
+"""pytest fixtures definition"""
+
+
+@pytest.fixture(scope='module')
+def cell():
+    return (Qf, D, Sf, B, D, Qd, D, B, D, Qf)
+
+
+@pytest.fixture(scope='module')
+def method():
+    return MethodTM({'global': SecondTM})
+
+
+@pytest.fixture(scope='function')
+def lattice(cell, method):
+    return MagneticLattice(8*cell, method=method)
+
+
+@pytest.fixture(scope='module')
+def tws0():
+    tws = Twiss()
+    tws.beta_x = 5.
+    tws.beta_y = 8.
+    tws.E = 1.
+    return tws
@@ -0,0 +1,60 @@
+"""Test of the composition of the second order maps"""
+
+import os
+import sys
+import time
+
+FILE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+from unit_tests.params import *
+from second_order_maps_conf import *
+from ocelot.cpbd.optics import transfer_maps_mult_py, sym_matrix, unsym_matrix
+
+def test_second_order_composition(lattice, tws0):
+    """composition of the second order maps, reference is element by element transfer_maps_mult_py()"""
+
+    R = lattice_transfer_map(lattice, tws0.E)
+    T = lattice.T
+
+    R_ref = np.eye(6)
+    T_ref = np.zeros((6, 6, 6))
+    E = tws0.E
+    for elem in lattice.sequence:
+        tm = elem.transfer_map
+        Tb = sym_matrix(np.copy(tm.T_tilt(E))) if tm.__class__ == SecondTM else np.zeros((6, 6, 6))
+        R_ref, T_ref = transfer_maps_mult_py(R_ref, T_ref, tm.R(E), Tb)
+        E += tm.delta_e
+    T_ref = unsym_matrix(T_ref)
+
+    result1 = check_matrix(R, R_ref, TOL, 'absotute', assert_info=' R - ')
+    result2 = check_matrix(T.flatten(), T_ref.flatten(), TOL, 'absotute', assert_info=' T - ')
+    assert check_result(result1 + result2)
+
+
+def setup_module(module):
+
+    f = open(pytest.TEST_RESULTS_FILE, 'a')
+    f.write('### SECOND ORDER MAPS START ###\n\n')
+    f.close()
+
+
+def teardown_module(module):
+
+    f = open(pytest.TEST_RESULTS_FILE, 'a')
+    f.write('### SECOND ORDER MAPS END ###\n\n\n')
+    f.close()
+
+
+def setup_function(function):
+
+    f = open(pytest.TEST_RESULTS_FILE, 'a')
+    f.write(function.__name__)
+    f.close()
+
+    pytest.t_start = time.time()
+
+
+def teardown_function(function):
+    f = open(pytest.TEST_RESULTS_FILE, 'a')
+    f.write(' execution time is ' + '{:.3f}'.format(time.time() - pytest.t_start) + ' sec\n\n')
+    f.close()
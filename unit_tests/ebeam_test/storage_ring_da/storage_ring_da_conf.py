@@ -15,6 +15,7 @@ B = Bend(l=2.7, k1=-.06, angle=2*pi/16.0, e1=pi/16.0, e2=pi/16.0, eid="B")
 
 SF = Sextupole(l=0.01, k2=150.0, eid="SF") #random value
 SD = Sextupole(l=0.01, k2=-150.0, eid="SD") #random value
+SEXT_K2 = {"SF": SF.k2, "SD": SD.k2}  # initial values, test_compensate_chromaticity changes them
 
 D1 = Drift(l=2.0, eid="D1")
 D2 = Drift(l=0.6, eid="D2")
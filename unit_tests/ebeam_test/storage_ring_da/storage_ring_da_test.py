@@ -3,6 +3,7 @@
 import os
 import sys
 import time
+from copy import deepcopy
 
 FILE_DIR = os.path.dirname(os.path.abspath(__file__))
 REF_RES_DIR = FILE_DIR + '/ref_results/'
@@ -119,6 +120,145 @@ def test_freq_analysis(lattice, tws, update_ref_values=False):
     assert check_result(result)
 
 
+def test_track_nturns_tpsa(lattice, tws, update_ref_values=False):
+    """Tracking with the one-turn Taylor map test, reference is element by element tracking"""
+
+    x_array = np.linspace(-0.001, 0.001, 5)
+    y_array = np.linspace(0.0001, 0.001, 4)
+    pxy_list = track_nturns(lattice, 10, create_track_list(x_array, y_array, p_array=[0.0]), save_track=True,
+                            print_progress=False)
+    pxy_list_tpsa = track_nturns(lattice, 10, create_track_list(x_array, y_array, p_array=[0.0]), save_track=True,
+                                 print_progress=False, tpsa_order=4)
+
+    result = []
+    for pxy, pxy_tpsa in zip(pxy_list, pxy_list_tpsa):
+        result += check_matrix(np.array(pxy_tpsa.p_list), np.array(pxy.p_list), TOL, 'absotute',
+                               assert_info=' p_list - ')
+    assert check_result(result)
+
+
+def test_track_nturns_losses(lattice, tws, update_ref_values=False):
+    """Deferred removal of the lost particles test, reference is tracking with removal after every superperiod"""
+
+    x_array = np.linspace(-0.03, 0.03, 10)
+    y_array = np.linspace(0.0001, 0.03, 8)
+    pxy_list = track_nturns(lattice, 20, create_track_list(x_array, y_array, p_array=[0.0]), nsuperperiods=8,
+                            save_track=True, print_progress=False, compact_threshold=0.)
+    pxy_list_mask = track_nturns(lattice, 20, create_track_list(x_array, y_array, p_array=[0.0]), nsuperperiods=8,
+                                 save_track=True, print_progress=False, compact_threshold=0.5)
+
+    result = []
+    for pxy, pxy_mask in zip(pxy_list, pxy_list_mask):
+        result.append(check_value(pxy_mask.turn, pxy.turn, TOL, assert_info=' turn - '))
+        result += check_matrix(np.array(pxy_mask.p_list), np.array(pxy.p_list), TOL, 'absotute',
+                               assert_info=' p_list - ')
+    assert check_result(result)
+
+    p_array = ParticleArray(n=5)
+    p_array.rparticles[0] = [0., 0.02, np.nan, 0., -0.03]
+    p_array.compact_threshold = 0.7
+    p_array.rm_tails(0.01, 0.01, 1, 1, turn=3, eid="D1")
+    record = p_array.loss_record()
+    assert p_array.size() == 5 and p_array.n_alive() == 2
+    assert list(record["id"]) == [1, 2, 4] and list(record["cause"]) == ["x", "nan", "x"]
+    assert list(record["turn"]) == [3, 3, 3] and record["eid"][0] == "D1"
+    p_array.mark_lost([0], turn=4)
+    p_array.compact()
+    assert p_array.size() == 1 and list(p_array.particle_ids()) == [3]
+
+
+def test_turn_recorder(lattice, tws, tmp_path, update_ref_values=False):
+    """Turn by turn recorder test, reference is tracking with all turns in memory"""
+
+    x_array = np.linspace(-0.03, 0.03, 10)
+    y_array = np.linspace(0.0001, 0.03, 8)
+    nturns = 20
+    pxy_list = track_nturns(lattice, nturns, create_track_list(x_array, y_array, p_array=[0.0]), nsuperperiods=8,
+                            print_progress=False)
+    x = np.full((nturns + 1, len(pxy_list)), np.nan)
+    for k, pxy in enumerate(pxy_list):
+        x[:len(pxy.p_list), k] = pxy.get_x()
+
+    filename = str(tmp_path / "track.dat")
+    with TurnRecorder(len(pxy_list), nturns, every=5, planes=[0, 2], filename=filename) as recorder:
+        pxy_list_rec = track_nturns(lattice, nturns, create_track_list(x_array, y_array, p_array=[0.0]),
+                                    nsuperperiods=8, print_progress=False, recorder=recorder)
+        result = check_matrix(np.nan_to_num(recorder.plane(0)), np.nan_to_num(x[::5]), TOL, 'absotute',
+                              assert_info=' x - ')
+        result += check_matrix(contour_da(recorder, nturns), contour_da(pxy_list, nturns), TOL,
+                               assert_info=' da - ')
+        n_stable = len(stable_particles(recorder, nturns))
+
+    x_file = np.memmap(filename, dtype=np.float64, mode="r", shape=recorder.data.shape)[:, 0]
+    result += check_matrix(np.nan_to_num(x_file), np.nan_to_num(x[::5]), TOL, 'absotute', assert_info=' file x - ')
+    assert check_result(result)
+    assert n_stable == len(stable_particles(pxy_list_rec, nturns))
+
+
+def test_da_fma_pool(lattice, tws, update_ref_values=False):
+    """Dynamic aperture and frequency map in the process pool test, reference is track_nturns()"""
+
+    x_array = np.linspace(-0.03, 0.03, 10)
+    y_array = np.linspace(0.0001, 0.03, 8)
+    da = da_pool(lattice, 20, x_array, y_array, nsuperperiods=8, workers=2)
+    pxy_list = track_nturns(lattice, 20, create_track_list(x_array, y_array, p_array=[0.0]), nsuperperiods=8,
+                            print_progress=False)
+    result = check_matrix(da.flatten(), [pxy.turn for pxy in pxy_list], TOL, assert_info=' da - ')
+
+    x_array = np.linspace(-0.01, 0.01, 5)
+    y_array = np.linspace(0.0001, 0.005, 3)
+    ctr_da, mux, muy = fma_pool(lattice, 128, x_array, y_array, nsuperperiods=8, workers=2)
+    pxy_list = track_nturns(lattice, 128, create_track_list(x_array, y_array, p_array=[0.0]), nsuperperiods=8,
+                            print_progress=False)
+    pxy_list = freq_analysis(pxy_list, lattice, 128, harm=True, nsuperperiods=8)
+    result += check_matrix(ctr_da.flatten(), contour_da(pxy_list, 128), TOL, assert_info=' contour_da - ')
+    result += check_matrix(mux.flatten(), [pxy.mux for pxy in pxy_list], TOL, assert_info=' mux - ')
+    result += check_matrix(muy.flatten(), [pxy.muy for pxy in pxy_list], TOL, assert_info=' muy - ')
+    assert check_result(result)
+
+
+def test_naff(lattice, method, update_ref_values=False):
+    """NAFF test, references are harmonic signals and FFT tunes with the accuracy 1/nturns"""
+
+    nturns = 512
+    k = np.arange(1024)[:, np.newaxis]
+    mu_ref = np.linspace(0.05, 0.45, 9)
+    amp_ref = np.linspace(0.5, 2., 9)
+    mu, amp = naff(amp_ref*np.cos(2*np.pi*mu_ref*k + 0.3))
+    result = check_matrix(mu, mu_ref, 1e-6, 'absotute', assert_info=' mu - ')
+    result += check_matrix(amp, amp_ref, 1e-4, 'absotute', assert_info=' amp - ')
+
+    # the lattice with the initial sextupoles, test_compensate_chromaticity changes the sextupoles of the lattice
+    cell = deepcopy(lattice.sequence)
+    for elem in cell:
+        if elem.__class__ == Sextupole:
+            elem.k2 = SEXT_K2[elem.id]
+    lat = MagneticLattice(cell, method=method)
+
+    x_array = np.linspace(-0.01, 0.01, 5)
+    y_array = np.linspace(0.0001, 0.005, 3)
+    pxy_list = track_nturns(lat, nturns, create_track_list(x_array, y_array, p_array=[0.0]), nsuperperiods=8,
+                            print_progress=False)
+    pxy_list = freq_analysis(pxy_list, lat, nturns, harm=True, nsuperperiods=8)
+    mux_fft = np.array([pxy.mux for pxy in pxy_list])
+    muy_fft = np.array([pxy.muy for pxy in pxy_list])
+    pxy_list = freq_analysis(pxy_list, lat, nturns, harm=True, nsuperperiods=8, method="naff")
+    result += check_matrix(np.array([pxy.mux for pxy in pxy_list]), mux_fft, 1./nturns, 'absotute', assert_info=' mux - ')
+    result += check_matrix(np.array([pxy.muy for pxy in pxy_list]), muy_fft, 1./nturns, 'absotute', assert_info=' muy - ')
+
+    x = np.array([pxy.get_x() for pxy in pxy_list]).T
+    y = np.array([pxy.get_y() for pxy in pxy_list]).T
+    mux, muy, diffusion, ax, ay = naff_fma(x, y)
+    result += check_matrix(mux, mux_fft, 1./nturns, 'absotute', assert_info=' fma mux - ')
+
+    alive = np.arange(len(pxy_list)) != 2
+    mux_alive = naff_fma(x, y, alive=alive)[0]
+    result += check_matrix(mux_alive[alive], mux[alive], 1e-12, 'absotute', assert_info=' alive mux - ')
+    assert check_result(result)
+    assert np.all(diffusion < -5)
+    assert np.isnan(mux_alive[2])
+
+
 def compensate_chromaticity_wrapper(lattice):
 
     ksi_x = 0.0
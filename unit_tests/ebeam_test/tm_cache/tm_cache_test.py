@@ -0,0 +1,118 @@
+"""Test of the transfer matrices cache"""
+
+import os
+import sys
+import time
+import gc
+import weakref
+
+FILE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+from unit_tests.params import *
+from tm_cache_conf import *
+from ocelot.cpbd.optics import tm_cache
+
+
+def test_cached_matrices(lattice, tws0):
+    """lattice transfer map with and without cache"""
+
+    tm_cache.clear()
+    R = lattice_transfer_map(lattice, tws0.E)
+    T = np.copy(lattice.T)
+    tws = twiss(lattice, tws0)
+
+    tm_cache.enabled = False
+    R_ref = lattice_transfer_map(lattice, tws0.E)
+    T_ref = lattice.T
+    tws_ref = twiss(lattice, tws0)
+    tm_cache.enabled = True
+
+    result1 = check_matrix(R, R_ref, TOL, assert_info=' R - ')
+    result2 = check_matrix(T.flatten(), T_ref.flatten(), TOL, assert_info=' T - ')
+    result3 = check_value(tws[-1].beta_x, tws_ref[-1].beta_x, TOL, assert_info=' beta_x - ')
+    result4 = check_value(tws[-1].muy, tws_ref[-1].muy, TOL, assert_info=' muy - ')
+    assert check_result(result1 + result2 + [result3, result4])
+    assert tm_cache.hits > tm_cache.misses
+
+
+def test_cache_invalidation(lattice, tws0):
+    """changed element parameters must not use old matrices"""
+
+    R0 = np.copy(lattice_transfer_map(lattice, tws0.E))
+    Qf.k1 = 1.3
+    lattice.update_transfer_maps()
+    R1 = np.copy(lattice_transfer_map(lattice, tws0.E))
+
+    tm_cache.enabled = False
+    R1_ref = lattice_transfer_map(lattice, tws0.E)
+    tm_cache.enabled = True
+
+    Qf.k1 = 1.2
+    lattice.update_transfer_maps()
+    R2 = lattice_transfer_map(lattice, tws0.E)
+
+    result1 = check_matrix(R1, R1_ref, TOL, assert_info=' R1 - ')
+    result2 = check_matrix(R2, R0, TOL, assert_info=' R2 - ')
+    assert check_result(result1 + result2)
+    assert np.max(np.abs(R1 - R0)) > 1e-3
+
+
+def test_cache_bounded(lattice, tws0):
+    """cache size is limited by maxsize"""
+
+    maxsize = tm_cache.maxsize
+    tm_cache.maxsize = 10
+    tm_cache.clear()
+    twiss(lattice, tws0, nPoints=100)
+    size = len(tm_cache)
+    tm_cache.maxsize = maxsize
+    assert size <= 10
+
+
+def test_object_params():
+    """object parameters are kept alive by the fingerprint, so their ids can not be reused in the cache keys"""
+
+    class Field:
+        pass
+
+    quad = Quadrupole(l=0.3, k1=1.2)
+    quad.field = Field()
+    field_ref = weakref.ref(quad.field)
+    params = quad.fingerprint()
+    quad.field = Field()
+    gc.collect()
+    assert field_ref() is not None
+    assert quad.fingerprint() != params
+    del params
+    gc.collect()
+    assert field_ref() is None
+
+
+
+def setup_module(module):
+
+    f = open(pytest.TEST_RESULTS_FILE, 'a')
+    f.write('### TM CACHE START ###\n\n')
+    f.close()
+
+
+def teardown_module(module):
+
+    f = open(pytest.TEST_RESULTS_FILE, 'a')
+    f.write('### TM CACHE END ###\n\n\n')
+    f.close()
+
+
+def setup_function(function):
+
+    f = open(pytest.TEST_RESULTS_FILE, 'a')
+    f.write(function.__name__)
+    f.close()
+
+    pytest.t_start = time.time()
+
+
+def teardown_function(function):
+    f = open(pytest.TEST_RESULTS_FILE, 'a')
+    f.write(' execution time is ' + '{:.3f}'.format(time.time() - pytest.t_start) + ' sec\n\n')
+    f.close()
@@ -0,0 +1,115 @@
+"""Test of the tracking with the compiled lattice"""
+
+import os
+import sys
+import time
+
+FILE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+from unit_tests.params import *
+from tracking_plan_conf import *
+
+
+def test_tracking_plan(cell, method):
+    """tracking with the compiled lattice, reference is element by element tracking"""
+
+    C = Cavity(l=0.5, v=0.01, freq=1.3e9, phi=10., eid="C")
+    lat = MagneticLattice(cell + (C,) + cell, method=method)
+
+    def track_steps(dz, energy):
+        np.random.seed(10)
+        p_array = ParticleArray(n=100)
+        p_array.rparticles[:] = np.random.randn(6, 100) * 1e-5
+        p_array.E = energy
+        navi = Navigator(lat)
+        while np.abs(navi.z0 - lat.totalLen) > 1e-10:
+            tracking_step(lat, p_array, dz, navi)
+        return p_array
+
+    p_ref = track_steps(lat.totalLen, 1.)
+    p_ref_steps = track_steps(1.3, 1.)
+    p_ref_energy = track_steps(lat.totalLen, 2.)
+
+    plan = lat.compile(energy=1., order=2)
+    runs = sorted([(start, stop) for start, (stop, tm) in plan.steps.items()])
+    p_plan = track_steps(lat.totalLen, 1.)
+    p_plan_steps = track_steps(1.3, 1.)
+    p_plan_energy = track_steps(lat.totalLen, 2.)
+
+    fused_tm = plan.steps[0][1]
+    Qd.k1 = -1.25
+    updated = lat.compile(energy=1., order=2) is plan and plan.steps[0][1] is not fused_tm
+    p_plan_mod = track_steps(lat.totalLen, 1.)
+    lat.plan = None
+    p_ref_mod = track_steps(lat.totalLen, 1.)
+    Qd.k1 = -1.2
+
+    result1 = check_matrix(p_plan.rparticles.flatten(), p_ref.rparticles.flatten(), 1e-11, 'absotute', assert_info=' plan - ')
+    result2 = check_matrix(p_plan_steps.rparticles.flatten(), p_ref_steps.rparticles.flatten(), 1e-11, 'absotute', assert_info=' plan steps - ')
+    result3 = check_matrix(p_plan_energy.rparticles.flatten(), p_ref_energy.rparticles.flatten(), 1e-15, 'absotute', assert_info=' plan energy - ')
+    result4 = check_matrix(p_plan_mod.rparticles.flatten(), p_ref_mod.rparticles.flatten(), 1e-11, 'absotute', assert_info=' plan modified - ')
+    result5 = check_value(p_plan.E, p_ref.E, TOL, assert_info=' E - ')
+    assert check_result(result1 + result2 + result3 + result4 + [result5])
+    n = lat.sequence.index(C)
+    assert runs == [(0, n), (n + 1, len(lat.sequence))]
+    assert updated
+
+
+
+def test_tracking_plan_update(cell, method):
+    """the plan is updated when the elements are changed between the steps of the tracking"""
+
+    C = Cavity(l=0.5, v=0.01, freq=1.3e9, phi=10., eid="C")
+    lat = MagneticLattice(cell + (C,) + cell, method=method)
+    z_cav = sum([elem.l for elem in cell]) + C.l
+
+    def track_steps():
+        np.random.seed(10)
+        p_array = ParticleArray(n=100)
+        p_array.rparticles[:] = np.random.randn(6, 100) * 1e-5
+        p_array.E = 1.
+        navi = Navigator(lat)
+        tracking_step(lat, p_array, z_cav, navi)
+        Qd.k1 = -1.25
+        lat.update_transfer_maps()
+        tracking_step(lat, p_array, lat.totalLen - z_cav, navi)
+        Qd.k1 = -1.2
+        lat.update_transfer_maps()
+        return p_array
+
+    lat.compile(energy=1., order=2)
+    p_plan = track_steps()
+    lat.plan = None
+    p_ref = track_steps()
+
+    result = check_matrix(p_plan.rparticles.flatten(), p_ref.rparticles.flatten(), 1e-11, 'absotute',
+                          assert_info=' plan - ')
+    assert check_result(result)
+
+def setup_module(module):
+
+    f = open(pytest.TEST_RESULTS_FILE, 'a')
+    f.write('### TRACKING PLAN START ###\n\n')
+    f.close()
+
+
+def teardown_module(module):
+
+    f = open(pytest.TEST_RESULTS_FILE, 'a')
+    f.write('### TRACKING PLAN END ###\n\n\n')
+    f.close()
+
+
+def setup_function(function):
+
+    f = open(pytest.TEST_RESULTS_FILE, 'a')
+    f.write(function.__name__)
+    f.close()
+
+    pytest.t_start = time.time()
+
+
+def teardown_function(function):
+    f = open(pytest.TEST_RESULTS_FILE, 'a')
+    f.write(' execution time is ' + '{:.3f}'.format(time.time() - pytest.t_start) + ' sec\n\n')
+    f.close()